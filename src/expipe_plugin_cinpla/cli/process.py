@@ -1,201 +1,384 @@
 # -*- coding: utf-8 -*-
+import ast
 from pathlib import Path
 
 import click
+import expipe
 import ruamel.yaml as yaml
 
 from expipe_plugin_cinpla.scripts import process
-from expipe_plugin_cinpla.tools.imports import project
 
-
-# TODO: update this
-def attach_to_process(cli):
-    @cli.command("ecephys", short_help="Process open ephys recordings.")
-    @click.argument("action-id", type=click.STRING)
-    @click.option(
-        "--probe-path",
+ecephys_options = [
+    click.option(
+        "-p",
+        "--project-path",
         type=click.STRING,
-        help="Path to probefile, assumed to be in expipe config directory by default.",
-    )
-    @click.option(
+        default=".",
+        help="The project path. Default is current directory.",
+    ),
+    click.option(
         "--sorter",
         default="mountainsort5",
         type=click.STRING,
         help="Spike sorter software to be used.",
-    )
-    @click.option(
-        "--acquisition",
-        default=None,
-        type=click.STRING,
-        help="(optional) Open ephys acquisition folder.",
-    )
-    @click.option(
-        "--exdir-path",
-        default=None,
-        type=click.STRING,
-        help="(optional) Exdir file path.",
-    )
-    @click.option(
+    ),
+    click.option(
         "--no-sorting",
         is_flag=True,
         help="if True spikesorting is not performed.",
-    )
-    @click.option(
+    ),
+    click.option(
         "--no-lfp",
         is_flag=True,
         help="if True LFP are not extracted.",
-    )
-    @click.option(
+    ),
+    click.option(
+        "--no-mua",
+        is_flag=True,
+        help="if True MUA are not extracted.",
+    ),
+    click.option(
         "--no-par",
         is_flag=True,
         help="if True groups are not sorted in parallel.",
-    )
-    @click.option(
-        "--sort-by",
+    ),
+    click.option(
+        "--sorting-workers",
+        type=click.INT,
+        default=None,
+        help="Number of groups sorted in parallel (by default, they are sorted sequentially).",
+    ),
+    click.option(
+        "--sorting-max-memory",
         type=click.STRING,
         default=None,
-        help="sort by property (group).",
-    )
-    @click.option(
-        "--no-mua",
+        help="Maximum memory of each sorting worker (e.g. 8G).",
+    ),
+    click.option(
+        "--no-sort-by-group",
         is_flag=True,
-        help="if True MUA are not extracted.",
-    )
-    @click.option(
+        help="if True all channels are sorted together instead of by group.",
+    ),
+    click.option(
         "--spike-params",
         type=click.STRING,
         default=None,
         help="Path to spike sorting params yml file.",
-    )
-    @click.option(
-        "--server",
-        type=click.STRING,
-        default=None,
-        help="'local' or name of expipe server.",
-    )
-    @click.option(
+    ),
+    click.option(
         "--bad-channels",
         "-bc",
         type=click.STRING,
         multiple=True,
         default=None,
-        help="Bad channels to ground.",
-    )
-    @click.option(
+        help="Bad channel ids to remove, as in the NWB file (e.g. CH1), or 'auto' for automatic detection.",
+    ),
+    click.option(
         "--bad-threshold",
         "-bt",
         type=click.FLOAT,
         default=None,
-        help="Bad channels to ground.",
+        help="Threshold for automatic bad channel detection. Default is the one of process_ecephys.",
+    ),
+    click.option(
+        "--ref",
+        default="cmr",
+        type=click.Choice(["cmr", "car", "none"]),
+        help="Reference to be used.",
+    ),
+    click.option(
+        "--split-channels",
+        default="all",
+        type=click.STRING,
+        help="It can be 'all', 'half', or list of channels " "used for custom split e.g. [[0,1,2,3,4], [5,6,7,8,9]]",
+    ),
+    click.option("--ms-before-wf", default=1, type=click.FLOAT, help="ms to clip before waveform peak"),
+    click.option("--ms-after-wf", default=2, type=click.FLOAT, help="ms to clip after waveform peak"),
+    click.option(
+        "--metric-names",
+        "-qm",
+        type=click.STRING,
+        multiple=True,
+        default=None,
+        help="Quality metrics to compute (all by default).",
+    ),
+    click.option(
+        "--n-components",
+        default=3,
+        type=click.INT,
+        help="Number of PCA components.",
+    ),
+    click.option(
+        "--singularity-image",
+        type=click.STRING,
+        default=None,
+        help="Singularity image to run the spike sorter in.",
+    ),
+    click.option(
+        "--overwrite",
+        is_flag=True,
+        help="Overwrite processed data in the NWB file.",
+    ),
+    click.option(
+        "--no-resume",
+        is_flag=True,
+        help="if True all processing stages are recomputed, even if they are already completed.",
+    ),
+    click.option(
+        "--keep-intermediates",
+        is_flag=True,
+        help="if True the preprocessed cache and the LFP/MUA are kept after writing to NWB.",
+    ),
+    click.option(
+        "--preprocessed-cache",
+        default="binary",
+        type=click.Choice(["binary", "lazy"]),
+        help="Save the preprocessed recording to a scratch binary shared by sorter, analyzer and phy ('binary'), "
+        "or compute it on the fly ('lazy').",
+    ),
+    click.option(
+        "--storage-format",
+        default=None,
+        type=click.Choice(["binary", "zarr"]),
+        help="Save the analyzer and the preprocessed recording uncompressed ('binary') or as compressed zarr "
+        "('zarr'). By default, the 'storage_format' of the project config, or 'binary'.",
+    ),
+]
+
+
+def add_ecephys_options(function):
+    for option in ecephys_options[::-1]:
+        function = option(function)
+    return function
+
+
+def get_process_kwargs(
+    no_sorting,
+    no_lfp,
+    no_mua,
+    no_par,
+    sorting_workers,
+    sorting_max_memory,
+    no_sort_by_group,
+    spike_params,
+    bad_channels,
+    bad_threshold,
+    ref,
+    split_channels,
+    ms_before_wf,
+    ms_after_wf,
+    metric_names,
+    n_components,
+    singularity_image,
+    overwrite,
+    no_resume,
+    keep_intermediates,
+    preprocessed_cache,
+    storage_format,
+):
+    """Converts the CLI options to keyword arguments for process.process_ecephys"""
+    if "auto" in bad_channels:
+        bad_channels = ["auto"]
+    else:
+        bad_channels = list(bad_channels)
+    if spike_params is not None:
+        spike_params = Path(spike_params)
+        if spike_params.is_file():
+            with spike_params.open() as f:
+                yaml_ = yaml.YAML(typ="safe", pure=True)
+                params = yaml_.load(f)
+        else:
+            params = None
+    else:
+        params = None
+    if split_channels not in ("all", "half"):
+        split_channels = ast.literal_eval(split_channels)
+        assert isinstance(split_channels, list), (
+            "With custom reference the list of channels has to be provided " "with the --split-channels argument"
+        )
+    process_kwargs = dict(
+        spikesort=not no_sorting,
+        compute_lfp=not no_lfp,
+        compute_mua=not no_mua,
+        spikesorter_params=params,
+        bad_channel_ids=bad_channels,
+        reference=None if ref == "none" else ref,
+        split=split_channels,
+        spikesort_by_group=not no_sort_by_group,
+        ms_before=ms_before_wf,
+        ms_after=ms_after_wf,
+        metric_names=list(metric_names) if len(metric_names) > 0 else None,
+        overwrite=overwrite,
+        singularity_image=singularity_image,
+        n_components=n_components,
+        resume=not no_resume,
+        keep_intermediates=keep_intermediates,
+        preprocessed_cache=preprocessed_cache,
+        storage_format=storage_format,
+        sorting_n_workers=1 if no_par else sorting_workers,
+        sorting_max_memory=sorting_max_memory,
     )
+    if bad_threshold is not None:
+        process_kwargs["bad_threshold"] = bad_threshold
+    return process_kwargs
+
+
+def attach_to_process(cli):
+    @cli.command("ecephys", short_help="Process open ephys recordings.")
+    @click.argument("action-id", type=click.STRING)
+    @add_ecephys_options
+    def _process_ecephys(action_id, project_path, sorter, **options):
+        project = expipe.get_project(path=Path(project_path))
+        process.process_ecephys(
+            project=project,
+            action_id=action_id,
+            sorter=sorter,
+            **get_process_kwargs(**options),
+        )
+
+    @cli.command("ecephys-batch", short_help="Process several open ephys recordings in parallel.")
+    @click.argument("action-ids", type=click.STRING, nargs=-1, required=True)
     @click.option(
-        "--min-fr",
-        "-mfr",
-        type=click.FLOAT,
+        "--n-workers",
+        type=click.INT,
         default=None,
-        help="Minimum firing rate per unit to retain.",
+        help="Number of actions processed concurrently (one every 4 CPUs by default).",
     )
     @click.option(
-        "--min-isi",
-        "-mi",
-        type=click.FLOAT,
+        "--n-jobs",
+        type=click.INT,
         default=None,
-        help="Maximum isi violation rate (if > 0).",
+        help="Total number of CPUs to use (all, or the ones allocated by SLURM, by default).",
     )
     @click.option(
-        "--ref",
-        default="cmr",
-        type=click.Choice(["cmr", "car", "none"]),
-        help="Reference to be used.",
+        "--max-disk-jobs",
+        type=click.INT,
+        default=1,
+        help="Maximum number of concurrent disk-heavy stages.",
     )
     @click.option(
-        "--split-channels",
-        default="all",
+        "--report",
         type=click.STRING,
-        help="It can be 'all', 'half', or list of channels " "used for custom split e.g. [[0,1,2,3,4], [5,6,7,8,9]]",
+        default=None,
+        help="Path of the JSON status/timing report.",
+    )
+    @add_ecephys_options
+    def _process_ecephys_batch(action_ids, n_workers, n_jobs, max_disk_jobs, report, project_path, sorter, **options):
+        project = expipe.get_project(path=Path(project_path))
+        process.process_many(
+            project=project,
+            action_ids=action_ids,
+            sorter=sorter,
+            n_workers=n_workers,
+            n_jobs=n_jobs,
+            max_disk_jobs=max_disk_jobs,
+            report_path=report,
+            **get_process_kwargs(**options),
+        )
+
+    @cli.command("ecephys-slurm", short_help="Process several open ephys recordings with a SLURM array job.")
+    @click.argument("action-ids", type=click.STRING, nargs=-1, required=True)
+    @click.option("--cpus-per-task", type=click.INT, default=8, help="Number of CPUs of each task.")
+    @click.option("--mem", type=click.STRING, default=None, help="Memory of each task (e.g. 32G).")
+    @click.option("--time", "time_limit", type=click.STRING, default=None, help="Time limit of each task.")
+    @click.option("--partition", type=click.STRING, default=None, help="SLURM partition.")
+    @click.option(
+        "--max-concurrent",
+        type=click.INT,
+        default=None,
+        help="Maximum number of tasks running at the same time.",
+    )
+    @click.option(
+        "--sbatch-arg",
+        type=click.STRING,
+        multiple=True,
+        help="Additional #SBATCH option, e.g. --sbatch-arg=--account=nn1234k",
     )
-    @click.option("--ms-before-wf", default=1, type=click.FLOAT, help="ms to clip before waveform peak")
-    @click.option("--ms-after-wf", default=2, type=click.FLOAT, help="ms to clip after waveform peak")
-    def _process_openephys(
-        action_id,
-        probe_path,
+    @click.option(
+        "--setup",
+        type=click.STRING,
+        default=None,
+        help="Shell commands to run before processing (e.g. to activate an environment).",
+    )
+    @click.option("--run-folder", type=click.STRING, default=None, help="Folder of the job script, logs and report.")
+    @click.option("--sbatch", type=click.STRING, default="sbatch", help="The sbatch executable.")
+    @click.option("--dry-run", is_flag=True, help="Print the job script without submitting it.")
+    @add_ecephys_options
+    def _process_ecephys_slurm(
+        action_ids,
+        cpus_per_task,
+        mem,
+        time_limit,
+        partition,
+        max_concurrent,
+        sbatch_arg,
+        setup,
+        run_folder,
+        sbatch,
+        dry_run,
+        project_path,
         sorter,
-        no_sorting,
-        no_mua,
-        no_lfp,
-        ms_before_wf,
-        ms_after_wf,
-        spike_params,
-        server,
-        acquisition,
-        exdir_path,
-        bad_channels,
-        ref,
-        split_channels,
-        no_par,
-        sort_by,
-        bad_threshold,
-        min_fr,
-        min_isi,
+        **options,
     ):
-        if "auto" in bad_channels:
-            bad_channels = ["auto"]
-        else:
-            bad_channels = [int(bc) for bc in bad_channels]
-        if no_sorting:
-            spikesort = False
-        else:
-            spikesort = True
-        if no_lfp:
-            compute_lfp = False
-        else:
-            compute_lfp = True
-        if no_mua:
-            compute_mua = False
-        else:
-            compute_mua = True
-        if spike_params is not None:
-            spike_params = Path(spike_params)
-            if spike_params.is_file():
-                with spike_params.open() as f:
-                    yaml_ = yaml.YAML(typ="safe", pure=True)
-                    params = yaml_.load(f)
-            else:
-                params = None
-        else:
-            params = None
-        if no_par:
-            parallel = False
-        else:
-            parallel = True
+        from expipe_plugin_cinpla.scripts import slurm
 
-        if split_channels == "custom":
-            import ast
+        project = expipe.get_project(path=Path(project_path))
+        run_folder = slurm.prepare_slurm_run(
+            project,
+            action_ids,
+            sorter,
+            process_kwargs=get_process_kwargs(**options),
+            run_folder=run_folder,
+            cpus_per_task=cpus_per_task,
+            mem=mem,
+            time_limit=time_limit,
+            partition=partition,
+            max_concurrent=max_concurrent,
+            sbatch_args=list(sbatch_arg),
+            setup=setup,
+        )
+        slurm.submit_slurm_job(run_folder, sbatch=sbatch, dry_run=dry_run)
 
-            split_channels = ast.literal_eval(split_channels)
-            assert isinstance(split_channels, list), (
-                "With custom reference the list of channels has to be provided " "with the --split-channels argument"
-            )
-        process.process_openephys(
-            project=project,
-            action_id=action_id,
-            probe_path=probe_path,
-            sorter=sorter,
-            spikesort=spikesort,
-            compute_lfp=compute_lfp,
-            compute_mua=compute_mua,
-            spikesorter_params=params,
-            server=server,
-            acquisition_folder=acquisition,
-            exdir_file_path=exdir_path,
-            bad_channels=bad_channels,
-            ref=ref,
-            split=split_channels,
-            ms_before_wf=ms_before_wf,
-            ms_after_wf=ms_after_wf,
-            parallel=parallel,
-            sort_by=sort_by,
-            bad_threshold=bad_threshold,
-            firing_rate_threshold=min_fr,
-            isi_viol_threshold=min_isi,
+    @cli.command("slurm-report", short_help="Collect the status of a SLURM processing run.")
+    @click.argument("run-folder", type=click.Path(exists=True))
+    def _slurm_report(run_folder):
+        from expipe_plugin_cinpla.scripts import slurm
+
+        report = slurm.collect_slurm_report(run_folder)
+        for action_id, action_report in report["actions"].items():
+            duration = action_report.get("duration")
+            duration_str = f" in {round(duration)}s" if duration is not None else ""
+            error_str = f" ({action_report['error']})" if "error" in action_report else ""
+            print(f"{action_id}: {action_report['status']}{duration_str}{error_str}")
+        print(f"Report: {Path(run_folder) / 'report.json'}")
+
+    @cli.command("ecephys-profile", short_help="Aggregate the stage profiles of processed actions.")
+    @click.argument("action-ids", type=click.STRING, nargs=-1)
+    @click.option(
+        "-p",
+        "--project-path",
+        type=click.STRING,
+        default=".",
+        help="The project path. Default is current directory.",
+    )
+    @click.option("--sorter", type=click.STRING, default=None, help="Only collect the profiles of this sorter.")
+    @click.option(
+        "--output",
+        type=click.STRING,
+        default=None,
+        help="Path of the aggregated table (.parquet or .csv).",
+    )
+    def _ecephys_profile(action_ids, project_path, sorter, output):
+        from expipe_plugin_cinpla.scripts import profiling
+
+        project = expipe.get_project(path=Path(project_path))
+        profiles = profiling.collect_profiles(
+            project, sorter=sorter, action_ids=list(action_ids) if len(action_ids) > 0 else None, output_path=output
         )
+        if len(profiles) == 0:
+            print("No profiles found")
+            return
+        columns = ["wall_time", "cpu_time", "children_cpu_time", "peak_rss_mb"]
+        summary = profiles.groupby("name", sort=False).agg({column: ["sum", "max"] for column in columns})
+        print(f"Profiles of {profiles['action_id'].nunique()} actions:")
+        print(summary.round(1).to_string())
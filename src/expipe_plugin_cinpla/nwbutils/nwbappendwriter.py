@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import gc
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+import h5py
+
+JOURNAL_GROUP = ".journal"
+
+
+class NWBAppendWriter:
+    """
+    Context manager to add, replace or delete processed containers of an NWB file in place.
+
+    The NWB file is opened in append mode, so that only the affected containers are written and the
+    raw acquisition is never copied: write time scales with the size of the processed data.
+
+    All modifications are recorded in a journal file (``<nwb_path>.journal.json``) before they are applied.
+    Removed containers are moved to a backup group inside the file and only deleted when the new containers
+    have been successfully written (commit). If anything fails, the added containers are discarded, the
+    removed ones are moved back, the column names of the existing tables are restored and the resizable
+    datasets which existed before are truncated to their original
+    length, which discards the rows appended to them (rollback). Values overwritten in place in existing
+    datasets and attributes other than the column names are not journaled, so they are not restored.
+    A journal left behind by a crashed process is rolled back the next time the file is opened by the writer
+    (or with ``recover_nwb_file``).
+
+    The writer is not crash-safe: the journal only records which containers are modified, it does not protect
+    the HDF5 metadata itself. A process killed while HDF5 is writing (e.g. by SLURM or the OOM killer) can leave
+    the file unreadable, in which case no rollback is possible, so keep a backup of NWB files which cannot be
+    regenerated.
+
+    HDF5 does not reclaim the space of deleted objects, so the file grows every time containers are replaced.
+    Run ``repack_nwb_file`` (which calls ``h5repack``) to shrink it.
+
+    HDF5 does not allow to open a file in append mode while it is open in read-only mode, so all the readers of
+    the file in this process (e.g. ``NWBHDF5IO``, lazy extractors or ``NWBSession``) must be closed before
+    entering the writer, otherwise a ``RuntimeError`` is raised.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path to the NWB file
+    verbose : bool, default: False
+        If True, the journal operations are printed
+
+    Examples
+    --------
+    >>> with NWBAppendWriter(nwb_path) as writer:
+    ...     writer.remove("units")
+    ...     nwbfile = writer.read()
+    ...     nwbfile.add_unit_column(...)
+    """
+
+    def __init__(self, nwb_path, verbose=False):
+        self.nwb_path = Path(nwb_path)
+        self.journal_path = get_journal_path(self.nwb_path)
+        self.verbose = verbose
+        self.nwbfile = None
+        self._file = None
+        self._io = None
+        self._journal = None
+
+    def __enter__(self):
+        check_nwb_file_closed(self.nwb_path)
+        recover_nwb_file(self.nwb_path, verbose=self.verbose)
+        self._file = h5py.File(self.nwb_path, "r+")
+        existing = _list_paths(self._file)
+        # columns can be added to (or removed from) existing tables and rows can be appended to their columns, so
+        # the column names and the shapes of the resizable datasets are also journaled
+        colnames = {}
+        shapes = {}
+        for path in existing:
+            if not isinstance(self._file.get(path, getlink=True), h5py.HardLink):
+                continue
+            obj = self._file[path]
+            if "colnames" in obj.attrs:
+                colnames[path] = [_to_str(c) for c in obj.attrs["colnames"]]
+            if isinstance(obj, h5py.Dataset) and obj.chunks is not None:
+                shapes[path] = list(obj.shape)
+        self._journal = dict(status="pending", existing=existing, removed=[], colnames=colnames, shapes=shapes)
+        self._write_journal()
+        self._file.require_group(JOURNAL_GROUP)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                if self._io is not None:
+                    self._io.write(self.nwbfile)
+            except Exception:
+                self._close()
+                self.rollback()
+                raise
+            self._close()
+            self.commit()
+        else:
+            self._close()
+            self.rollback()
+        return False
+
+    def keys(self, path):
+        """Returns the names of the children of the group at `path` (empty if the group does not exist)"""
+        file = self._get_file()
+        if path not in file:
+            return []
+        return list(file[path].keys())
+
+    def remove(self, path):
+        """
+        Removes the container (group or dataset) at `path`.
+
+        Returns
+        -------
+        removed : bool
+            True if the container existed and has been removed
+        """
+        file = self._get_file()
+        path = path.strip("/")
+        if path not in file:
+            return False
+        backup = f"{JOURNAL_GROUP}/{len(self._journal['removed'])}"
+        self._journal["removed"].append(dict(path=path, backup=backup))
+        self._write_journal()
+        file.move(path, backup)
+        if self.verbose:
+            print(f"\tRemoved {path}")
+        return True
+
+    def remove_column(self, table_path, column):
+        """
+        Removes a column (and its index, if ragged) from the DynamicTable at `table_path`.
+
+        Returns
+        -------
+        removed : bool
+            True if the column existed and has been removed
+        """
+        file = self._get_file()
+        table_path = table_path.strip("/")
+        if table_path not in file or column not in file[table_path]:
+            return False
+        table = file[table_path]
+        table.attrs["colnames"] = [_to_str(c) for c in table.attrs["colnames"] if _to_str(c) != column]
+        for name in (column, f"{column}_index", f"{column}_index_index"):
+            self.remove(f"{table_path}/{name}")
+        return True
+
+    def read(self):
+        """Opens the NWB file in append mode and returns the NWBFile object to add containers to"""
+        from pynwb import NWBHDF5IO
+
+        if self._io is None:
+            self._file.close()
+            self._file = None
+            self._io = NWBHDF5IO(str(self.nwb_path), mode="a")
+            self.nwbfile = self._io.read()
+        return self.nwbfile
+
+    def commit(self):
+        """Deletes the backups of the removed containers and the journal"""
+        self._journal["status"] = "committed"
+        self._write_journal()
+        _finalize(self.nwb_path)
+
+    def rollback(self):
+        """Discards the added containers and restores the removed ones"""
+        _rollback(self.nwb_path, self._journal, verbose=self.verbose)
+
+    def _get_file(self):
+        if self._file is None:
+            raise RuntimeError("Containers can only be removed before calling read()")
+        return self._file
+
+    def _close(self):
+        if self._io is not None:
+            try:
+                self._io.close()
+            finally:
+                self._io = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_journal(self):
+        journal_tmp = self.journal_path.with_suffix(".tmp")
+        journal_tmp.write_text(json.dumps(self._journal))
+        journal_tmp.replace(self.journal_path)
+
+
+def get_journal_path(nwb_path):
+    """Returns the path of the journal file of an NWB file"""
+    nwb_path = Path(nwb_path)
+    return nwb_path.parent / f"{nwb_path.name}.journal.json"
+
+
+def recover_nwb_file(nwb_path, verbose=True):
+    """
+    Recovers an NWB file left in an inconsistent state by a crashed NWBAppendWriter.
+
+    Pending modifications are rolled back, committed ones are finalized.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path to the NWB file
+    verbose : bool, default: True
+        If True, the recovery is printed
+
+    Returns
+    -------
+    recovered : bool
+        True if a journal was found and the file has been recovered
+    """
+    journal_path = get_journal_path(nwb_path)
+    if not journal_path.is_file():
+        return False
+    journal = json.loads(journal_path.read_text())
+    if journal["status"] == "committed":
+        if verbose:
+            print(f"Finalizing interrupted write of {nwb_path}")
+        _finalize(nwb_path)
+    else:
+        if verbose:
+            print(f"Rolling back interrupted write of {nwb_path}")
+        _rollback(nwb_path, journal, verbose=verbose)
+    return True
+
+
+def repack_nwb_file(nwb_path, h5repack="h5repack"):
+    """
+    Rewrites an NWB file with ``h5repack`` to reclaim the space of the containers removed or replaced by
+    NWBAppendWriter.
+
+    The repacked file is written next to the NWB file and replaces it only if ``h5repack`` succeeds, so this
+    requires free disk space for a copy of the file.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path to the NWB file
+    h5repack : str, default: "h5repack"
+        The h5repack executable (installed with the HDF5 tools, e.g. ``conda install hdf5``)
+    """
+    nwb_path = Path(nwb_path)
+    if shutil.which(h5repack) is None:
+        raise FileNotFoundError(f"{h5repack} not found. Install the HDF5 tools (e.g. `conda install hdf5`)")
+    check_nwb_file_closed(nwb_path)
+    if get_journal_path(nwb_path).is_file():
+        recover_nwb_file(nwb_path)
+    repacked_path = nwb_path.parent / f"{nwb_path.name}.repack"
+    try:
+        subprocess.run([h5repack, str(nwb_path), str(repacked_path)], check=True)
+    except BaseException:
+        repacked_path.unlink(missing_ok=True)
+        raise
+    repacked_path.replace(nwb_path)
+
+
+def _finalize(nwb_path):
+    with h5py.File(nwb_path, "r+") as file:
+        if JOURNAL_GROUP in file:
+            del file[JOURNAL_GROUP]
+    get_journal_path(nwb_path).unlink()
+
+
+def _rollback(nwb_path, journal, verbose=False):
+    check_nwb_file_closed(nwb_path)
+    with h5py.File(nwb_path, "r+") as file:
+        # restore removed containers (in reverse order, since a removed column can be nested in a removed table)
+        for removed in journal["removed"][::-1]:
+            if removed["backup"] not in file:
+                continue
+            if removed["path"] in file:
+                del file[removed["path"]]
+            file.move(removed["backup"], removed["path"])
+            if verbose:
+                print(f"\tRestored {removed['path']}")
+        for table_path, colnames in journal["colnames"].items():
+            if table_path in file:
+                file[table_path].attrs["colnames"] = colnames
+        # discard the rows appended to existing datasets
+        for path, shape in journal.get("shapes", {}).items():
+            if path in file and isinstance(file[path], h5py.Dataset) and list(file[path].shape) != shape:
+                file[path].resize(shape)
+                if verbose:
+                    print(f"\tTruncated {path}")
+        # discard added containers
+        existing = set(journal["existing"])
+        for path in _list_paths(file):
+            parent = path.rpartition("/")[0]
+            if path not in existing and path != JOURNAL_GROUP and (parent == "" or parent in existing):
+                if path in file:
+                    del file[path]
+                    if verbose:
+                        print(f"\tDiscarded {path}")
+        if JOURNAL_GROUP in file:
+            del file[JOURNAL_GROUP]
+    get_journal_path(nwb_path).unlink()
+
+
+def _to_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _list_paths(group, prefix=""):
+    """Lists the paths of all links in a group, without following soft and external links"""
+    paths = []
+    for name in group:
+        path = f"{prefix}/{name}" if prefix else name
+        if path == JOURNAL_GROUP:
+            continue
+        paths.append(path)
+        if isinstance(group.get(name, getlink=True), h5py.HardLink) and isinstance(group[name], h5py.Group):
+            paths.extend(_list_paths(group[name], path))
+    return paths
+
+
+def check_nwb_file_closed(nwb_path):
+    """
+    Raises an error if the NWB file is still open in this process (e.g. by lazy extractors or widgets), since HDF5
+    does not allow to open a file in append mode while it is open in read-only mode.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path to the NWB file
+    """
+    # readers which are not referenced anymore are closed when garbage collected
+    gc.collect()
+    nwb_path = Path(nwb_path).resolve()
+    # a file stays open as long as one of its objects is open, even if its file identifier has been closed
+    object_types = h5py.h5f.OBJ_FILE | h5py.h5f.OBJ_GROUP | h5py.h5f.OBJ_DATASET | h5py.h5f.OBJ_ATTR
+    open_objects = []
+    for object_id in h5py.h5f.get_obj_ids(types=object_types):
+        if Path(h5py.h5f.get_name(object_id).decode()).resolve() == nwb_path:
+            open_objects.append((h5py.h5i.get_name(object_id) or b"").decode())
+    if len(open_objects) > 0:
+        # the names of the open objects hint at the reader (e.g. "/units/spike_times" for a sorting)
+        open_objects = sorted(set(name for name in open_objects if name))
+        raise RuntimeError(
+            f"{nwb_path} is still open in this process (open objects: {', '.join(open_objects[:5]) or '/'}). "
+            "Delete or close the objects reading from it (e.g. NWBHDF5IO, recordings or sortings read with "
+            "spikeinterface, NWBSession or the analyzers of widgets) before writing to it"
+        )
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+
+# cache of the last chunk read from the source recording, shared by all the CachedTracesRecording of a process
+_traces_cache = {}
+
+
+class CachedTracesRecording(BaseRecording):
+    """
+    Recording serving the traces of its parent from a chunk cache shared by all the instances with the same
+    `cache_key` in the process.
+
+    It is used by `save_fused` to read each chunk of the raw data once and feed several preprocessing chains
+    (highpass, LFP, MUA): the cache is filled with `fill_cache` and all the requests inside the cached window
+    (including the margins of filters and resampling) are served from memory. Other requests are read from the
+    parent.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The source recording
+    cache_key : str
+        The key of the shared cache
+    """
+
+    def __init__(self, recording, cache_key):
+        BaseRecording.__init__(self, recording.sampling_frequency, recording.channel_ids, recording.get_dtype())
+        recording.copy_metadata(self)
+        for segment_index, parent_segment in enumerate(recording._recording_segments):
+            self.add_recording_segment(CachedTracesRecordingSegment(parent_segment, cache_key, segment_index))
+        self._kwargs = dict(recording=recording, cache_key=cache_key)
+
+    def fill_cache(self, segment_index, start_frame, end_frame):
+        """Reads the traces of all channels between `start_frame` and `end_frame` into the shared cache"""
+        segment = self._recording_segments[segment_index]
+        start_frame = max(0, start_frame)
+        end_frame = min(segment.get_num_samples(), end_frame)
+        traces = segment.parent_segment.get_traces(start_frame, end_frame, slice(None))
+        _traces_cache[segment.cache_key] = (segment_index, start_frame, end_frame, traces)
+
+
+class CachedTracesRecordingSegment(BaseRecordingSegment):
+    def __init__(self, parent_segment, cache_key, segment_index):
+        BaseRecordingSegment.__init__(self, **parent_segment.get_times_kwargs())
+        self.parent_segment = parent_segment
+        self.cache_key = cache_key
+        self.segment_index = segment_index
+
+    def get_num_samples(self):
+        return self.parent_segment.get_num_samples()
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        start_frame = 0 if start_frame is None else start_frame
+        end_frame = self.get_num_samples() if end_frame is None else end_frame
+        cache = _traces_cache.get(self.cache_key)
+        if cache is not None:
+            segment_index, cache_start, cache_end, traces = cache
+            if segment_index == self.segment_index and cache_start <= start_frame and end_frame <= cache_end:
+                traces = traces[start_frame - cache_start : end_frame - cache_start]
+                if channel_indices is not None:
+                    traces = traces[:, channel_indices]
+                return traces
+        return self.parent_segment.get_traces(start_frame, end_frame, channel_indices)
+
+
+def clear_cache(cache_key):
+    """Removes the chunk of a cache key from the shared cache of the process"""
+    _traces_cache.pop(cache_key, None)
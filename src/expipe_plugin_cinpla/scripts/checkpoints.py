@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+class StageCheckpoints:
+    """
+    Keeps track of the completed stages of a processing pipeline.
+
+    Each stage is identified by a key, which is a content hash of its inputs and parameters (including the key of
+    the stage it depends on, so that changing an early stage invalidates all the following ones).
+    The keys of the completed stages and the outputs they produced are stored in ``checkpoints.json`` in the
+    output folder. A stage is skipped on a rerun if its key is unchanged and all its outputs still exist.
+
+    Parameters
+    ----------
+    folder : str or Path
+        The output folder of the pipeline (e.g. ``spikeinterface/<sorter>``)
+    resume : bool, default: True
+        If False, existing checkpoints are ignored and all stages are recomputed
+    """
+
+    file_name = "checkpoints.json"
+
+    def __init__(self, folder, resume=True):
+        self.folder = Path(folder)
+        self.checkpoint_file = self.folder / self.file_name
+        self.checkpoints = {}
+        if resume and self.checkpoint_file.is_file():
+            self.checkpoints = json.loads(self.checkpoint_file.read_text())
+
+    def is_done(self, stage, key):
+        """Returns True if the stage has been completed with the same key and its outputs still exist"""
+        checkpoint = self.checkpoints.get(stage)
+        if checkpoint is None or checkpoint["key"] != key:
+            return False
+        return all((self.folder / output).exists() for output in checkpoint["outputs"])
+
+    def mark_done(self, stage, key, outputs=()):
+        """
+        Records a completed stage.
+
+        Parameters
+        ----------
+        stage : str
+            The stage name
+        key : str
+            The stage key (see ``compute_key``)
+        outputs : list, default: ()
+            The outputs (files or folders) of the stage, relative to the output folder
+        """
+        self.checkpoints[stage] = dict(
+            key=key,
+            outputs=[str(output) for output in outputs],
+            completed=datetime.now().isoformat(timespec="seconds"),
+        )
+        self._write()
+
+    def invalidate(self, stage):
+        """Removes the checkpoint of a stage"""
+        if self.checkpoints.pop(stage, None) is not None:
+            self._write()
+
+    def _write(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        checkpoint_tmp = self.checkpoint_file.with_suffix(".tmp")
+        checkpoint_tmp.write_text(json.dumps(self.checkpoints, indent=4))
+        checkpoint_tmp.replace(self.checkpoint_file)
+
+
+def compute_key(*args, **kwargs):
+    """Computes a content hash of JSON-serializable arguments (numpy objects and paths are also supported)"""
+    content = json.dumps(dict(args=args, kwargs=kwargs), sort_keys=True, default=_to_serializable)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_acquisition_key(nwb_path, electrical_series_path="acquisition/ElectricalSeries"):
+    """
+    Computes a content hash of the raw acquisition of an NWB file.
+
+    Hashing the full raw data would take as long as reading it, so the hash includes the shape, dtype and
+    timing of the electrical series, the first and last chunks of the data, and the electrodes table.
+    Containers added to the file after the acquisition (e.g. processed data) do not change the hash.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path to the NWB file
+    electrical_series_path : str, default: "acquisition/ElectricalSeries"
+        Path to the raw electrical series
+
+    Returns
+    -------
+    key : str
+        The acquisition hash
+    """
+    import h5py
+
+    sha = hashlib.sha1()
+    with h5py.File(nwb_path, "r") as file:
+        electrical_series = file[electrical_series_path]
+        data = electrical_series["data"]
+        chunk_size = data.chunks[0] if data.chunks is not None else min(30000, data.shape[0])
+        sha.update(str((data.shape, data.dtype.str)).encode())
+        for name in ("starting_time", "timestamps"):
+            if name in electrical_series:
+                dataset = electrical_series[name]
+                sha.update(str(dict(dataset.attrs)).encode())
+                sha.update(np.asarray(dataset[()] if dataset.ndim == 0 else dataset[:chunk_size]).tobytes())
+        sha.update(np.ascontiguousarray(data[:chunk_size]).tobytes())
+        sha.update(np.ascontiguousarray(data[-chunk_size:]).tobytes())
+        electrodes = file["general/extracellular_ephys/electrodes"]
+        for name in sorted(electrodes):
+            dataset = electrodes[name]
+            # object references (e.g. the electrode group) are not hashable content
+            if dataset.dtype.kind != "O" or h5py.check_string_dtype(dataset.dtype) is not None:
+                sha.update(name.encode())
+                sha.update(str(dataset[:].tolist()).encode())
+    return sha.hexdigest()
+
+
+def _to_serializable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, set):
+        return sorted(obj, key=str)
+    return str(obj)
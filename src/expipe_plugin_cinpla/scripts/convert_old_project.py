@@ -9,6 +9,7 @@ import expipe
 from .curation import SortingCurator
 from .process import process_ecephys
 from .register import convert_to_nwb, register_entity
+from .utils import link_phy_recording
 
 
 def convert_old_project(
@@ -215,15 +216,20 @@ def convert_old_project(
                     if new_phy_folder.is_dir():
                         shutil.rmtree(new_phy_folder)
                     print(f"\tCopying folder for {sorter_folder.name}")
-                    shutil.copytree(old_phy_folder, new_phy_folder)
-                    # update the recording.dat in params.py
-                    params_file = new_phy_folder / "params.py"
-                    params_str = params_file.read_text()
-                    idx_n_channels = params_str.find("n_channels_dat")
-                    rest = params_str[idx_n_channels:]
-                    new_head = f"dat_path = '{str(new_phy_folder / 'recording.dat')}'\n"
-                    new_params_str = new_head + rest
-                    params_file.write_text(new_params_str)
+                    shutil.copytree(old_phy_folder, new_phy_folder, ignore=shutil.ignore_patterns("recording.dat"))
+                    old_dat_file = old_phy_folder / "recording.dat"
+                    if old_dat_file.is_file():
+                        # the traces are never modified by phy, so they are hard-linked instead of copied
+                        link_phy_recording(new_phy_folder, old_dat_file)
+                    else:
+                        # update the recording.dat in params.py
+                        params_file = new_phy_folder / "params.py"
+                        params_str = params_file.read_text()
+                        idx_n_channels = params_str.find("n_channels_dat")
+                        rest = params_str[idx_n_channels:]
+                        new_head = f"dat_path = '{str(new_phy_folder / 'recording.dat')}'\n"
+                        new_params_str = new_head + rest
+                        params_file.write_text(new_params_str)
 
                 print("\n>>> Applying Phy curation and set main units\n")
                 # Generate new main unit table from Phy (with preprocessed data)
@@ -1,14 +1,30 @@
 # -*- coding: utf-8 -*-
+import json
 import shutil
 import warnings
+import weakref
+from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 import spikeinterface as si
 
+from .extensions import compute_extensions, get_extension_list, memmap_extensions
+from .storage import (
+    get_analyzer_folder,
+    get_analyzer_format,
+    get_storage_format,
+    get_units_dataset_settings,
+)
 from .utils import (
     _get_data_path,
     add_units_from_sorting_analyzer,
+    check_sortings_equal,
     compute_and_set_unit_groups,
+    get_timing_recording,
+    get_unit_spike_hashes,
+    get_unit_spike_indices,
+    replace_analyzer_recording,
 )
 
 warnings.filterwarnings("ignore", category=ResourceWarning)
@@ -33,21 +49,140 @@ metric_metric_str_to_si_metric_name = {
 }
 
 
+def compute_curation_diff(raw_sorting, curated_sorting):
+    """
+    Classifies the units of a curated sorting relative to the units of the raw sorting.
+
+    A curated unit is "unchanged" if it has the same spike train as a raw unit, "merged" if its spike train is the
+    union of the spike trains of several raw units, "split" if its spike train is part of the spike train of a raw
+    unit and "modified" otherwise (e.g. split and then merged). The raw units which are not the source of any curated
+    unit are "removed" (e.g. labeled as noise). The spike trains are compared by hashing the spike indices of each
+    unit, and only the spikes of the changed units are looked up in the spikes of the raw sorting.
+
+    Parameters
+    ----------
+    raw_sorting : BaseSorting
+        The raw sorting
+    curated_sorting : BaseSorting
+        The curated sorting
+
+    Returns
+    -------
+    curation_diff : dict
+        Dictionary with "units", a dictionary with the curated unit ids as key and a dictionary with the "status" and
+        the raw unit ids it comes "from" as value, and "removed", the list of removed raw unit ids
+    """
+    raw_spike_hashes = {}
+    for unit_id, spike_hash in get_unit_spike_hashes(raw_sorting).items():
+        raw_spike_hashes.setdefault(spike_hash, unit_id)
+    spike_hashes = get_unit_spike_hashes(curated_sorting)
+
+    # the raw spikes, sorted by time
+    raw_spikes = raw_sorting.to_spike_vector()
+    spikes = curated_sorting.to_spike_vector()
+    num_samples = max(raw_spikes["sample_index"].max(initial=0), spikes["sample_index"].max(initial=0)) + 1
+    raw_times = raw_spikes["segment_index"].astype("int64") * num_samples + raw_spikes["sample_index"]
+    times = spikes["segment_index"].astype("int64") * num_samples + spikes["sample_index"]
+    raw_order = np.argsort(raw_times, kind="stable")
+    raw_times = raw_times[raw_order]
+    raw_unit_indices = raw_spikes["unit_index"][raw_order]
+    raw_num_spikes = np.bincount(raw_spikes["unit_index"], minlength=raw_sorting.get_num_units())
+
+    units = {}
+    for unit_id, spike_indices in get_unit_spike_indices(curated_sorting).items():
+        if spike_hashes[unit_id] in raw_spike_hashes:
+            units[unit_id] = dict(status="unchanged", from_unit_ids=[raw_spike_hashes[spike_hashes[unit_id]]])
+            continue
+        # number of spikes of each raw unit at the times of the spikes of the unit
+        starts = np.searchsorted(raw_times, times[spike_indices], side="left")
+        num_matches = np.searchsorted(raw_times, times[spike_indices], side="right") - starts
+        match_indices = np.repeat(starts - np.cumsum(num_matches) + num_matches, num_matches) + np.arange(
+            np.sum(num_matches)
+        )
+        # (counted once, even if the unit has several spikes at the same time, e.g. after a merge)
+        num_common_spikes = np.bincount(
+            raw_unit_indices[np.unique(match_indices)], minlength=raw_sorting.get_num_units()
+        )
+
+        num_spikes = len(spike_indices)
+        contained = np.flatnonzero((num_common_spikes == raw_num_spikes) & (raw_num_spikes > 0))
+        containing = np.flatnonzero(num_common_spikes == num_spikes)
+        if len(contained) > 1 and np.all(num_matches > 0) and np.sum(raw_num_spikes[contained]) == num_spikes:
+            status, from_unit_indices = "merged", contained
+        elif num_spikes > 0 and len(containing) > 0:
+            status, from_unit_indices = "split", containing[:1]
+        else:
+            # the raw units sharing a significant part of their spikes (not only coincident spikes)
+            status = "modified"
+            from_unit_indices = np.flatnonzero(
+                (num_common_spikes > 0) & (num_common_spikes >= 0.1 * np.minimum(raw_num_spikes, num_spikes))
+            )
+        units[unit_id] = dict(status=status, from_unit_ids=list(raw_sorting.unit_ids[from_unit_indices]))
+
+    from_unit_ids = set(raw_unit_id for unit in units.values() for raw_unit_id in unit["from_unit_ids"])
+    removed = [raw_unit_id for raw_unit_id in raw_sorting.unit_ids if raw_unit_id not in from_unit_ids]
+    return dict(units=units, removed=removed)
+
+
+def summarize_curation_diff(curation_diff):
+    """Returns the number of curated units of each status and the number of removed raw units of a curation diff"""
+    summary = {status: 0 for status in ["unchanged", "merged", "split", "modified"]}
+    for unit in curation_diff["units"].values():
+        summary[unit["status"]] += 1
+    summary["removed"] = len(curation_diff["removed"])
+    return summary
+
+
+def write_curation_log(curation_diff, log_path, **info):
+    """
+    Writes a curation diff (see `compute_curation_diff`) as a JSON curation log.
+
+    Parameters
+    ----------
+    curation_diff : dict
+        The curation diff
+    log_path : str or Path
+        The JSON file
+    **info : dict
+        Information about the curation stored in the log (e.g. action_id, sorter, description)
+    """
+    curation_log = dict(
+        **info,
+        date=datetime.now().isoformat(timespec="seconds"),
+        summary=summarize_curation_diff(curation_diff),
+        units={str(unit_id): unit for unit_id, unit in curation_diff["units"].items()},
+        removed=curation_diff["removed"],
+    )
+    # numpy scalars (e.g. integer unit ids) are written as strings
+    Path(log_path).write_text(json.dumps(curation_log, indent=4, default=str))
+
+
 class SortingCurator:
-    def __init__(self, project) -> None:
+    def __init__(self, project, analyzer_format=None) -> None:
+        if analyzer_format is None:
+            # by default, the curated analyzer is saved with the storage format of the project
+            analyzer_format = get_analyzer_format(get_storage_format(project))
+        assert analyzer_format in ("binary_folder", "zarr", "memory"), f"Invalid analyzer format {analyzer_format}"
         self.project = project
+        self.analyzer_format = analyzer_format
         self.action = None
         self.nwb_path_tmp = None
         self.nwb_path_main = None
         self.nwbfile = None
-        self.io = None
+        self.ios = []
+        # the analyzers returned to the caller, whose processed recording reads from the NWB file
+        self.analyzers = weakref.WeakSet()
         self.si_path = None
         self.curated_sorting = None
         self.curated_analyzer = None
         self.curation_description = ""
+        self.curation_sorter = None
+        self.curation_diff = None
 
     def set_action(self, action_id):
         self.action = self.project.actions[action_id]
+        self.curation_sorter = None
+        self.curation_diff = None
         self.remove_tmp_files()
         nwb_path = _get_data_path(self.action)
         nwb_path_tmp = nwb_path.parent / "main_tmp.nwb"
@@ -58,39 +193,31 @@ class SortingCurator:
         self.si_path = self.nwb_path_tmp.parent / "spikeinterface"
 
     def check_sortings_equal(self, sorting1, sorting2):
-        if sorting1.get_num_units() != sorting2.get_num_units():
-            return False
-
-        if not np.array_equal(sorting1.unit_ids.astype(str), sorting2.unit_ids.astype(str)):
-            return False
-
-        if not np.array_equal(sorting1.to_spike_vector(), sorting2.to_spike_vector()):
-            return False
-
-        return True
+        return check_sortings_equal(sorting1, sorting2)
 
     def load_raw_sorting(self, sorter):
         import spikeinterface.extractors as se
 
         raw_units_path = f"processing/ecephys/RawUnits-{sorter}"
         try:
-            sorting_raw = se.read_nwb_sorting(
+            sorting_nwb = se.read_nwb_sorting(
                 self.nwb_path_main,
                 unit_table_path=raw_units_path,
                 electrical_series_path="acquisition/ElectricalSeries",
             )
+            # the raw sorting is loaded in memory, so that it does not keep the NWB file open (see `save_to_nwb`)
+            sorting_raw = si.NumpySorting.from_sorting(sorting_nwb, with_metadata=True)
+            del sorting_nwb
             return sorting_raw
         except Exception as e:
             print(f"Could not load raw sorting for {sorter}. Using None.\nError: {e}")
             return None
 
     def load_raw_units(self, sorter):
-        from pynwb import NWBHDF5IO
         from spikeinterface.extractors.nwbextractors import _retrieve_unit_table_pynwb
 
         raw_units_path = f"processing/ecephys/RawUnits-{sorter}"
-        self.io = NWBHDF5IO(self.nwb_path_main, "r")
-        nwbfile = self.io.read()
+        nwbfile = self._read_nwbfile()
         try:
             units = _retrieve_unit_table_pynwb(nwbfile, raw_units_path)
             return units
@@ -99,20 +226,14 @@ class SortingCurator:
             return None
 
     def load_main_units(self):
-        from pynwb import NWBHDF5IO
-
-        self.io = NWBHDF5IO(self.nwb_path_main, "r")
-        nwbfile = self.io.read()
+        nwbfile = self._read_nwbfile()
         return nwbfile.units
 
     def construct_curated_units(self):
         if self.curated_analyzer is None:
             print("No units left after curation.")
             return
-        from pynwb import NWBHDF5IO
-
-        self.io = NWBHDF5IO(self.nwb_path_main, "r")
-        nwbfile = self.io.read()
+        nwbfile = self._read_nwbfile()
         add_units_from_sorting_analyzer(
             self.curated_analyzer,
             nwbfile,
@@ -123,6 +244,28 @@ class SortingCurator:
         )
         return nwbfile.processing["ecephys"].data_interfaces["CuratedUnits"]
 
+    def _read_nwbfile(self):
+        from pynwb import NWBHDF5IO
+
+        # the readers are kept open, since the loaded units tables read from the file lazily
+        io = NWBHDF5IO(self.nwb_path_main, "r")
+        self.ios.append(io)
+        return io.read()
+
+    def close_readers(self):
+        """
+        Closes the readers of the NWB file opened by the curator: the readers of the units tables are closed and
+        the processed recording of the analyzers returned by `load_raw_analyzer` and `load_curated_analyzer` is
+        replaced by a recording with the same times and no traces (their extensions are kept).
+        """
+        for io in self.ios:
+            io.close()
+        self.ios = []
+        for analyzer in list(self.analyzers):
+            if analyzer.has_temporary_recording():
+                self._set_processed_recording(analyzer, get_timing_recording(analyzer.recording))
+        self.analyzers = weakref.WeakSet()
+
     def load_processed_recording(self, sorter):
         preprocessed_json = self.si_path / sorter / "preprocessed.json"
         try:
@@ -135,33 +278,96 @@ class SortingCurator:
         if (self.si_path / sorter / "waveforms").is_dir():
             waveforms_folder = self.si_path / sorter / "waveforms"
             raw_analyzer = si.load_waveforms(waveforms_folder, output="SortingAnalyzer")
-        elif (self.si_path / sorter / "analyzer").is_dir():
-            raw_analyzer = si.load_sorting_analyzer(self.si_path / sorter / "analyzer")
+            self._set_processed_recording(raw_analyzer, self.load_processed_recording(sorter))
+        elif get_analyzer_folder(self.si_path / sorter) is not None:
+            raw_analyzer = self._load_analyzer(get_analyzer_folder(self.si_path / sorter), sorter)
         else:
             return None
-        recording = self.load_processed_recording(sorter)
-        raw_analyzer.set_temporary_recording(recording)
         return raw_analyzer
 
+    def _load_analyzer(self, folder, sorter, load_extensions=True):
+        # the analyzer is loaded with a recording without traces (instead of the recording of its provenance, which
+        # reads from the NWB file), and the processed recording is set as temporary recording
+        recording = self.load_processed_recording(sorter)
+        analyzer = si.SortingAnalyzer.load(
+            folder, recording=get_timing_recording(recording), load_extensions=load_extensions
+        )
+        self._set_processed_recording(analyzer, recording)
+        return analyzer
+
+    def _set_processed_recording(self, analyzer, recording):
+        # the analyzers are kept (weakly), so that `close_readers` can release their processed recording
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="SortingAnalyzer recording is already set")
+            analyzer.set_temporary_recording(recording)
+        self.analyzers.add(analyzer)
+
+    def get_curated_analyzer_folder(self, sorter):
+        curated_analyzer_folder = self.si_path / sorter / "analyzer_curated"
+        if self.analyzer_format == "zarr":
+            curated_analyzer_folder = curated_analyzer_folder.with_suffix(".zarr")
+        return curated_analyzer_folder
+
+    def load_curated_analyzer(self, sorter, curated_sorting=None):
+        """
+        Loads the curated analyzer saved by `apply_curation`.
+
+        Parameters
+        ----------
+        sorter : str
+            The spike sorter name
+        curated_sorting : BaseSorting, optional
+            If given, the analyzer is only returned if it has the same units and spike trains
+
+        Returns
+        -------
+        curated_analyzer : SortingAnalyzer or None
+            The curated analyzer, with the processed recording, or None if it does not exist
+        """
+        curated_analyzer_folder = self.get_curated_analyzer_folder(sorter)
+        if self.analyzer_format == "memory" or not curated_analyzer_folder.exists():
+            return None
+        try:
+            curated_analyzer = self._load_analyzer(curated_analyzer_folder, sorter, load_extensions=False)
+        except Exception as e:
+            print(f"Could not load curated analyzer for {sorter}: {e}")
+            return None
+        if curated_sorting is not None and not self.check_sortings_equal(curated_analyzer.sorting, curated_sorting):
+            return None
+        memmap_extensions(curated_analyzer)
+        return curated_analyzer
+
     def apply_curation(self, sorter, curated_sorting):
+        import spikeinterface.curation as sc
+
+        recording = self.load_processed_recording(sorter)
+        # remove excess spikes
+        print("Removing excess spikes from curated sorting")
+        curated_sorting = sc.remove_excess_spikes(curated_sorting, recording=recording)
+
         sorting_raw = self.load_raw_sorting(sorter)
-        if sorting_raw is not None and self.check_sortings_equal(sorting_raw, curated_sorting):
+        self.curation_sorter = sorter
+        self.curation_diff = None
+        if sorting_raw is not None:
+            self.curation_diff = compute_curation_diff(sorting_raw, curated_sorting)
+            summary = summarize_curation_diff(self.curation_diff)
+            print(f"Curation of {sorter}: {', '.join(f'{num} {status}' for status, num in summary.items())}")
+        # the spike trains of all the raw units are unchanged
+        if (
+            self.curation_diff is not None
+            and summary["unchanged"] == len(self.curation_diff["units"])
+            and summary["removed"] == 0
+        ):
             print(f"No curation was performed for {sorter}. Using raw sorting")
             self.curated_analyzer = None
         else:
-            import spikeinterface.curation as sc
-            import spikeinterface.qualitymetrics as sqm
-
             si.set_global_job_kwargs(n_jobs=-1, progress_bar=False)
 
-            recording = self.load_processed_recording(sorter)
-
-            # remove excess spikes
-            print("Removing excess spikes from curated sorting")
-            curated_sorting = sc.remove_excess_spikes(curated_sorting, recording=recording)
-
             # if "group" is not available or some missing groups, extract dense and estimate group
             compute_and_set_unit_groups(curated_sorting, recording)
+            # properties with object dtype are not saved in zarr analyzers
+            if curated_sorting.get_property("group").dtype.kind == "O":
+                curated_sorting.set_property("group", curated_sorting.get_property("group").astype(str))
 
             # sort by group and phy ID (if present)
             if "original_cluster_id" in curated_sorting.get_property_keys():
@@ -174,6 +380,7 @@ class SortingCurator:
 
             # load extension params from previously computed raw analyzer
             raw_analyzer = self.load_raw_analyzer(sorter)
+            unit_id_map = None
             if raw_analyzer is None:
                 print("No raw analyzer found. Using default values.")
                 ms_before = 1
@@ -183,30 +390,40 @@ class SortingCurator:
                 ms_before = raw_analyzer.get_extension("waveforms").params["ms_before"]
                 ms_after = raw_analyzer.get_extension("waveforms").params["ms_after"]
                 n_components = raw_analyzer.get_extension("principal_components").params["n_components"]
+                if self.curation_diff is not None:
+                    # the raw units of the NWB file are the units of the raw analyzer, with string ids
+                    raw_analyzer_unit_ids = {str(unit_id): unit_id for unit_id in raw_analyzer.unit_ids}
+                    unit_id_map = {
+                        unit_id: raw_analyzer_unit_ids[str(unit["from_unit_ids"][0])]
+                        for unit_id, unit in self.curation_diff["units"].items()
+                        if unit["status"] == "unchanged" and str(unit["from_unit_ids"][0]) in raw_analyzer_unit_ids
+                    }
+
+            # the curated analyzer is saved next to the raw analyzer, so that it is reused (e.g. after a restart)
+            # if the curated units did not change
+            self.curated_analyzer = self.load_curated_analyzer(sorter, curated_sorting)
+            if self.curated_analyzer is not None:
+                print("Reusing saved curated analyzer")
+            elif self.analyzer_format == "memory":
+                self.curated_analyzer = si.create_sorting_analyzer(
+                    curated_sorting,
+                    recording,
+                    sparse=True,
+                    method="by_property",
+                    by_property="group",
+                )
+            else:
+                self.curated_analyzer = si.create_sorting_analyzer(
+                    curated_sorting,
+                    recording,
+                    format=self.analyzer_format,
+                    folder=self.get_curated_analyzer_folder(sorter),
+                    overwrite=True,
+                    sparse=True,
+                    method="by_property",
+                    by_property="group",
+                )
 
-            self.curated_analyzer = si.create_sorting_analyzer(
-                curated_sorting,
-                recording,
-                sparse=True,
-                method="by_property",
-                by_property="group",
-            )
-            print("Recomputing all extensions")
-
-            extension_list = {
-                "noise_levels": {},
-                "random_spikes": {},
-                "waveforms": {"ms_before": ms_before, "ms_after": ms_after},
-                "templates": {"operators": ["average", "std", "median"]},
-                "spike_amplitudes": {},
-                "unit_locations": {},
-                "correlograms": {},
-                "template_similarity": {},
-                "isi_histograms": {},
-                "principal_components": {"n_components": n_components},
-                "template_metrics": {},
-            }
-            self.curated_analyzer.compute(extension_list)
             metric_names = []
             for property_name in curated_sorting.get_property_keys():
                 for metric_str in metric_metric_str_to_si_metric_name:
@@ -214,7 +431,19 @@ class SortingCurator:
                         new_metric = metric_metric_str_to_si_metric_name[metric_str]
                         if new_metric not in metric_names:
                             metric_names.append(new_metric)
-            _ = sqm.compute_quality_metrics(self.curated_analyzer, metric_names=metric_names)
+            # the waveforms and amplitudes of the units unchanged by the curation are carried over from the raw
+            # analyzer, so that only the spikes of the new (e.g. merged or split) units are read from the recording
+            print("Computing extensions")
+            extension_list = get_extension_list(ms_before=ms_before, ms_after=ms_after, n_components=n_components)
+            extension_list["quality_metrics"] = dict(metric_names=metric_names)
+            compute_extensions(
+                self.curated_analyzer,
+                extension_list,
+                source_analyzer=raw_analyzer,
+                unit_id_map=unit_id_map,
+                verbose=True,
+            )
+            memmap_extensions(self.curated_analyzer)
             print("Done applying curation")
 
     def load_from_phy(self, sorter):
@@ -258,6 +487,8 @@ class SortingCurator:
         units_good = qm_table.query(query).index.values
         # in this case, no split/merge is performed, so we can just select the units
         self.curated_analyzer = raw_analyzer.select_units(units_good)
+        self.curation_sorter = sorter
+        self.curation_diff = compute_curation_diff(raw_analyzer.sorting, self.curated_analyzer.sorting)
         print(f'Applied QM-based curation with query "{query}" for {sorter}:\n{self.curated_analyzer.sorting}')
         self.curation_description = f"Automatic curation based on quality metrics.\nQuery: {query}"
 
@@ -281,24 +512,23 @@ class SortingCurator:
         if self.curated_analyzer is None:
             print("No curation was performed.")
             return
-        from pynwb import NWBHDF5IO
-
-        # trick to get rid of Units first
-        with NWBHDF5IO(self.nwb_path_main, mode="r") as read_io:
-            nwbfile_in = read_io.read()
+        from ..nwbutils.nwbappendwriter import NWBAppendWriter, check_nwb_file_closed
+
+        # units tables and analyzers loaded for visualization keep the file open in read-only mode
+        self.close_readers()
+        # the processed recording of the curated analyzer reads from the NWB file, so it is replaced by a timing
+        # recording (which keeps the spike times) before the file is opened in append mode
+        self.curated_analyzer = replace_analyzer_recording(
+            self.curated_analyzer, get_timing_recording(self.curated_analyzer.recording)
+        )
+        # the remaining readers are not owned by the curator (e.g. recordings loaded by the caller)
+        check_nwb_file_closed(self.nwb_path_main)
 
+        with NWBAppendWriter(self.nwb_path_main) as writer:
             # delete main unit table
-            if nwbfile_in.units is not None:
+            if writer.remove("units"):
                 print("Deleting main unit table")
-                nwbfile_in.units.reset_parent()
-                nwbfile_in.fields["units"] = None
-
-            with NWBHDF5IO(self.nwb_path_tmp, mode="w") as export_io:
-                export_io.export(src_io=read_io, nwbfile=nwbfile_in)
-
-        # write new units
-        with NWBHDF5IO(self.nwb_path_tmp, mode="a") as io:
-            nwbfile_out = io.read()
+            nwbfile_out = writer.read()
             print("Adding curated units table")
             add_units_from_sorting_analyzer(
                 sorting_analyzer=self.curated_analyzer,
@@ -306,18 +536,25 @@ class SortingCurator:
                 unit_table_name="units",
                 unit_table_description=self.curation_description,
                 write_in_processing_module=False,
+                dataset_settings=get_units_dataset_settings(self.project),
             )
-            io.write(nwbfile_out)
 
-        self.nwb_path_main.unlink()
-        self.nwb_path_tmp.rename(self.nwb_path_main)
+        if self.curation_diff is not None:
+            curation_log_path = self.si_path / self.curation_sorter / "curation_log.json"
+            write_curation_log(
+                self.curation_diff,
+                curation_log_path,
+                action_id=self.action.id,
+                sorter=self.curation_sorter,
+                description=self.curation_description,
+            )
+            print(f"Curation log saved to {curation_log_path}")
         print("Done saving to NWB")
 
     def remove_tmp_files(self):
         if self.nwb_path_tmp is not None and self.nwb_path_tmp.is_file():
             self.nwb_path_tmp.unlink()
-        if self.io is not None:
-            self.io.close()
+        self.close_readers()
         if self.nwbfile is not None:
             del self.nwbfile
             self.nwbfile = None
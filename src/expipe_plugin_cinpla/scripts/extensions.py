@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import time
+
+import numpy as np
+
+
+def get_extension_list(ms_before=1, ms_after=2, n_components=3):
+    """
+    Returns the analyzer extensions (and their parameters) computed for the raw and curated units.
+
+    Parameters
+    ----------
+    ms_before : float, default: 1
+        The ms before the spike peak for waveforms
+    ms_after : float, default: 2
+        The ms after the spike peak for waveforms
+    n_components : int, default: 3
+        The number of PCA components
+
+    Returns
+    -------
+    extension_list : dict
+        Dictionary with the extension name as key and its parameters as value, in order of dependency
+    """
+    return {
+        "noise_levels": {},
+        "random_spikes": {},
+        "waveforms": {"ms_before": ms_before, "ms_after": ms_after},
+        "templates": {"operators": ["average", "std", "median"]},
+        "spike_amplitudes": {},
+        "unit_locations": {},
+        "correlograms": {},
+        "template_similarity": {},
+        "isi_histograms": {},
+        "principal_components": {"n_components": n_components},
+        "template_metrics": {},
+    }
+
+
+def compute_extensions(
+    sorting_analyzer,
+    extension_list,
+    source_analyzer=None,
+    unit_id_map=None,
+    profiler=None,
+    verbose=False,
+    **job_kwargs,
+):
+    """
+    Computes the missing or stale extensions of a sorting analyzer.
+
+    The extensions are visited in order of dependency. An extension already in the analyzer is reused if it has
+    the same parameters (including the defaults and the parameters inherited from its parents). Otherwise, it is
+    (re)computed, which also deletes the extensions depending on it, so that they are recomputed as well.
+    For example, changing only `n_components` recomputes the principal components, but not the waveforms.
+
+    If a source analyzer of the same recording is given (e.g. the raw analyzer, for a curated sorting), the
+    extensions reading the traces ("noise_levels", "random_spikes", "waveforms" and "spike_amplitudes") are carried
+    over from it for the units with the same spike train, if they have the same parameters and sparsity. Only the
+    spikes of the other units (e.g. merged or split) are then read from the recording. The other extensions are
+    computed from the carried over ones (e.g. the templates from the waveforms), without reading the traces.
+
+    Parameters
+    ----------
+    sorting_analyzer : SortingAnalyzer
+        The sorting analyzer
+    extension_list : dict
+        Dictionary with the extension name as key and its parameters as value (see `get_extension_list`)
+    source_analyzer : SortingAnalyzer, optional
+        The analyzer to carry over the extensions from, with the same recording
+    unit_id_map : dict, optional
+        Dictionary with the unit ids of `sorting_analyzer` as key and the unit ids of `source_analyzer` with the same
+        spike train as value. By default, the units are matched with `match_unchanged_units`
+    profiler : StageProfiler, optional
+        If given, each computed extension is profiled as "postprocess/<extension>"
+    verbose : bool, default: False
+        If True, the reused and computed extensions are printed
+    **job_kwargs : dict
+        Job kwargs for the extensions computed with the chunk executor
+
+    Returns
+    -------
+    plan : dict
+        Dictionary with the extension name as key and "reused", "carried over" or "computed" as value
+    """
+    from spikeinterface.core.sortinganalyzer import _sort_extensions_by_dependency
+
+    if source_analyzer is not None:
+        unit_id_map = _get_carry_over_units(sorting_analyzer, source_analyzer, unit_id_map)
+
+    plan = {}
+    for extension_name, extension_params in _sort_extensions_by_dependency(extension_list).items():
+        if _is_extension_up_to_date(sorting_analyzer, extension_name, extension_params):
+            plan[extension_name] = "reused"
+            continue
+        carry_over = (
+            source_analyzer is not None
+            and extension_name in _carry_over_functions
+            and _is_extension_up_to_date(source_analyzer, extension_name, extension_params)
+        )
+        if carry_over and extension_name in _carry_over_parents:
+            # e.g. the waveforms are only carried over if the random spikes are the same
+            carry_over = plan.get(_carry_over_parents[extension_name]) == "carried over"
+        stage = profiler.stage(f"postprocess/{extension_name}") if profiler is not None else contextlib.nullcontext()
+        with stage:
+            if carry_over:
+                _carry_over_extension(sorting_analyzer, source_analyzer, extension_name, unit_id_map, **job_kwargs)
+            else:
+                sorting_analyzer.compute(extension_name, **extension_params, **job_kwargs)
+        plan[extension_name] = "carried over" if carry_over else "computed"
+
+    if verbose:
+        for status in ("reused", "carried over", "computed"):
+            extension_names = [extension_name for extension_name in plan if plan[extension_name] == status]
+            if len(extension_names) > 0:
+                print(f"\t{status.capitalize()} extensions: {', '.join(extension_names)}")
+    return plan
+
+
+def memmap_extensions(sorting_analyzer, extension_names=("waveforms", "spike_amplitudes", "principal_components")):
+    """
+    Memory-maps the arrays of the (large) per-spike extensions of a "binary_folder" analyzer.
+
+    The extension data are loaded in memory by SpikeInterface. Their arrays are replaced by read-only memory maps
+    of the ".npy" files of the analyzer folder, so that they are only read from disk when accessed. Analyzers in
+    other formats are left unchanged.
+
+    Parameters
+    ----------
+    sorting_analyzer : SortingAnalyzer
+        The sorting analyzer
+    extension_names : tuple, default: ("waveforms", "spike_amplitudes", "principal_components")
+        The extensions to memory-map
+    """
+    if sorting_analyzer.format != "binary_folder":
+        return
+    for extension_name in extension_names:
+        extension = sorting_analyzer.get_extension(extension_name)
+        if extension is None:
+            continue
+        extension_folder = extension._get_binary_extension_folder()
+        for data_name, data in extension.data.items():
+            data_file = extension_folder / f"{data_name}.npy"
+            if isinstance(data, np.ndarray) and not isinstance(data, np.memmap) and data_file.is_file():
+                extension.data[data_name] = np.load(data_file, mmap_mode="r")
+
+
+def _is_extension_up_to_date(sorting_analyzer, extension_name, extension_params):
+    from spikeinterface.core.core_tools import SIJsonEncoder
+    from spikeinterface.core.sortinganalyzer import get_extension_class
+
+    # extensions which did not complete are not loaded
+    extension = sorting_analyzer.get_extension(extension_name)
+    if extension is None:
+        return False
+    # the full parameters of a new extension, with the defaults and the ones inherited from the parents
+    new_extension = get_extension_class(extension_name)(sorting_analyzer)
+    new_params = new_extension._set_params(**extension_params)
+    return json.dumps(extension.params, cls=SIJsonEncoder, sort_keys=True) == json.dumps(
+        new_params, cls=SIJsonEncoder, sort_keys=True
+    )
+
+
+def _get_carry_over_units(sorting_analyzer, source_analyzer, unit_id_map=None):
+    from .utils import match_unchanged_units
+
+    if (
+        sorting_analyzer.sampling_frequency != source_analyzer.sampling_frequency
+        or sorting_analyzer.get_total_samples() != source_analyzer.get_total_samples()
+        or sorting_analyzer.return_scaled != source_analyzer.return_scaled
+        or not np.array_equal(sorting_analyzer.channel_ids, source_analyzer.channel_ids)
+    ):
+        return {}
+    if unit_id_map is None:
+        unit_id_map = match_unchanged_units(sorting_analyzer.sorting, source_analyzer.sorting)
+
+    # the waveforms of a unit are carried over only if they are on the same channels
+    carry_over_units = {}
+    for unit_id, source_unit_id in unit_id_map.items():
+        if sorting_analyzer.sparsity is None and source_analyzer.sparsity is None:
+            carry_over_units[unit_id] = source_unit_id
+        elif sorting_analyzer.sparsity is not None and source_analyzer.sparsity is not None:
+            mask = sorting_analyzer.sparsity.mask[sorting_analyzer.sorting.id_to_index(unit_id)]
+            source_mask = source_analyzer.sparsity.mask[source_analyzer.sorting.id_to_index(source_unit_id)]
+            if np.array_equal(mask, source_mask):
+                carry_over_units[unit_id] = source_unit_id
+    return carry_over_units
+
+
+def _carry_over_extension(sorting_analyzer, source_analyzer, extension_name, unit_id_map, **job_kwargs):
+    from spikeinterface.core.sortinganalyzer import (
+        _get_children_dependencies,
+        get_extension_class,
+    )
+
+    for child in _get_children_dependencies(extension_name):
+        if sorting_analyzer.has_extension(child):
+            sorting_analyzer.delete_extension(child)
+    if sorting_analyzer.has_extension(extension_name):
+        sorting_analyzer.delete_extension(extension_name)
+
+    source_extension = source_analyzer.get_extension(extension_name)
+    extension = get_extension_class(extension_name)(sorting_analyzer)
+    extension.params = source_extension.params.copy()
+    t_start = time.perf_counter()
+    extension.data = _carry_over_functions[extension_name](extension, source_extension, unit_id_map, **job_kwargs)
+    extension.run_info = dict(run_completed=True, runtime_s=time.perf_counter() - t_start)
+    extension.save()
+    sorting_analyzer.extensions[extension_name] = extension
+
+
+def _map_spikes(sorting_analyzer, source_analyzer, unit_id_map):
+    # returns the spike vector indices of the carried over units in the analyzer and in the source analyzer
+    from .utils import get_unit_spike_indices
+
+    unit_spike_indices = get_unit_spike_indices(sorting_analyzer.sorting)
+    source_unit_spike_indices = get_unit_spike_indices(source_analyzer.sorting)
+    if len(unit_id_map) == 0:
+        return np.array([], dtype="int64"), np.array([], dtype="int64")
+    spike_indices = np.concatenate([unit_spike_indices[unit_id] for unit_id in unit_id_map])
+    source_spike_indices = np.concatenate(
+        [source_unit_spike_indices[source_unit_id] for source_unit_id in unit_id_map.values()]
+    )
+    return spike_indices, source_spike_indices
+
+
+def _get_new_spike_mask(sorting_analyzer, unit_id_map):
+    # the spikes of the units which are not carried over
+    spikes = sorting_analyzer.sorting.to_spike_vector()
+    carried_over_unit_indices = sorting_analyzer.sorting.ids_to_indices(list(unit_id_map))
+    return ~np.isin(spikes["unit_index"], carried_over_unit_indices)
+
+
+def _carry_over_noise_levels(extension, source_extension, unit_id_map, **job_kwargs):
+    # the noise levels only depend on the recording
+    return dict(noise_levels=source_extension.data["noise_levels"].copy())
+
+
+def _carry_over_random_spikes(extension, source_extension, unit_id_map, **job_kwargs):
+    from spikeinterface.core.sorting_tools import random_spikes_selection
+
+    sorting_analyzer = extension.sorting_analyzer
+    spike_indices, source_spike_indices = _map_spikes(sorting_analyzer, source_extension.sorting_analyzer, unit_id_map)
+    source_selected = np.zeros(source_extension.sorting_analyzer.sorting.to_spike_vector().size, dtype=bool)
+    source_selected[source_extension.data["random_spikes_indices"]] = True
+    selected = np.zeros(sorting_analyzer.sorting.to_spike_vector().size, dtype=bool)
+    selected[spike_indices] = source_selected[source_spike_indices]
+
+    # the other units have a new selection
+    new_spike_mask = _get_new_spike_mask(sorting_analyzer, unit_id_map)
+    if np.any(new_spike_mask):
+        random_spikes_indices = random_spikes_selection(
+            sorting_analyzer.sorting, num_samples=sorting_analyzer.rec_attributes["num_samples"], **extension.params
+        )
+        selected[random_spikes_indices[new_spike_mask[random_spikes_indices]]] = True
+    return dict(random_spikes_indices=np.flatnonzero(selected))
+
+
+def _carry_over_waveforms(extension, source_extension, unit_id_map, **job_kwargs):
+    from spikeinterface.core.waveform_tools import extract_waveforms_to_single_buffer
+
+    sorting_analyzer = extension.sorting_analyzer
+    source_analyzer = source_extension.sorting_analyzer
+    spike_indices, source_spike_indices = _map_spikes(sorting_analyzer, source_analyzer, unit_id_map)
+    source_random_spikes_indices = source_analyzer.get_extension("random_spikes").data["random_spikes_indices"]
+    random_spikes_indices = sorting_analyzer.get_extension("random_spikes").data["random_spikes_indices"]
+
+    # the index of the source spike of each random spike (-1 for the new ones)
+    spikes_to_source_spikes = np.full(sorting_analyzer.sorting.to_spike_vector().size, -1, dtype="int64")
+    spikes_to_source_spikes[spike_indices] = source_spike_indices
+    random_source_spikes = spikes_to_source_spikes[random_spikes_indices]
+    source_rows = np.searchsorted(source_random_spikes_indices, random_source_spikes)
+    source_rows = np.minimum(source_rows, len(source_random_spikes_indices) - 1)
+    carried_over = (random_source_spikes >= 0) & (source_random_spikes_indices[source_rows] == random_source_spikes)
+
+    source_waveforms = source_extension.data["waveforms"]
+    if sorting_analyzer.sparsity is None:
+        num_channels = sorting_analyzer.get_num_channels()
+    else:
+        num_channels = sorting_analyzer.sparsity.max_num_active_channels
+    waveforms = np.zeros(
+        (len(random_spikes_indices), extension.nbefore + extension.nafter, num_channels),
+        dtype=extension.params["dtype"],
+    )
+    # the sparse waveforms of the units with the same channels only differ by the zero padding
+    num_source_channels = min(num_channels, source_waveforms.shape[2])
+    waveforms[carried_over, :, :num_source_channels] = source_waveforms[
+        source_rows[carried_over], :, :num_source_channels
+    ]
+    if not np.all(carried_over):
+        spikes = sorting_analyzer.sorting.to_spike_vector()
+        waveforms[~carried_over] = extract_waveforms_to_single_buffer(
+            sorting_analyzer.recording,
+            spikes[random_spikes_indices[~carried_over]],
+            sorting_analyzer.unit_ids,
+            extension.nbefore,
+            extension.nafter,
+            mode="shared_memory",
+            return_scaled=sorting_analyzer.return_scaled,
+            dtype=extension.params["dtype"],
+            sparsity_mask=None if sorting_analyzer.sparsity is None else sorting_analyzer.sparsity.mask,
+            copy=True,
+            job_name="compute_waveforms",
+            **job_kwargs,
+        )
+    return dict(waveforms=waveforms)
+
+
+def _carry_over_spike_amplitudes(extension, source_extension, unit_id_map, **job_kwargs):
+    sorting_analyzer = extension.sorting_analyzer
+    spike_indices, source_spike_indices = _map_spikes(sorting_analyzer, source_extension.sorting_analyzer, unit_id_map)
+    source_amplitudes = source_extension.data["amplitudes"]
+    amplitudes = np.zeros(sorting_analyzer.sorting.to_spike_vector().size, dtype=source_amplitudes.dtype)
+    amplitudes[spike_indices] = source_amplitudes[source_spike_indices]
+
+    # the amplitudes of the other units are computed on an analyzer with only these units
+    new_spike_mask = _get_new_spike_mask(sorting_analyzer, unit_id_map)
+    if np.any(new_spike_mask):
+        new_unit_ids = [unit_id for unit_id in sorting_analyzer.unit_ids if unit_id not in unit_id_map]
+        new_units_analyzer = sorting_analyzer.select_units(new_unit_ids)
+        new_amplitudes = new_units_analyzer.compute("spike_amplitudes", **extension.params, **job_kwargs)
+        amplitudes[new_spike_mask] = new_amplitudes.data["amplitudes"]
+    return dict(amplitudes=amplitudes)
+
+
+# the extensions which read the traces, with the functions carrying them over to the unchanged units
+_carry_over_functions = {
+    "noise_levels": _carry_over_noise_levels,
+    "random_spikes": _carry_over_random_spikes,
+    "waveforms": _carry_over_waveforms,
+    "spike_amplitudes": _carry_over_spike_amplitudes,
+}
+# the extension which must be carried over too (the spike amplitudes depend on the templates from the waveforms)
+_carry_over_parents = {
+    "waveforms": "random_spikes",
+    "spike_amplitudes": "waveforms",
+}
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import json
+import mmap
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+
+def save_fused(source, outputs, margin_ms=200.0, verbose=False, **job_kwargs):
+    """
+    Saves several preprocessed recordings derived from the same source recording (e.g. highpass, LFP and MUA
+    chains of the raw data) to binary or zarr folders, reading each chunk of the source only once.
+
+    The outputs are computed chunk by chunk on the time base of the source: each chunk of the source (with a
+    margin for the filters and resampling of the chains) is read once into a cache, and all outputs compute the
+    corresponding frames from the cache. The saved folders are the same as the ones of `recording.save(folder=...)`
+    (binary) and `recording.save(format="zarr", folder=...)` (zarr). The zarr chunks span one chunk of the executor
+    in time and one channel group (see `storage.get_channel_chunk_size`), so that each chunk is written by a single
+    worker and both time-sliced and channel-sliced reads only decompress the chunks they need.
+
+    Parameters
+    ----------
+    source : BaseRecording
+        The source recording (e.g. the raw recording read from the NWB file)
+    outputs : dict
+        Dictionary with the output name as key and a dictionary with "recording" (the preprocessing chain,
+        built on `source`), "folder" and, optionally, "dtype", "format" ("binary" or "zarr", default: "binary"),
+        "compressor" (zarr compressor, default: `storage.get_zarr_compressor()`) and "channel_chunk_size" (zarr
+        channels per chunk, default: `storage.get_channel_chunk_size(recording)`) as value. Zarr outputs must have
+        the sampling frequency of the source
+    margin_ms : float, default: 200.0
+        The margin in ms read around each chunk. It should be larger than the sum of the margins of the
+        preprocessing steps of the chains (e.g. 100 ms for resample + 5 ms for filters), otherwise the
+        frames outside the margin are read again from the source
+    verbose : bool, default: False
+        If True, the progress is printed
+    **job_kwargs : dict
+        Job kwargs for the chunk executor (n_jobs, chunk_duration, ...). By default, the global job kwargs
+
+    Returns
+    -------
+    saved : dict
+        Dictionary with the output name as key and the saved BinaryFolderRecording or ZarrRecordingExtractor as
+        value
+    """
+    from spikeinterface.core import get_global_job_kwargs
+    from spikeinterface.core.job_tools import (
+        ChunkRecordingExecutor,
+        ensure_chunk_size,
+        fix_job_kwargs,
+    )
+
+    from .cachedtracesrecording import CachedTracesRecording, clear_cache
+    from .storage import get_channel_chunk_size, get_zarr_compressor
+
+    job_kwargs = fix_job_kwargs({**get_global_job_kwargs(), **job_kwargs})
+    chunk_size = ensure_chunk_size(source, **job_kwargs)
+
+    # the chains are rebuilt in the workers on top of a cached version of the source
+    cached_source = CachedTracesRecording(source, cache_key=uuid.uuid4().hex)
+    source_str = _to_json_str(source.to_dict(recursive=True))
+    cached_source_dict = cached_source.to_dict(recursive=True)
+    fused_dicts = {}
+    file_paths = {}
+    dtypes = {}
+    formats = {}
+    for name, output in outputs.items():
+        recording = output["recording"]
+        assert recording.get_num_segments() == source.get_num_segments(), "Outputs must have the same segments"
+        chain_dict = recording.to_dict(recursive=True)
+        fused_dict, found = _replace_source(chain_dict, source_str, cached_source_dict)
+        assert found, f"The recording of output '{name}' is not derived from the source recording"
+        fused_dicts[name] = fused_dict
+        dtypes[name] = np.dtype(output.get("dtype") or recording.get_dtype())
+        formats[name] = output.get("format", "binary")
+        assert formats[name] in ("binary", "zarr"), f"The format of output '{name}' can be either 'binary' or 'zarr'"
+
+        folder = Path(output["folder"])
+        if folder.is_dir():
+            shutil.rmtree(folder)
+        if formats[name] == "zarr":
+            # the chunks of the executor must match the zarr chunks, which are then written by a single worker
+            assert (
+                recording.sampling_frequency == source.sampling_frequency
+            ), f"The zarr output '{name}' must have the sampling frequency of the source"
+            channel_chunk_size = output.get("channel_chunk_size", get_channel_chunk_size(recording))
+            compressor = output.get("compressor", get_zarr_compressor())
+            _create_zarr_datasets(recording, folder, dtypes[name], chunk_size, channel_chunk_size, compressor)
+            file_paths[name] = str(folder)
+            continue
+        folder.mkdir(parents=True)
+        file_paths[name] = [folder / f"traces_cached_seg{i}.raw" for i in range(recording.get_num_segments())]
+        for segment_index, file_path in enumerate(file_paths[name]):
+            num_bytes = recording.get_num_samples(segment_index) * recording.get_num_channels() * dtypes[name].itemsize
+            with open(file_path, "wb") as f:
+                if num_bytes > 0:
+                    f.seek(num_bytes - 1)
+                    f.write(b"\0")
+
+    margin = int(margin_ms * source.sampling_frequency / 1000)
+    init_args = (cached_source_dict, fused_dicts, file_paths, dtypes, formats, margin)
+    executor = ChunkRecordingExecutor(
+        source,
+        _write_fused_chunk,
+        _init_fused_worker,
+        init_args,
+        job_name="fused preprocessing",
+        verbose=verbose,
+        **job_kwargs,
+    )
+    executor.run()
+    clear_cache(cached_source_dict["kwargs"]["cache_key"])
+
+    saved = {}
+    for name, output in outputs.items():
+        if formats[name] == "zarr":
+            saved[name] = _write_zarr_metadata(output["recording"], output["folder"])
+        else:
+            saved[name] = _write_binary_folder_metadata(
+                output["recording"], output["folder"], file_paths[name], dtypes[name]
+            )
+    return saved
+
+
+def scale_to_int16(recording, chunk_duration_s=10.0):
+    """
+    Scales a recording to int16 with the finest resolution which does not clip its traces.
+
+    The gain of each channel (in uV per bit) is the maximum absolute value of its scaled traces divided by the
+    int16 maximum, so the rounding error is at most half a gain. The traces are read once to compute the maximum,
+    so it is meant for small recordings (e.g. LFP and MUA at 1 kHz).
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording. If it is already int16, it is returned as is
+    chunk_duration_s : float, default: 10.0
+        The duration of the chunks read to compute the maximum
+
+    Returns
+    -------
+    recording_int16 : BaseRecording
+        The int16 recording, with the channel gains in uV and offsets of 0
+    """
+    import spikeinterface.preprocessing as spre
+
+    if recording.get_dtype() == np.int16:
+        return recording
+    return_scaled = recording.has_scaleable_traces()
+    if return_scaled:
+        gains, offsets = recording.get_channel_gains(), recording.get_channel_offsets()
+    else:
+        # traces without gains are assumed to be in uV
+        gains, offsets = np.ones(recording.get_num_channels()), np.zeros(recording.get_num_channels())
+
+    max_abs = np.zeros(recording.get_num_channels())
+    chunk_size = int(chunk_duration_s * recording.sampling_frequency)
+    for segment_index in range(recording.get_num_segments()):
+        num_samples = recording.get_num_samples(segment_index)
+        for start_frame in range(0, num_samples, chunk_size):
+            traces = recording.get_traces(
+                segment_index=segment_index,
+                start_frame=start_frame,
+                end_frame=min(start_frame + chunk_size, num_samples),
+                return_scaled=return_scaled,
+            )
+            max_abs = np.maximum(max_abs, np.max(np.abs(traces), axis=0))
+    # flat channels get a gain of 1 uV
+    gains_int16 = np.where(max_abs > 0, max_abs / np.iinfo(np.int16).max, 1.0)
+    recording_int16 = spre.scale(recording, gain=gains / gains_int16, offset=offsets / gains_int16, dtype="int16")
+    recording_int16.set_channel_gains(gains_int16)
+    recording_int16.set_channel_offsets(0)
+    return recording_int16
+
+
+def _init_fused_worker(cached_source_dict, fused_dicts, file_paths, dtypes, formats, margin):
+    import zarr
+    from spikeinterface.core import load_extractor
+
+    worker_ctx = {}
+    worker_ctx["cached_source"] = load_extractor(cached_source_dict)
+    worker_ctx["recordings"] = {name: load_extractor(fused_dict) for name, fused_dict in fused_dicts.items()}
+    worker_ctx["files"] = {}
+    for name, paths in file_paths.items():
+        if formats[name] == "zarr":
+            zarr_root = zarr.open(paths, mode="r+")
+            num_segments = worker_ctx["recordings"][name].get_num_segments()
+            worker_ctx["files"][name] = {i: zarr_root[f"traces_seg{i}"] for i in range(num_segments)}
+        else:
+            worker_ctx["files"][name] = {i: open(file_path, "r+b") for i, file_path in enumerate(paths)}
+    worker_ctx["dtypes"] = dtypes
+    worker_ctx["formats"] = formats
+    worker_ctx["margin"] = margin
+    return worker_ctx
+
+
+def _write_fused_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    cached_source = worker_ctx["cached_source"]
+    margin = worker_ctx["margin"]
+    num_source_samples = cached_source.get_num_samples(segment_index)
+    cached_source.fill_cache(segment_index, start_frame - margin, end_frame + margin)
+
+    for name, recording in worker_ctx["recordings"].items():
+        # frames of the output corresponding to the chunk (outputs can be resampled)
+        num_samples = recording.get_num_samples(segment_index)
+        ratio = recording.sampling_frequency / cached_source.sampling_frequency
+        output_start = min(int(start_frame * ratio), num_samples)
+        output_end = num_samples if end_frame == num_source_samples else min(int(end_frame * ratio), num_samples)
+        if output_end <= output_start:
+            continue
+        traces = recording.get_traces(start_frame=output_start, end_frame=output_end, segment_index=segment_index)
+        dtype = worker_ctx["dtypes"][name]
+        if worker_ctx["formats"][name] == "zarr":
+            worker_ctx["files"][name][segment_index][output_start:output_end] = traces.astype(dtype, copy=False)
+        else:
+            _write_traces(worker_ctx["files"][name][segment_index], traces, output_start, dtype)
+
+
+def _write_traces(file, traces, start_frame, dtype):
+    num_channels = traces.shape[1]
+    start_byte = start_frame * num_channels * dtype.itemsize
+    end_byte = (start_frame + traces.shape[0]) * num_channels * dtype.itemsize
+    # the mmap offset must be a multiple of mmap.ALLOCATIONGRANULARITY
+    memmap_offset, start_offset = divmod(start_byte, mmap.ALLOCATIONGRANULARITY)
+    memmap_offset *= mmap.ALLOCATIONGRANULARITY
+    length = end_byte - start_byte + start_offset
+    memmap_obj = mmap.mmap(file.fileno(), length=length, access=mmap.ACCESS_WRITE, offset=memmap_offset)
+    memmap_array = np.ndarray(shape=traces.shape, dtype=dtype, buffer=memmap_obj, offset=start_offset)
+    memmap_array[:] = traces.astype(dtype, copy=False)
+    memmap_obj.flush()
+    memmap_obj.close()
+
+
+def _write_binary_folder_metadata(recording, folder, file_paths, dtype):
+    """Writes the same metadata files as `recording.save(folder=folder)` for traces already written to file_paths"""
+    from spikeinterface.core import BinaryFolderRecording, BinaryRecordingExtractor
+
+    folder = Path(folder)
+    if recording.check_serializability("json"):
+        recording.dump_to_json(file_path=folder / "provenance.json", relative_to=folder)
+    recording.save_metadata_to_folder(folder)
+    binary_recording = BinaryRecordingExtractor(
+        file_paths=file_paths,
+        sampling_frequency=recording.get_sampling_frequency(),
+        num_channels=recording.get_num_channels(),
+        dtype=dtype,
+        t_starts=_get_t_starts(recording),
+        channel_ids=recording.get_channel_ids(),
+        time_axis=0,
+        file_offset=0,
+        is_filtered=recording.is_filtered(),
+        gain_to_uV=recording.get_channel_gains(),
+        offset_to_uV=recording.get_channel_offsets(),
+    )
+    binary_recording.dump(folder / "binary.json", relative_to=folder)
+    saved = BinaryFolderRecording(folder_path=folder)
+    recording.copy_metadata(saved)
+    for segment_index in range(recording.get_num_segments()):
+        if recording.has_time_vector(segment_index):
+            saved.set_times(recording.get_times(segment_index=segment_index), segment_index=segment_index)
+    saved.dump_to_json(file_path=folder / "si_folder.json", relative_to=folder)
+    return saved
+
+
+def _get_t_starts(recording):
+    """Returns the start time of each segment, or None if none is set (as `recording.save`)"""
+    t_starts = [recording.get_time_info(segment_index=i)["t_start"] for i in range(recording.get_num_segments())]
+    return None if all(t_start is None for t_start in t_starts) else t_starts
+
+
+def _create_zarr_datasets(recording, folder, dtype, chunk_size, channel_chunk_size, compressor):
+    """Creates the (empty) zarr traces datasets of `recording.save(format="zarr", folder=folder)`"""
+    import zarr
+
+    zarr_root = zarr.open(str(folder), mode="w")
+    for segment_index in range(recording.get_num_segments()):
+        zarr_root.create_dataset(
+            name=f"traces_seg{segment_index}",
+            shape=(recording.get_num_samples(segment_index), recording.get_num_channels()),
+            chunks=(chunk_size, channel_chunk_size),
+            dtype=dtype,
+            compressor=compressor,
+        )
+
+
+def _write_zarr_metadata(recording, folder):
+    """Writes the same metadata as `recording.save(format="zarr", folder=folder)` for traces already written"""
+    import zarr
+    from spikeinterface.core import read_zarr
+    from spikeinterface.core.core_tools import check_json
+    from spikeinterface.core.zarrextractors import add_properties_and_annotations
+
+    zarr_root = zarr.open(str(folder), mode="r+")
+    if recording.check_serializability("json"):
+        zarr_root.attrs["provenance"] = check_json(recording.to_dict(recursive=True))
+    else:
+        zarr_root.attrs["provenance"] = None
+    zarr_root.attrs["sampling_frequency"] = float(recording.get_sampling_frequency())
+    zarr_root.attrs["num_segments"] = int(recording.get_num_segments())
+    zarr_root.create_dataset(name="channel_ids", data=recording.get_channel_ids(), compressor=None)
+    if recording.get_property("contact_vector") is not None:
+        zarr_root.attrs["probe"] = check_json(recording.get_probegroup().to_dict(array_as_list=True))
+    for segment_index in range(recording.get_num_segments()):
+        if recording.has_time_vector(segment_index):
+            zarr_root.create_dataset(
+                name=f"times_seg{segment_index}", data=recording.get_times(segment_index=segment_index)
+            )
+    t_starts = _get_t_starts(recording)
+    if t_starts is not None:
+        t_starts = np.array([np.nan if t_start is None else t_start for t_start in t_starts], dtype="float64")
+        zarr_root.create_dataset(name="t_starts", data=t_starts, compressor=None)
+    add_properties_and_annotations(zarr_root, recording)
+    saved = read_zarr(folder)
+    # properties with object dtype are not saved to zarr, but they are kept in the returned recording
+    recording.copy_metadata(saved)
+    return saved
+
+
+def _replace_source(dictionary, source_str, replacement):
+    """Replaces the (nested) dictionary of the source extractor in an extractor dictionary"""
+    if _to_json_str(dictionary) == source_str:
+        return replacement, True
+    found = False
+    new_kwargs = {}
+    for key, value in dictionary["kwargs"].items():
+        if isinstance(value, dict) and "class" in value and "kwargs" in value:
+            value, found_in_value = _replace_source(value, source_str, replacement)
+            found = found or found_in_value
+        elif isinstance(value, list):
+            new_value = []
+            for v in value:
+                if isinstance(v, dict) and "class" in v and "kwargs" in v:
+                    v, found_in_value = _replace_source(v, source_str, replacement)
+                    found = found or found_in_value
+                new_value.append(v)
+            value = new_value
+        new_kwargs[key] = value
+    return {**dictionary, "kwargs": new_kwargs}, found
+
+
+def _to_json_str(dictionary):
+    from spikeinterface.core.core_tools import SIJsonEncoder
+
+    return json.dumps(dictionary, cls=SIJsonEncoder, sort_keys=True)
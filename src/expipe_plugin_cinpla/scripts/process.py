@@ -4,6 +4,7 @@ import json
 import os
 import shutil
 import time
+from pathlib import Path
 
 import numpy as np
 
@@ -29,8 +30,109 @@ def process_ecephys(
     overwrite=False,
     singularity_image=None,
     n_components=3,
+    resume=True,
+    keep_intermediates=False,
+    preprocessed_cache="binary",
+    storage_format=None,
+    sorting_n_workers=None,
+    sorting_max_memory=None,
+    n_jobs=None,
+    disk_semaphore=None,
     verbose=True,
 ):
+    """
+    Preprocesses, spike sorts and postprocesses the raw data of an action and writes the outputs to its NWB file.
+
+    The processing runs in stages (preprocess, lfp, mua, cache, sort, analyzer, postprocess, qc, phy, nwb). Each
+    completed stage is checkpointed in `spikeinterface/<sorter>/checkpoints.json` with a hash of its inputs and
+    parameters, so that a rerun after a failure (or with changed downstream parameters) skips the stages that are
+    still valid.
+    When the units are unchanged, the existing analyzer is reused and only its missing or stale extensions are
+    computed (e.g. changing only `n_components` recomputes the principal components, but not the waveforms).
+    The wall time, CPU time, peak memory and I/O of the stages computed by the last run (including each analyzer
+    extension) are recorded in `spikeinterface/<sorter>/profile.json` (see `profiling.collect_profiles`).
+
+    Parameters
+    ----------
+    project : expipe.Project
+        The expipe project
+    action_id : str
+        The action ID
+    sorter : str
+        The spike sorter name
+    spikesort : bool, default: True
+        Whether to spike sort
+    compute_lfp : bool, default: True
+        Whether to compute and save the LFP. The LFP and MUA are written with the chunking, compression and dtype of
+        the "ecephys_dataset_settings" of the project config (see `storage.get_ecephys_dataset_settings`)
+    compute_mua : bool, default: False
+        Whether to compute and save the MUA
+    spikesorter_params : dict, optional
+        The spike sorter parameters
+    bad_channel_ids : list, optional
+        The bad channel ids to remove. If it contains "auto", bad channels are detected automatically
+    reference : "cmr" | "car", optional
+        The common reference to apply
+    split : "all" | "half" | list, optional
+        How to split the channels for the common reference
+    spikesort_by_group : bool, default: True
+        Whether to spike sort each channel group separately
+    bad_threshold : float, default: 2
+        The threshold for the automatic bad channel detection
+    ms_before : float, default: 1
+        The ms before the spike peak for waveforms
+    ms_after : float, default: 2
+        The ms after the spike peak for waveforms
+    metric_names : list, optional
+        The quality metrics to compute
+    overwrite : bool, default: False
+        Whether to overwrite the processed data already in the NWB file. If True, the NWB stage is run even if it
+        is up to date
+    singularity_image : str or bool, optional
+        The singularity image to run the spike sorter in
+    n_components : int, default: 3
+        The number of PCA components. Units with less spikes than `n_components` are removed
+    resume : bool, default: True
+        If True, completed stages with unchanged inputs and parameters are skipped.
+        If False, all previous outputs are removed and all stages are recomputed
+    keep_intermediates : bool, default: False
+        If True, the intermediate outputs of the preprocessing (the preprocessed cache and the LFP/MUA) are kept
+        after writing to NWB, so that a rerun with changed downstream parameters does not repeat the preprocessing.
+        By default, they are removed (their checkpoints are then stale, so they are recomputed if needed)
+    preprocessed_cache : "binary" | "lazy", default: "binary"
+        How the preprocessed (filtered and referenced) recording is provided to the sorter, the analyzer and phy.
+        With "binary", it is saved once to a scratch binary folder, which is shared by all of them (the phy
+        `recording.dat` is a hard link to it). With "lazy", nothing is saved and the preprocessing is recomputed
+        from the raw data by each of them, which saves disk space and I/O at the cost of CPU (sorters which need a
+        binary input still write their own copy, and phy gets its own `recording.dat`)
+    storage_format : "binary" | "zarr", optional
+        The storage format of the analyzer and of the preprocessed cache. With "zarr", they are saved as chunked
+        and compressed zarr folders (`analyzer.zarr` and `recording_cmr.zarr`), with chunks of one second and one
+        channel group, and phy gets its own `recording.dat`. By default, the "storage_format" of the project config,
+        or "binary" (see `storage.get_storage_format`)
+    sorting_n_workers : int, optional
+        The number of groups sorted in parallel when `spikesort_by_group` is True. By default, 1: the groups are
+        sorted sequentially in the current process. The wall time and peak memory of each group are reported in
+        `spikeinterface/<sorter>/sorting_report.json`. With more than one worker, the groups are sorted in "spawn"
+        subprocesses, so when called from a script, the call must be guarded by ``if __name__ == "__main__":``
+    sorting_max_memory : int or str, optional
+        The maximum memory of each sorting worker, in bytes or as a string (e.g. "8G")
+    n_jobs : int, optional
+        The number of jobs used by spikeinterface. If None, the number of CPUs allocated by SLURM is used
+        (if available), otherwise all CPUs
+    disk_semaphore : multiprocessing.Semaphore, optional
+        If given, the disk-heavy stages (saving the preprocessed data, exporting to phy and writing to NWB) are run
+        while holding the semaphore, to limit the number of concurrent disk-heavy stages when processing
+        several actions in parallel (see `process_many`)
+    verbose : bool, default: True
+        If True, the progress is printed
+
+    Returns
+    -------
+    success : bool
+        False if writing to the NWB file failed (the intermediate outputs are kept, so that a rerun resumes from
+        the NWB writing)
+    """
     import warnings
 
     import spikeinterface as si
@@ -40,96 +142,58 @@ def process_ecephys(
     import spikeinterface.preprocessing as spre
     import spikeinterface.qualitymetrics as sqm
     import spikeinterface.sorters as ss
-    from neuroconv.tools.spikeinterface import add_recording
-    from pynwb import NWBHDF5IO
     from spikeinterface.core.core_tools import SIJsonEncoder
 
-    from .utils import add_units_from_sorting_analyzer, compute_and_set_unit_groups
+    from ..nwbutils.nwbappendwriter import NWBAppendWriter
+    from .checkpoints import StageCheckpoints, compute_key, get_acquisition_key
+    from .extensions import compute_extensions, get_extension_list
+    from .preprocessing import save_fused
+    from .profiling import StageProfiler
+    from .sorting import run_sorter_by_group
+    from .storage import (
+        get_analyzer_folder,
+        get_analyzer_format,
+        get_ecephys_dataset_settings,
+        get_storage_format,
+        get_units_dataset_settings,
+        get_zarr_compressor,
+    )
+    from .utils import (
+        add_processed_recording,
+        add_units_from_sorting_analyzer,
+        check_sortings_equal,
+        compute_and_set_unit_groups,
+        get_timing_recording,
+        replace_analyzer_recording,
+    )
 
     warnings.filterwarnings("ignore")
 
     t_start = time.time()
 
+    assert preprocessed_cache in ("binary", "lazy"), "'preprocessed_cache' can be either 'binary' or 'lazy'"
+    storage_format = get_storage_format(project, storage_format)
+    ecephys_dataset_settings = get_ecephys_dataset_settings(project)
     action = project.actions[action_id]
     nwb_path = utils._get_data_path(action)
-    nwb_path_tmp = nwb_path.parent / "main_tmp.nwb"
+    si_folder = nwb_path.parent / "spikeinterface"
+    output_base_folder = si_folder / sorter
+    processed_tmp_folder = output_base_folder / "processed_tmp"
+    recording_cmr_folder = output_base_folder / ("recording_cmr.zarr" if storage_format == "zarr" else "recording_cmr")
+    preprocessed_file = output_base_folder / "preprocessed.json"
 
-    # clean up tmp NWB file in case of crash
-    if nwb_path_tmp.is_file():
-        nwb_path_tmp.unlink()
+    # clean up tmp files in case of crash
+    for tmp_file in (nwb_path.parent / "main_tmp.nwb", nwb_path.parent / "main2_tmp.nwb"):
+        if tmp_file.is_file():
+            tmp_file.unlink()
+    if not resume and output_base_folder.is_dir():
+        shutil.rmtree(output_base_folder)
 
     # We need to use the number of allocated CPUs, if available
-    n_jobs = int(os.environ.get("SLURM_CPUS_ON_NODE", -1))
-    print("N JOBS", n_jobs)
+    if n_jobs is None:
+        n_jobs = int(os.environ.get("SLURM_CPUS_ON_NODE", -1))
     si.set_global_job_kwargs(n_jobs=n_jobs, progress_bar=False)
-
-    if overwrite:
-        if verbose:
-            print("\nCleaning up existing NWB file")
-        # trick to get rid of open synchronous files issue
-        nwb_path2 = nwb_path.parent / "main2_tmp.nwb"
-        shutil.copy(nwb_path, nwb_path2)
-
-        # export NWB file and skip: processed timeseries, units
-        with NWBHDF5IO(nwb_path2, "r") as read_io:
-            nwbfile = read_io.read()
-            # delete main unit table
-            if nwbfile.units is not None:
-                if verbose:
-                    print("Deleting main unit table")
-                nwbfile.units.reset_parent()
-                nwbfile.fields["units"] = None
-            # remove processed timeseries
-            if "ecephys" in nwbfile.processing:
-                for data_interface in nwbfile.processing["ecephys"].data_interfaces.copy():
-                    if compute_lfp and "LFP" in data_interface:
-                        if verbose:
-                            print(f"\tRemoving {data_interface}")
-                        di = nwbfile.processing["ecephys"].data_interfaces.pop(data_interface)
-                        di.reset_parent()
-                        for child in di.children:
-                            child.reset_parent()
-                    if compute_mua and "Processed" in data_interface:
-                        if verbose:
-                            print(f"\tRemoving {data_interface}")
-                        di = nwbfile.processing["ecephys"].data_interfaces.pop(data_interface)
-                        di.reset_parent()
-                        for child in di.children:
-                            child.reset_parent()
-                    if spikesort and sorter in data_interface:
-                        if verbose:
-                            print(f"\tRemoving {data_interface}")
-                        di = nwbfile.processing["ecephys"].data_interfaces.pop(data_interface)
-                        di.reset_parent()
-                        for child in di.children:
-                            child.reset_parent()
-
-            with NWBHDF5IO(nwb_path_tmp, "w") as export_io:
-                export_io.export(src_io=read_io, nwbfile=nwbfile)
-        nwb_path2.unlink()
-    else:
-        shutil.copy(nwb_path, nwb_path_tmp)
-
-    recording = se.read_nwb_recording(nwb_path_tmp, electrical_series_path="acquisition/ElectricalSeries")
-
-    auto_detection = False
-    if bad_channel_ids is not None:
-        if "auto" not in bad_channel_ids and len(bad_channel_ids) > 0:
-            recording_active = recording.remove_channels(bad_channel_ids)
-        else:
-            auto_detection = True
-            recording_active = recording
-    else:
-        recording_active = recording
-
-    # apply filtering and cmr
-    if verbose:
-        duration = np.round(recording.get_total_duration(), 2)
-        print(f"\nPreprocessing recording:\n\tNum channels: {recording.get_num_channels()}\n\tDuration: {duration} s")
-    si_folder = nwb_path.parent / "spikeinterface"
-    output_base_folder = si_folder / sorter
-    if output_base_folder.is_dir():
-        shutil.rmtree(output_base_folder)
+    disk_context = disk_semaphore if disk_semaphore is not None else contextlib.nullcontext()
 
     freq_min_hp = 300
     freq_max_hp = 3000
@@ -139,177 +203,377 @@ def process_ecephys(
     freq_resample_mua = 1000
     order_hp = 5
 
-    recording_bp = spre.bandpass_filter(
-        recording_active, freq_min=freq_min_hp, freq_max=freq_max_hp, filter_order=order_hp
+    if spikesorter_params is None:
+        spikesorter_params = {}
+    extension_list = get_extension_list(ms_before=ms_before, ms_after=ms_after, n_components=n_components)
+
+    # each stage key depends on the key of the stage it uses, so that changes propagate downstream. The spike
+    # preprocessing (bad channels, reference and highpass filter) is shared by all the outputs: the LFP and MUA only
+    # feed the NWB stage, and the cache of the preprocessed recording does not change the sorting and the analyzer
+    checkpoints = StageCheckpoints(output_base_folder, resume=resume)
+    stage_keys = {}
+    stage_keys["preprocess"] = compute_key(
+        "preprocess",
+        acquisition=get_acquisition_key(nwb_path),
+        bad_channel_ids=bad_channel_ids,
+        reference=reference,
+        split=split,
+        bad_threshold=bad_threshold,
+        highpass=[freq_min_hp, freq_max_hp, order_hp],
+    )
+    if compute_lfp:
+        stage_keys["lfp"] = compute_key(
+            "lfp", stage_keys["preprocess"], lfp=[freq_min_lfp, freq_max_lfp, freq_resample_lfp]
+        )
+    if compute_mua:
+        stage_keys["mua"] = compute_key("mua", stage_keys["preprocess"], mua=freq_resample_mua)
+    if spikesort:
+        if preprocessed_cache == "binary":
+            stage_keys["cache"] = compute_key("cache", stage_keys["preprocess"], storage_format=storage_format)
+        stage_keys["sort"] = compute_key(
+            "sort",
+            stage_keys["preprocess"],
+            sorter=sorter,
+            spikesorter_params=spikesorter_params,
+            spikesort_by_group=spikesort_by_group,
+        )
+        # the analyzer is reused by the following runs as long as the units and the preprocessing are unchanged
+        stage_keys["analyzer"] = compute_key("analyzer", stage_keys["preprocess"], storage_format=storage_format)
+        stage_keys["postprocess"] = compute_key(
+            "postprocess", stage_keys["sort"], n_components=n_components, extension_list=extension_list
+        )
+        stage_keys["qc"] = compute_key("qc", stage_keys["postprocess"], metric_names=metric_names)
+        stage_keys["phy"] = compute_key("phy", stage_keys["qc"])
+    stage_keys["nwb"] = compute_key(
+        "nwb",
+        [stage_keys.get(stage) for stage in ("phy", "lfp", "mua")],
+        sorter=sorter,
+        units_dataset_settings=get_units_dataset_settings(project) if spikesort else None,
+        ecephys_dataset_settings=ecephys_dataset_settings if compute_lfp or compute_mua else None,
     )
 
-    if reference is not None:
-        if reference.lower() == "cmr":
-            reference = "median"
-        elif reference.lower() == "car":
-            reference = "average"
-        else:
-            raise Exception("'reference' can be either 'cmr' or 'car'")
-        if split == "all":
-            recording_cmr = spre.common_reference(recording_bp, operator=reference)
-        elif split == "half":
-            num_half = recording.get_num_channels() // 2
-            groups = [
-                recording.channel_ids[:num_half],
-                recording.channel_ids[num_half:],
-            ]
-            recording_cmr = spre.common_reference(recording_bp, groups=groups, operator=reference)
-        else:
-            if isinstance(split, list):
-                recording_cmr = spre.common_reference(recording_bp, groups=split, operator=reference)
+    # with overwrite, the processed data are written to the NWB file again, even if they are up to date
+    if not overwrite and checkpoints.is_done("nwb", stage_keys["nwb"]):
+        if verbose:
+            print(f"All processing stages of {action_id} are already completed. Use resume=False to reprocess.")
+        return True
+
+    profiler = StageProfiler(output_base_folder, action_id=action_id, sorter=sorter, n_jobs=n_jobs)
+    recording_lfp = None
+    recording_mua = None
+    recording_cmr = None
+    # the outputs of the preprocessing which are not up to date are computed in a single pass over the raw data
+    compute_outputs = dict(
+        lfp=compute_lfp and not checkpoints.is_done("lfp", stage_keys["lfp"]),
+        mua=compute_mua and not checkpoints.is_done("mua", stage_keys["mua"]),
+        cmr=spikesort and preprocessed_cache == "binary" and not checkpoints.is_done("cache", stage_keys["cache"]),
+    )
+    if checkpoints.is_done("preprocess", stage_keys["preprocess"]) and not any(compute_outputs.values()):
+        if verbose:
+            print("\nPreprocessing: loading checkpoint")
+        if spikesort:
+            if preprocessed_cache == "binary":
+                recording_cmr = si.load_extractor(recording_cmr_folder)
             else:
-                raise Exception("'split' must be a list of lists")
+                recording_cmr = si.load_extractor(json.loads(preprocessed_file.read_text()))
+        if compute_lfp:
+            recording_lfp = si.load_extractor(processed_tmp_folder / "lfp")
+        if compute_mua:
+            recording_mua = si.load_extractor(processed_tmp_folder / "mua")
     else:
-        recording_cmr = recording
+        with profiler.stage("preprocess"):
+            # the raw acquisition is read directly from the main NWB file (read-only) and never copied
+            recording = se.read_nwb_recording(nwb_path, electrical_series_path="acquisition/ElectricalSeries")
+
+            auto_detection = False
+            if bad_channel_ids is not None:
+                if "auto" not in bad_channel_ids and len(bad_channel_ids) > 0:
+                    recording_active = recording.remove_channels(bad_channel_ids)
+                else:
+                    auto_detection = True
+                    recording_active = recording
+            else:
+                recording_active = recording
 
-    if auto_detection:
-        bad_channel_ids, _ = spre.detect_bad_channels(recording_cmr, method="std", std_mad_threshold=bad_threshold)
-        if len(bad_channel_ids) > 0:
+            # apply filtering and cmr
             if verbose:
-                print(f"\tDetected bad channels: {bad_channel_ids}")
-            recording_cmr = recording_cmr.remove_channels(bad_channel_ids)
-            recording_active = recording.channel_slice(channel_ids=recording_cmr.channel_ids)
+                duration = np.round(recording.get_total_duration(), 2)
+                print(
+                    f"\nPreprocessing recording:\n\tNum channels: {recording.get_num_channels()}"
+                    f"\n\tDuration: {duration} s"
+                )
 
-    if verbose:
-        print(f"\tActive channels: {len(recording_active.channel_ids)}")
+            recording_bp = spre.bandpass_filter(
+                recording_active, freq_min=freq_min_hp, freq_max=freq_max_hp, filter_order=order_hp
+            )
 
-    if compute_lfp:
-        recording_lfp = spre.bandpass_filter(recording_active, freq_min=freq_min_lfp, freq_max=freq_max_lfp)
-        recording_lfp = spre.resample(recording_lfp, freq_resample_lfp)
-        # make sure to not override the electrodes table
-        recording_lfp.set_property("group_name", [f"tetrode{gr}" for gr in recording_lfp.get_channel_groups()])
-    if compute_mua:
-        recording_mua = spre.resample(spre.rectify(recording_active), freq_resample_mua)
-        # make sure to not override the electrodes table
-        recording_mua.set_property("group_name", [f"tetrode{gr}" for gr in recording_lfp.get_channel_groups()])
+            if reference is not None:
+                if reference.lower() == "cmr":
+                    reference = "median"
+                elif reference.lower() == "car":
+                    reference = "average"
+                else:
+                    raise Exception("'reference' can be either 'cmr' or 'car'")
+                if split == "all":
+                    recording_cmr = spre.common_reference(recording_bp, operator=reference)
+                elif split == "half":
+                    num_half = recording.get_num_channels() // 2
+                    groups = [
+                        recording.channel_ids[:num_half],
+                        recording.channel_ids[num_half:],
+                    ]
+                    recording_cmr = spre.common_reference(recording_bp, groups=groups, operator=reference)
+                else:
+                    if isinstance(split, list):
+                        recording_cmr = spre.common_reference(recording_bp, groups=split, operator=reference)
+                    else:
+                        raise Exception("'split' must be a list of lists")
+            else:
+                recording_cmr = recording
 
-    if spikesort:
-        if verbose:
-            print("\tSaving preprocessed recording")
-        recording_cmr = recording_cmr.save(folder=output_base_folder / "recording_cmr", overwrite=True, verbose=False)
+            if auto_detection:
+                bad_channel_ids, _ = spre.detect_bad_channels(
+                    recording_cmr, method="std", std_mad_threshold=bad_threshold
+                )
+                if len(bad_channel_ids) > 0:
+                    if verbose:
+                        print(f"\tDetected bad channels: {bad_channel_ids}")
+                    recording_cmr = recording_cmr.remove_channels(bad_channel_ids)
+                    recording_active = recording.channel_slice(channel_ids=recording_cmr.channel_ids)
 
-        if spikesorter_params is None:
-            spikesorter_params = {}
-        output_folder = output_base_folder / "spikesorting"
-        try:
-            # save in data/processing
-            if singularity_image:
+            if verbose:
+                print(f"\tActive channels: {len(recording_active.channel_ids)}")
+
+            output_base_folder.mkdir(parents=True, exist_ok=True)
+            preprocessed_file.write_text(json.dumps(recording_cmr.to_dict(recursive=True), cls=SIJsonEncoder))
+            checkpoints.mark_done("preprocess", stage_keys["preprocess"], outputs=[preprocessed_file.name])
+
+            # LFP and MUA are small (downsampled), so they are saved to a sidecar folder and appended to the NWB file
+            # at the end: the NWB file cannot be opened in append mode while the raw data is being read from it.
+            # All outputs are computed in a single pass over the raw data (each chunk is read once from the NWB file),
+            # and the outputs which are up to date are loaded from their checkpoint
+            outputs = {}
+            if compute_lfp:
+                if compute_outputs["lfp"]:
+                    recording_lfp = spre.bandpass_filter(recording_active, freq_min=freq_min_lfp, freq_max=freq_max_lfp)
+                    recording_lfp = spre.resample(recording_lfp, freq_resample_lfp)
+                    outputs["lfp"] = dict(recording=recording_lfp, folder=processed_tmp_folder / "lfp")
+                else:
+                    recording_lfp = si.load_extractor(processed_tmp_folder / "lfp")
+            if compute_mua:
+                if compute_outputs["mua"]:
+                    recording_mua = spre.resample(spre.rectify(recording_active), freq_resample_mua)
+                    outputs["mua"] = dict(recording=recording_mua, folder=processed_tmp_folder / "mua")
+                else:
+                    recording_mua = si.load_extractor(processed_tmp_folder / "mua")
+            if spikesort and preprocessed_cache == "binary":
+                if compute_outputs["cmr"]:
+                    outputs["cmr"] = dict(recording=recording_cmr, folder=recording_cmr_folder, format=storage_format)
+                else:
+                    recording_cmr = si.load_extractor(recording_cmr_folder)
+            if len(outputs) > 0:
                 if verbose:
-                    print(f"\nSpike sorting with {sorter} using Singularity")
-                # the redirect stdout doesn't work nicely with singularity
-                context = contextlib.nullcontext()
-            else:
+                    print(f"\tSaving {', '.join(outputs)}")
+                with disk_context:
+                    saved = save_fused(recording, outputs)
+                recording_lfp = saved.get("lfp", recording_lfp)
+                recording_mua = saved.get("mua", recording_mua)
+                recording_cmr = saved.get("cmr", recording_cmr)
+                for name in outputs:
+                    stage = "cache" if name == "cmr" else name
+                    output_folder = outputs[name]["folder"].relative_to(output_base_folder)
+                    checkpoints.mark_done(stage, stage_keys[stage], outputs=[str(output_folder)])
+
+        # release the lazy recordings reading from the NWB file (with a lazy cache, recording_cmr is released before
+        # writing to NWB), so that it can be opened in append mode
+        recording = recording_active = recording_bp = outputs = None
+
+    if spikesort:
+        sorting_folder = output_base_folder / "sorting"
+        if checkpoints.is_done("sort", stage_keys["sort"]):
+            if verbose:
+                print(f"\nSpike sorting with {sorter}: loading checkpoint")
+            sorting = si.load_extractor(sorting_folder)
+        else:
+            with profiler.stage("sort"):
+                output_folder = output_base_folder / "spikesorting"
+                try:
+                    # save in data/processing
+                    if singularity_image:
+                        if verbose:
+                            print(f"\nSpike sorting with {sorter} using Singularity")
+                        # the redirect stdout doesn't work nicely with singularity
+                        context = contextlib.nullcontext()
+                    else:
+                        if verbose:
+                            print(f"\nSpike sorting with {sorter} using installed sorter")
+                        context = contextlib.redirect_stdout(None)
+
+                    if spikesort_by_group:
+                        sorting, _ = run_sorter_by_group(
+                            sorter,
+                            recording_cmr,
+                            folder=output_folder,
+                            n_workers=sorting_n_workers,
+                            max_memory=sorting_max_memory,
+                            n_jobs=n_jobs,
+                            report_path=output_base_folder / "sorting_report.json",
+                            singularity_image=singularity_image,
+                            verbose=verbose,
+                            **spikesorter_params,
+                        )
+                    else:
+                        with context:
+                            sorting = ss.run_sorter(
+                                sorter,
+                                recording_cmr,
+                                folder=output_folder,
+                                verbose=False,
+                                delete_output_folder=True,
+                                remove_existing_folder=True,
+                                singularity_image=singularity_image,
+                                **spikesorter_params,
+                            )
+                except Exception as e:
+                    raise Exception(f"Spike sorting failed:\n\n{e}")
                 if verbose:
-                    print(f"\nSpike sorting with {sorter} using installed sorter")
-                context = contextlib.redirect_stdout(None)
+                    print(f"\tFound {len(sorting.get_unit_ids())} units!")
 
-            with context:
-                if spikesort_by_group:
-                    sorting = ss.run_sorter_by_property(
-                        sorter,
-                        recording_cmr,
-                        folder=output_folder,
-                        grouping_property="group",
-                        verbose=False,
-                        delete_output_folder=True,
-                        remove_existing_folder=True,
-                        singularity_image=singularity_image,
-                        **spikesorter_params,
-                    )
-                else:
-                    sorting = ss.run_sorter(
-                        sorter,
-                        recording_cmr,
-                        folder=output_folder,
-                        verbose=False,
-                        delete_output_folder=True,
-                        remove_existing_folder=True,
-                        singularity_image=singularity_image,
-                        **spikesorter_params,
-                    )
-        except Exception as e:
-            raise Exception(f"Spike sorting failed:\n\n{e}")
-        if verbose:
-            print(f"\tFound {len(sorting.get_unit_ids())} units!")
+                # remove excess spikes from KS, which sometimes finds spikes beyond the recording duration
+                sorting = sc.remove_excess_spikes(sorting, recording=recording_cmr)
+
+                # if not sort by group, extract dense and estimate group
+                if "group" not in sorting.get_property_keys():
+                    compute_and_set_unit_groups(sorting, recording_cmr)
 
-        # remove excess spikes from KS, which sometimes finds spikes beyond the recording duration
-        sorting = sc.remove_excess_spikes(sorting, recording=recording_cmr)
+                sorting = sorting.save(folder=sorting_folder, overwrite=True, verbose=False)
+                checkpoints.mark_done("sort", stage_keys["sort"], outputs=[sorting_folder.name])
 
-        # remove units with less than n_components spikes
+        # remove units with less than n_components spikes (after the checkpoint, so that changing n_components
+        # does not require sorting again)
         num_spikes = sorting.count_num_spikes_per_unit()
         selected_units = sorting.unit_ids[np.array(list(num_spikes.values())) >= n_components]
         n_too_few_spikes = int(len(sorting.unit_ids) - len(selected_units))
-        print(f"\tRemoved {n_too_few_spikes} units with less than {n_components} spikes")
+        if verbose:
+            print(f"\tRemoved {n_too_few_spikes} units with less than {n_components} spikes")
         sorting = sorting.select_units(selected_units)
 
         # extract waveforms
         if verbose:
             print("\nPostprocessing")
-        # if not sort by group, extract dense and estimate group
-        if "group" not in sorting.get_property_keys():
-            compute_and_set_unit_groups(sorting, recording_cmr)
-
-        sparsity_temp_folder = si_folder / "tmp"
-        if sparsity_temp_folder.is_dir():
-            shutil.rmtree(sparsity_temp_folder)
-
-        sorting_analyzer = si.create_sorting_analyzer(
-            sorting,
-            recording_cmr,
-            format="binary_folder",
-            folder=output_base_folder / "analyzer",
-            overwrite=True,
-            sparse=True,
-            method="by_property",
-            by_property="group",
-        )
+        analyzer_folder = get_analyzer_folder(output_base_folder, storage_format)
+        if checkpoints.is_done("postprocess", stage_keys["postprocess"]):
+            if verbose:
+                print("\tLoading checkpoint")
+            sorting_analyzer = si.load_sorting_analyzer(analyzer_folder)
+            if not sorting_analyzer.has_recording():
+                sorting_analyzer.set_temporary_recording(recording_cmr)
+        else:
+            # the extensions of the existing analyzer are reused if the units are unchanged
+            sorting_analyzer = None
+            if checkpoints.is_done("analyzer", stage_keys["analyzer"]):
+                try:
+                    sorting_analyzer = si.load_sorting_analyzer(analyzer_folder)
+                except Exception:
+                    sorting_analyzer = None
+                if sorting_analyzer is not None and check_sortings_equal(sorting_analyzer.sorting, sorting):
+                    if verbose:
+                        print("\tReusing existing analyzer")
+                    sorting_analyzer.set_temporary_recording(recording_cmr)
+                else:
+                    sorting_analyzer = None
+            if sorting_analyzer is None:
+                # an analyzer saved with another storage format is replaced
+                existing_analyzer_folder = get_analyzer_folder(output_base_folder)
+                if existing_analyzer_folder is not None and existing_analyzer_folder != analyzer_folder:
+                    shutil.rmtree(existing_analyzer_folder)
+                with profiler.stage("postprocess/analyzer"):
+                    sorting_analyzer = si.create_sorting_analyzer(
+                        sorting,
+                        recording_cmr,
+                        format=get_analyzer_format(storage_format),
+                        folder=analyzer_folder,
+                        overwrite=True,
+                        sparse=True,
+                        method="by_property",
+                        by_property="group",
+                        backend_options=(
+                            dict(saving_options=dict(compressor=get_zarr_compressor()))
+                            if storage_format == "zarr"
+                            else None
+                        ),
+                    )
+                checkpoints.mark_done("analyzer", stage_keys["analyzer"], outputs=[analyzer_folder.name])
 
-        if verbose:
-            print("\tComputing extensions")
-        extension_list = {
-            "noise_levels": {},
-            "random_spikes": {},
-            "waveforms": {"ms_before": ms_before, "ms_after": ms_after},
-            "templates": {"operators": ["average", "std", "median"]},
-            "spike_amplitudes": {},
-            "unit_locations": {},
-            "correlograms": {},
-            "template_similarity": {},
-            "isi_histograms": {},
-            "principal_components": {"n_components": n_components},
-            "template_metrics": {},
-        }
-        sorting_analyzer.compute(extension_list, n_jobs=-1, progress_bar=False)
-        if verbose:
-            print("\tComputing QC metrics")
-        _ = sqm.compute_quality_metrics(sorting_analyzer, metric_names=metric_names)
+            if verbose:
+                print("\tComputing extensions")
+            # only missing or stale extensions are computed, each of them is profiled
+            compute_extensions(
+                sorting_analyzer, extension_list, profiler=profiler, verbose=verbose, n_jobs=n_jobs, progress_bar=False
+            )
+            checkpoints.mark_done("postprocess", stage_keys["postprocess"], outputs=[analyzer_folder.name])
+
+        if not checkpoints.is_done("qc", stage_keys["qc"]):
+            if verbose:
+                print("\tComputing QC metrics")
+            with profiler.stage("qc"):
+                _ = sqm.compute_quality_metrics(sorting_analyzer, metric_names=metric_names)
+            checkpoints.mark_done(
+                "qc", stage_keys["qc"], outputs=[f"{analyzer_folder.name}/extensions/quality_metrics"]
+            )
+
+        if not checkpoints.is_done("phy", stage_keys["phy"]):
+            if verbose:
+                print("\tExporting to phy")
+            with profiler.stage("phy"):
+                phy_folder = output_base_folder / "phy"
+                phy_restore_folder = output_base_folder / "phy_restore"
+                for folder in (phy_folder, phy_restore_folder):
+                    if folder.is_dir():
+                        shutil.rmtree(folder)
+                # the scratch binary of the preprocessed recording is reused as recording.dat (not written again),
+                # phy needs an uncompressed recording.dat, so it is written from the zarr cache
+                cmr_binary_file = recording_cmr_folder / "traces_cached_seg0.raw"
+                link_binary = (
+                    preprocessed_cache == "binary" and storage_format == "binary" and cmr_binary_file.is_file()
+                )
+                with disk_context:
+                    sexp.export_to_phy(
+                        sorting_analyzer,
+                        output_folder=phy_folder,
+                        copy_binary=not link_binary,
+                        use_relative_path=not link_binary,
+                        verbose=False,
+                    )
+                    if link_binary:
+                        utils.link_phy_recording(phy_folder, cmr_binary_file, dtype=recording_cmr.get_dtype())
+                # generate files to be used with restore
+                utils.generate_phy_restore_files(phy_folder)
+                checkpoints.mark_done("phy", stage_keys["phy"], outputs=[phy_folder.name, phy_restore_folder.name])
 
-        if verbose:
-            print("\tExporting to phy")
-        phy_folder = output_base_folder / "phy"
-        if phy_folder.is_dir():
-            shutil.rmtree(phy_folder)
-        sexp.export_to_phy(
-            sorting_analyzer,
-            output_folder=phy_folder,
-            copy_binary=True,
-            use_relative_path=True,
-            verbose=False,
-        )
-        # generate files to be used with restore
-        utils.generate_phy_restore_files(phy_folder)
+    provenance_str = preprocessed_file.read_text()
+
+    # the NWB file can only be opened in append mode once all its readers are released: the analyzer (whose recording
+    # can read from the NWB file) is replaced by an analyzer with a timing recording, which keeps the spike times
+    if spikesort:
+        sorting_analyzer = replace_analyzer_recording(sorting_analyzer, get_timing_recording(recording_cmr))
+    recording_cmr = sorting = None
 
     if verbose:
         print("\nWriting to NWB")
-    nwb_path.unlink()
     try:
-        with NWBHDF5IO(nwb_path_tmp, mode="r") as read_io:
-            nwbfile_out = read_io.read()
+        with disk_context, profiler.stage("nwb"), NWBAppendWriter(nwb_path) as writer:
+            if overwrite:
+                if verbose:
+                    print("\tRemoving existing processed data")
+                _remove_processed_containers(
+                    writer,
+                    sorter=sorter if spikesort else None,
+                    remove_lfp=compute_lfp,
+                    remove_mua=compute_mua,
+                    verbose=verbose,
+                )
+            nwbfile_out = writer.read()
             if spikesort:
                 if verbose:
                     print("\tAdding units table")
@@ -320,6 +584,7 @@ def process_ecephys(
                     unit_table_name=f"RawUnits-{sorter}",
                     unit_table_description=f"Raw units from {sorter} output",
                     write_in_processing_module=True,
+                    dataset_settings=get_units_dataset_settings(project),
                 )
             metadata_ecephys = {}
             # assign existing device
@@ -333,7 +598,13 @@ def process_ecephys(
                 if verbose:
                     print("\tAdding LFP")
                 recording_lfp.set_property("group_name", recording_lfp.get_channel_groups())
-                add_recording(recording_lfp, nwbfile=nwbfile_out, write_as="lfp", metadata=metadata_ecephys)
+                add_processed_recording(
+                    recording_lfp,
+                    nwbfile=nwbfile_out,
+                    write_as="lfp",
+                    metadata=metadata_ecephys,
+                    dataset_settings=ecephys_dataset_settings,
+                )
             if compute_mua:
                 if verbose:
                     print("\tAdding MUA")
@@ -343,61 +614,228 @@ def process_ecephys(
                     "description": "Rectified signal representing Multi-Unit Activity",
                 }
                 recording_mua.set_property("group_name", recording_mua.get_channel_groups())
-                add_recording(
+                add_processed_recording(
                     recording_mua,
                     nwbfile=nwbfile_out,
                     write_as="processed",
                     metadata=metadata_ecephys,
                     es_key="ElectricalSeriesMUA",
+                    dataset_settings=ecephys_dataset_settings,
                 )
-
-            with NWBHDF5IO(nwb_path, mode="w") as export_io:
-                export_io.export(src_io=read_io, nwbfile=nwbfile_out)
+        checkpoints.mark_done("nwb", stage_keys["nwb"])
     except Exception as e:
-        # restore NWB file
+        # intermediate outputs are kept, so that a rerun only repeats the NWB writing
         if verbose:
-            print(f"Error exporting to NWB: {e}")
-        if nwb_path.is_file():
-            nwb_path.unlink()
-        shutil.copy(nwb_path_tmp, nwb_path)
+            print(f"Error writing to NWB: {e}")
+        return False
 
     # clean up
     if verbose:
         print("Cleaning up")
-    provenance_file = output_base_folder / "recording_cmr" / "provenance.json"
-    if not provenance_file.is_file():
-        (output_base_folder / "recording_cmr").mkdir(parents=True, exist_ok=True)
-        provenance = recording_cmr.to_dict(recursive=True)
-        provenance_str = json.dumps(provenance, cls=SIJsonEncoder)
-        provenance_str = provenance_str.replace("main_tmp.nwb", "main.nwb")
-    else:
-        with open(output_base_folder / "recording_cmr" / "provenance.json") as f:
-            provenance = json.load(f)
-        provenance_str = json.dumps(provenance)
-        provenance_str = provenance_str.replace("../../../main_tmp.nwb", str(nwb_path))
-        provenance_str = provenance_str.replace('"relative_paths": true', '"relative_paths": false')
-    preprocessed_file = output_base_folder / "preprocessed.json"
-    preprocessed_file.write_text(provenance_str)
 
-    if spikesort:
-        # update analyzer path
-        analyer_recording_str = provenance_str.replace(
-            str(nwb_path), os.path.relpath(nwb_path, str(output_base_folder / "analyzer"))
-        )
-        analyzer_recording_json = output_base_folder / "analyzer" / "recording.json"
+    if spikesort and storage_format == "binary":
+        # update analyzer path (the zarr analyzer keeps the recording in its attributes, it is replaced by the
+        # preprocessed recording of the NWB file when loaded for curation)
+        analyer_recording_str = provenance_str.replace(str(nwb_path), os.path.relpath(nwb_path, str(analyzer_folder)))
+        analyzer_recording_json = analyzer_folder / "recording.json"
         analyzer_recording_json.write_text(analyer_recording_str)
 
-    if (output_base_folder / "recording_cmr").is_dir():
-        shutil.rmtree(output_base_folder / "recording_cmr")
-    try:
-        nwb_path_tmp.unlink()
-    except Exception as e:
-        print(f"Could not remove: {nwb_path_tmp}")
-        raise e
+    sorting_analyzer = recording_cmr = recording_lfp = recording_mua = None
+    # the binary cache shares its data with the phy recording.dat (hard link), which is kept
+    if not keep_intermediates:
+        if recording_cmr_folder.is_dir():
+            shutil.rmtree(recording_cmr_folder)
+        if processed_tmp_folder.is_dir():
+            shutil.rmtree(processed_tmp_folder)
 
     if verbose:
         print("\tSaved to NWB: ", nwb_path)
         print(f"Total processing time: {np.round(time.time() - t_start)}s")
+    return True
+
+
+def process_many(
+    project,
+    action_ids,
+    sorter,
+    n_workers=None,
+    n_jobs=None,
+    max_disk_jobs=1,
+    report_path=None,
+    verbose=True,
+    **process_kwargs,
+):
+    """
+    Processes several actions with `process_ecephys` in parallel on a local pool of processes.
+
+    The CPU budget (`n_jobs`) is split between the concurrent actions: each of the `n_workers` actions runs
+    with `n_jobs // n_workers` jobs. The disk-heavy stages (saving the preprocessed data, exporting to phy and
+    writing to NWB) of at most `max_disk_jobs` actions run at the same time.
+    A status/timing report of each action is written to `report_path` (JSON) as soon as the action is done.
+    The output of each action is written to a log file next to the report.
+
+    The actions are processed in "spawn" subprocesses, so when called from a script, the call must be guarded
+    by ``if __name__ == "__main__":``.
+
+    Parameters
+    ----------
+    project : expipe.Project
+        The expipe project
+    action_ids : list
+        The action IDs to process
+    sorter : str
+        The spike sorter name
+    n_workers : int, optional
+        The number of actions to process concurrently. By default, one action for each 4 CPUs
+    n_jobs : int, optional
+        The total number of CPUs to use. By default, the CPUs allocated by SLURM (if available), otherwise all CPUs
+    max_disk_jobs : int, default: 1
+        The maximum number of concurrent disk-heavy stages
+    report_path : str or Path, optional
+        The path of the JSON report. By default, `processing-reports/ecephys-<sorter>-<timestamp>.json` in the
+        project folder
+    verbose : bool, default: True
+        If True, the progress is printed
+    **process_kwargs : dict
+        Keyword arguments for `process_ecephys`
+
+    Returns
+    -------
+    report : dict
+        The status and timing of each action
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from datetime import datetime
+
+    action_ids = list(action_ids)
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = int(os.environ.get("SLURM_CPUS_ON_NODE", os.cpu_count()))
+    if n_workers is None:
+        n_workers = max(1, n_jobs // 4)
+    n_workers = max(1, min(n_workers, len(action_ids), n_jobs))
+    n_jobs_per_action = max(1, n_jobs // n_workers)
+
+    if report_path is None:
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        report_path = project.path / "processing-reports" / f"ecephys-{sorter}-{timestamp}.json"
+    report_path = Path(report_path)
+    log_folder = report_path.parent / report_path.stem
+    log_folder.mkdir(parents=True, exist_ok=True)
+
+    report = dict(
+        sorter=sorter,
+        n_workers=n_workers,
+        n_jobs_per_action=n_jobs_per_action,
+        max_disk_jobs=max_disk_jobs,
+        process_kwargs=process_kwargs,
+        actions={action_id: dict(status="pending") for action_id in action_ids},
+    )
+    _write_report(report, report_path)
+    if verbose:
+        print(
+            f"Processing {len(action_ids)} actions with {n_workers} workers "
+            f"({n_jobs_per_action} jobs per action)\n\tReport: {report_path}"
+        )
+
+    context = multiprocessing.get_context("spawn")
+    disk_semaphore = context.Semaphore(max_disk_jobs)
+    t_start = time.time()
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=context,
+        initializer=_init_process_worker,
+        initargs=(disk_semaphore,),
+    ) as executor:
+        futures = {}
+        for action_id in action_ids:
+            future = executor.submit(
+                _process_action,
+                project.path,
+                action_id,
+                sorter,
+                n_jobs_per_action,
+                log_folder / f"{action_id}.log",
+                process_kwargs,
+            )
+            futures[future] = action_id
+            report["actions"][action_id]["status"] = "queued"
+        for future in as_completed(futures):
+            action_id = futures[future]
+            try:
+                report["actions"][action_id] = future.result()
+            except Exception as e:
+                # e.g. a worker killed by the OS
+                report["actions"][action_id] = dict(status="failed", error=f"{type(e).__name__}: {e}")
+            _write_report(report, report_path)
+            if verbose:
+                action_report = report["actions"][action_id]
+                duration = action_report.get("duration")
+                duration_str = f" in {np.round(duration)}s" if duration is not None else ""
+                print(f"\t{action_id}: {action_report['status']}{duration_str}")
+
+    report["duration"] = time.time() - t_start
+    _write_report(report, report_path)
+    if verbose:
+        statuses = [action_report["status"] for action_report in report["actions"].values()]
+        print(
+            f"Processed {statuses.count('completed')}/{len(action_ids)} actions "
+            f"in {np.round(report['duration'])}s ({statuses.count('failed')} failed)"
+        )
+    return report
+
+
+_disk_semaphore = None
+
+
+def _init_process_worker(disk_semaphore):
+    global _disk_semaphore
+    _disk_semaphore = disk_semaphore
+
+
+def _process_action(project_path, action_id, sorter, n_jobs, log_file, process_kwargs):
+    import traceback
+    from datetime import datetime
+
+    import expipe
+
+    action_report = dict(
+        status="running",
+        start=datetime.now().isoformat(timespec="seconds"),
+        n_jobs=n_jobs,
+        pid=os.getpid(),
+        log=str(log_file),
+    )
+    t_start = time.time()
+    with open(log_file, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            project = expipe.get_project(project_path)
+            success = process_ecephys(
+                project,
+                action_id,
+                sorter,
+                n_jobs=n_jobs,
+                disk_semaphore=_disk_semaphore,
+                **process_kwargs,
+            )
+            if success:
+                action_report["status"] = "completed"
+            else:
+                action_report["status"] = "failed"
+                action_report["error"] = "Error writing to NWB"
+        except Exception as e:
+            traceback.print_exc()
+            action_report["status"] = "failed"
+            action_report["error"] = f"{type(e).__name__}: {e}"
+    action_report["end"] = datetime.now().isoformat(timespec="seconds")
+    action_report["duration"] = time.time() - t_start
+    return action_report
+
+
+def _write_report(report, report_path):
+    report_tmp = report_path.with_suffix(".tmp")
+    report_tmp.write_text(json.dumps(report, indent=4, default=str))
+    report_tmp.replace(report_path)
 
 
 def clean_up(project, action_id, sorter):
@@ -413,3 +851,34 @@ def clean_up(project, action_id, sorter):
         shutil.rmtree(sorter_folder)
     if len([p for p in si_folder.iterdir()]) == 0:
         shutil.rmtree(si_folder)
+
+
+def _remove_processed_containers(writer, sorter=None, remove_lfp=True, remove_mua=True, verbose=True):
+    """
+    Removes the main units table and the processed containers that are about to be re-written from the NWB file
+    (the raw acquisition is not touched).
+
+    Parameters
+    ----------
+    writer : NWBAppendWriter
+        The writer of the NWB file
+    sorter : str, optional
+        If given, the processed data interfaces of this sorter (e.g. RawUnits-{sorter}) are removed
+    remove_lfp : bool, default: True
+        Whether to remove the LFP data interfaces
+    remove_mua : bool, default: True
+        Whether to remove the processed (MUA) data interfaces
+    verbose : bool, default: True
+        If True, the removed containers are printed
+    """
+    if writer.remove("units") and verbose:
+        print("\tDeleting main unit table")
+    for data_interface in writer.keys("processing/ecephys"):
+        if (
+            (remove_lfp and "LFP" in data_interface)
+            or (remove_mua and "Processed" in data_interface)
+            or (sorter is not None and sorter in data_interface)
+        ):
+            if verbose:
+                print(f"\tRemoving {data_interface}")
+            writer.remove(f"processing/ecephys/{data_interface}")
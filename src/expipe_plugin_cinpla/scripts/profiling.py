@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, peak memory (RSS) and I/O of the stages of a processing pipeline.
+
+    The profile of each stage is appended to ``profile.json`` in the output folder as soon as the stage is done,
+    so that the profile of a failed run is kept up to the failing stage. Profiles of several actions can be
+    aggregated with `collect_profiles`.
+
+    The CPU time includes the child processes which have terminated during the stage (e.g. the pools of the
+    chunk executors). The peak RSS is the one of the main process during the stage (on Linux; on other platforms,
+    the peak of the process up to the end of the stage) and the largest peak of the terminated child processes.
+    The I/O (Linux only) are the bytes read and written by the main process and its child processes (the running
+    ones and the terminated ones, whose I/O is added to the main process when they are reaped), in total
+    (`read_chars` and `write_chars`, including the page cache) and from/to the storage (`read_bytes` and
+    `write_bytes`).
+
+    Parameters
+    ----------
+    folder : str or Path
+        The output folder of the pipeline (e.g. ``spikeinterface/<sorter>``)
+    **info : dict
+        Information about the run stored in the profile (e.g. action_id, sorter)
+    """
+
+    file_name = "profile.json"
+
+    def __init__(self, folder, **info):
+        self.folder = Path(folder)
+        self.profile_file = self.folder / self.file_name
+        self.profile = dict(
+            **info,
+            host=os.uname().nodename if hasattr(os, "uname") else None,
+            start=datetime.now().isoformat(timespec="seconds"),
+            stages=[],
+        )
+        self._t_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager profiling a stage.
+
+        Parameters
+        ----------
+        name : str
+            The stage name (e.g. "sort" or "postprocess/waveforms")
+        """
+        _reset_peak_rss()
+        times_start = os.times()
+        io_start = _get_io_counters()
+        t_start = time.perf_counter()
+        status = "failed"
+        try:
+            yield
+            status = "completed"
+        finally:
+            wall_time = time.perf_counter() - t_start
+            times_end = os.times()
+            io_end = _get_io_counters()
+            stage_profile = dict(
+                name=name,
+                status=status,
+                wall_time=wall_time,
+                cpu_time=(times_end.user - times_start.user) + (times_end.system - times_start.system),
+                children_cpu_time=(times_end.children_user - times_start.children_user)
+                + (times_end.children_system - times_start.children_system),
+                peak_rss_mb=_get_peak_rss_mb(),
+                children_peak_rss_mb=_get_peak_rss_mb(children=True),
+            )
+            for key in io_end:
+                stage_profile[key] = io_end[key] - io_start[key]
+            self.profile["stages"].append(stage_profile)
+            self.profile["wall_time"] = time.perf_counter() - self._t_start
+            self._write()
+
+    def _write(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        profile_tmp = self.profile_file.with_suffix(".tmp")
+        profile_tmp.write_text(json.dumps(self.profile, indent=4, default=str))
+        profile_tmp.replace(self.profile_file)
+
+
+def collect_profiles(project, sorter=None, action_ids=None, output_path=None):
+    """
+    Aggregates the stage profiles (see `StageProfiler`) of the actions of a project in a table.
+
+    Parameters
+    ----------
+    project : expipe.Project
+        The expipe project
+    sorter : str, optional
+        If given, only the profiles of this sorter are collected
+    action_ids : list, optional
+        The actions to collect. By default, all actions
+    output_path : str or Path, optional
+        If given, the table is saved to this path, as Parquet (".parquet", requires pyarrow) or CSV (any other
+        suffix)
+
+    Returns
+    -------
+    profiles : pandas.DataFrame
+        One row for each stage, with the action, sorter, start and host of the run
+    """
+    import pandas as pd
+
+    from .utils import _get_data_path
+
+    if action_ids is None:
+        action_ids = list(project.actions)
+    rows = []
+    for action_id in action_ids:
+        nwb_path = _get_data_path(project.actions[action_id])
+        if nwb_path is None:
+            continue
+        si_folder = nwb_path.parent / "spikeinterface"
+        for profile_file in sorted(si_folder.glob(f"{sorter or '*'}/{StageProfiler.file_name}")):
+            profile = json.loads(profile_file.read_text())
+            for stage_profile in profile["stages"]:
+                rows.append(
+                    dict(
+                        action_id=action_id,
+                        sorter=profile_file.parent.name,
+                        start=profile["start"],
+                        host=profile["host"],
+                        **stage_profile,
+                    )
+                )
+    profiles = pd.DataFrame(rows)
+    if output_path is not None:
+        output_path = Path(output_path)
+        if output_path.suffix == ".parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "Saving the profiles to Parquet requires pyarrow: install it with "
+                    "`pip install expipe_plugin_cinpla[profiling]` or use a '.csv' output_path"
+                )
+            profiles.to_parquet(output_path)
+        else:
+            profiles.to_csv(output_path, index=False)
+    return profiles
+
+
+def _reset_peak_rss():
+    # on Linux, writing "5" to clear_refs resets the peak RSS (VmHWM) of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _get_peak_rss_mb(children=False):
+    if not children:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return round(peak_rss / (1024**2 if sys.platform == "darwin" else 1024), 1)
+
+
+def _get_io_counters():
+    # /proc/<pid>/io of the main process includes the terminated child processes once they are reaped, so only the
+    # running child processes (e.g. the workers of a process pool) are added
+    io_counters = _read_io_counters("self")
+    try:
+        import psutil
+
+        children = psutil.Process().children(recursive=True)
+    except Exception:
+        children = []
+    for child in children:
+        child_io_counters = _read_io_counters(child.pid)
+        for key in io_counters:
+            io_counters[key] += child_io_counters.get(key, 0)
+    return io_counters
+
+
+def _read_io_counters(pid):
+    io_counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in ("rchar", "wchar", "read_bytes", "write_bytes"):
+                    io_counters[key.replace("rchar", "read_chars").replace("wchar", "write_chars")] = int(value)
+    except OSError:
+        # not on Linux, or the process has terminated
+        pass
+    return io_counters
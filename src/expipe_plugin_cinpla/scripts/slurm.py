@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+slurm_template = """#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --array=0-{last_task}{max_concurrent}
+#SBATCH --cpus-per-task={cpus_per_task}
+#SBATCH --output={log_folder}/task-%a.log
+{sbatch_options}
+{setup}
+{python} -m expipe_plugin_cinpla.scripts.slurm {run_folder} "$SLURM_ARRAY_TASK_ID"
+exit_code=$?
+echo "$exit_code" > {task_folder}/task-"$SLURM_ARRAY_TASK_ID".exitcode
+exit "$exit_code"
+"""
+
+
+def prepare_slurm_run(
+    project,
+    action_ids,
+    sorter,
+    process_kwargs=None,
+    run_folder=None,
+    cpus_per_task=8,
+    mem=None,
+    time_limit=None,
+    partition=None,
+    max_concurrent=None,
+    sbatch_args=None,
+    setup=None,
+    python=None,
+):
+    """
+    Prepares a SLURM array job processing each action with `process_ecephys` in a separate task.
+
+    The run folder contains the job script (`job.sh`), the actions and parameters of the run (`run.json`),
+    the log of each task (`logs/task-<index>.log`) and its status (`tasks/`).
+
+    Parameters
+    ----------
+    project : expipe.Project
+        The expipe project
+    action_ids : list
+        The action IDs to process (one array task each)
+    sorter : str
+        The spike sorter name
+    process_kwargs : dict, optional
+        Keyword arguments for `process_ecephys`
+    run_folder : str or Path, optional
+        The run folder. By default, `processing-reports/slurm-<sorter>-<timestamp>` in the project folder
+    cpus_per_task : int, default: 8
+        The number of CPUs of each task
+    mem : str, optional
+        The memory of each task (e.g. "32G")
+    time_limit : str, optional
+        The time limit of each task (e.g. "12:00:00")
+    partition : str, optional
+        The SLURM partition
+    max_concurrent : int, optional
+        The maximum number of tasks running at the same time
+    sbatch_args : list, optional
+        Additional #SBATCH options (e.g. ["--account=nn1234k"])
+    setup : str, optional
+        Shell commands run before processing (e.g. "module load ..." or activating an environment)
+    python : str, optional
+        The python executable. By default, the current one
+
+    Returns
+    -------
+    run_folder : Path
+        The run folder
+    """
+    action_ids = list(action_ids)
+    if len(action_ids) == 0:
+        raise ValueError("No actions to process")
+    if process_kwargs is None:
+        process_kwargs = {}
+    if run_folder is None:
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        run_folder = project.path / "processing-reports" / f"slurm-{sorter}-{timestamp}"
+    run_folder = Path(run_folder).absolute()
+    log_folder = run_folder / "logs"
+    task_folder = run_folder / "tasks"
+    log_folder.mkdir(parents=True, exist_ok=True)
+    task_folder.mkdir(parents=True, exist_ok=True)
+
+    run_info = dict(
+        project_path=str(project.path),
+        sorter=sorter,
+        action_ids=action_ids,
+        process_kwargs=process_kwargs,
+        cpus_per_task=cpus_per_task,
+        job_id=None,
+        created=datetime.now().isoformat(timespec="seconds"),
+    )
+    (run_folder / "run.json").write_text(json.dumps(run_info, indent=4))
+
+    sbatch_options = []
+    if mem is not None:
+        sbatch_options.append(f"--mem={mem}")
+    if time_limit is not None:
+        sbatch_options.append(f"--time={time_limit}")
+    if partition is not None:
+        sbatch_options.append(f"--partition={partition}")
+    if sbatch_args is not None:
+        sbatch_options.extend(sbatch_args)
+    script = slurm_template.format(
+        job_name=f"{project.path.name}-{sorter}",
+        last_task=len(action_ids) - 1,
+        max_concurrent=f"%{max_concurrent}" if max_concurrent is not None else "",
+        cpus_per_task=cpus_per_task,
+        log_folder=shlex.quote(str(log_folder)),
+        sbatch_options="\n".join(f"#SBATCH {option}" for option in sbatch_options),
+        setup=setup or "",
+        python=shlex.quote(python or sys.executable),
+        run_folder=shlex.quote(str(run_folder)),
+        task_folder=shlex.quote(str(task_folder)),
+    )
+    (run_folder / "job.sh").write_text(script)
+    return run_folder
+
+
+def submit_slurm_job(run_folder, sbatch="sbatch", dry_run=False):
+    """
+    Submits the array job of a run folder prepared with `prepare_slurm_run`.
+
+    Parameters
+    ----------
+    run_folder : str or Path
+        The run folder
+    sbatch : str, default: "sbatch"
+        The sbatch executable (e.g. a shim for local testing)
+    dry_run : bool, default: False
+        If True, the job script is printed and not submitted
+
+    Returns
+    -------
+    job_id : str or None
+        The SLURM job ID (None for dry runs)
+    """
+    run_folder = Path(run_folder)
+    job_script = run_folder / "job.sh"
+    if dry_run:
+        print(job_script.read_text())
+        return None
+    result = subprocess.run([sbatch, "--parsable", str(job_script)], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"sbatch failed with exit code {result.returncode}:\n{result.stderr}")
+    # --parsable prints "<job_id>[;<cluster>]"
+    job_id = result.stdout.strip().split(";")[0]
+    run_info_file = run_folder / "run.json"
+    run_info = json.loads(run_info_file.read_text())
+    run_info["job_id"] = job_id
+    run_info["submitted"] = datetime.now().isoformat(timespec="seconds")
+    run_info_file.write_text(json.dumps(run_info, indent=4))
+    print(f"Submitted batch job {job_id} with {len(run_info['action_ids'])} tasks\n\tRun folder: {run_folder}")
+    return job_id
+
+
+def collect_slurm_report(run_folder):
+    """
+    Collects the status, exit code and timing of each task of a SLURM run into `report.json` in the run folder.
+
+    Tasks without a status are "pending". Tasks whose process was killed (e.g. out of memory) are "failed", with
+    the exit code of the process but no timing. Tasks cancelled by SLURM (e.g. time limit) remain "running":
+    the reason is at the end of their log.
+
+    Parameters
+    ----------
+    run_folder : str or Path
+        The run folder
+
+    Returns
+    -------
+    report : dict
+        The status of each action
+    """
+    run_folder = Path(run_folder)
+    run_info = json.loads((run_folder / "run.json").read_text())
+    actions = {}
+    for task_index, action_id in enumerate(run_info["action_ids"]):
+        status_file = run_folder / "tasks" / f"task-{task_index}.json"
+        exit_code_file = run_folder / "tasks" / f"task-{task_index}.exitcode"
+        action_report = dict(task=task_index, status="pending")
+        if status_file.is_file():
+            action_report.update(json.loads(status_file.read_text()))
+        if exit_code_file.is_file():
+            exit_code = int(exit_code_file.read_text().strip())
+            action_report["exit_code"] = exit_code
+            if exit_code != 0 and action_report["status"] in ("pending", "running", "completed"):
+                action_report["status"] = "failed"
+        action_report["log"] = str(run_folder / "logs" / f"task-{task_index}.log")
+        actions[action_id] = action_report
+
+    report = dict(
+        job_id=run_info["job_id"],
+        sorter=run_info["sorter"],
+        process_kwargs=run_info["process_kwargs"],
+        actions=actions,
+    )
+    (run_folder / "report.json").write_text(json.dumps(report, indent=4))
+    return report
+
+
+def run_slurm_task(run_folder, task_index):
+    """
+    Processes the action of an array task (called by the job script).
+
+    Returns
+    -------
+    exit_code : int
+        0 if the action has been processed successfully
+    """
+    import expipe
+
+    from .process import process_ecephys
+
+    run_folder = Path(run_folder)
+    task_index = int(task_index)
+    run_info = json.loads((run_folder / "run.json").read_text())
+    action_id = run_info["action_ids"][task_index]
+    status_file = run_folder / "tasks" / f"task-{task_index}.json"
+
+    status = dict(
+        task=task_index,
+        status="running",
+        start=datetime.now().isoformat(timespec="seconds"),
+        host=os.uname().nodename,
+        slurm_job_id=os.environ.get("SLURM_JOB_ID"),
+    )
+    status_file.write_text(json.dumps(status, indent=4))
+    print(f"Processing {action_id} (task {task_index})")
+    t_start = time.time()
+    try:
+        project = expipe.get_project(run_info["project_path"])
+        success = process_ecephys(project, action_id, run_info["sorter"], **run_info["process_kwargs"])
+        status["status"] = "completed" if success else "failed"
+        if not success:
+            status["error"] = "Error writing to NWB"
+    except Exception as e:
+        import traceback
+
+        traceback.print_exc()
+        status["status"] = "failed"
+        status["error"] = f"{type(e).__name__}: {e}"
+    status["end"] = datetime.now().isoformat(timespec="seconds")
+    status["duration"] = time.time() - t_start
+    status_file.write_text(json.dumps(status, indent=4))
+    return 0 if status["status"] == "completed" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(run_slurm_task(*sys.argv[1:]))
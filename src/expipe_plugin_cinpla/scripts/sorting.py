@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def run_sorter_by_group(
+    sorter,
+    recording,
+    folder,
+    n_workers=None,
+    max_memory=None,
+    n_jobs=None,
+    report_path=None,
+    singularity_image=None,
+    verbose=False,
+    **sorter_params,
+):
+    """
+    Spike sorts each channel group (e.g. tetrode) of a recording separately, optionally on a pool of processes.
+
+    By default, the groups are sorted sequentially in the current process (the peak RSS is then the one of the
+    process up to the end of the group), with `n_jobs` and `max_memory` restored after each group. With more than
+    one worker, each group is sorted in a separate "spawn" process, so that the groups run in parallel and the
+    memory of a group is released when it is done; the call must then be guarded by
+    ``if __name__ == "__main__":`` when called from a script. The wall time and peak memory (RSS) of each group are
+    reported, to size the number of workers and the memory of the nodes.
+
+    Parameters
+    ----------
+    sorter : str
+        The spike sorter name
+    recording : BaseRecording
+        The recording to sort, with a "group" property. It must be serializable (e.g. saved to binary or read
+        from a file)
+    folder : str or Path
+        The working folder (one sub-folder per group)
+    n_workers : int, optional
+        The number of groups sorted in parallel. By default, 1: the groups are sorted sequentially in the current
+        process
+    max_memory : int or str, optional
+        The maximum memory of each worker, in bytes or as a string (e.g. "8G"). A group exceeding it fails with a
+        MemoryError, and the number of workers is limited so that all workers fit in the physical memory.
+        With a single worker, the limit includes the memory already used by the current process
+    n_jobs : int, optional
+        The total number of CPUs, split between the workers. By default, all CPUs
+    report_path : str or Path, optional
+        If given, the report is written to this JSON file
+    singularity_image : str or bool, optional
+        The singularity image to run the spike sorter in
+    verbose : bool, default: False
+        If True, the progress is printed
+    **sorter_params : dict
+        The spike sorter parameters
+
+    Returns
+    -------
+    sorting : UnitsAggregationSorting
+        The aggregated sorting, with the "group" property
+    report : dict
+        The status, wall time and peak RSS of each group
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from spikeinterface.core import aggregate_units
+    from spikeinterface.core.core_tools import convert_string_to_bytes
+
+    folder = Path(folder).absolute()
+    recordings = recording.split_by("group")
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_workers is None:
+        n_workers = 1
+    if isinstance(max_memory, str):
+        max_memory = convert_string_to_bytes(max_memory)
+    if max_memory is not None and hasattr(os, "sysconf"):
+        total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        n_workers = min(n_workers, total_memory // max_memory)
+    n_workers = int(max(1, min(n_workers, len(recordings))))
+    n_jobs_per_worker = max(1, n_jobs // n_workers)
+
+    report = dict(
+        sorter=sorter,
+        n_workers=n_workers,
+        n_jobs_per_worker=n_jobs_per_worker,
+        max_memory=max_memory,
+        groups={str(group): dict(status="pending") for group in recordings},
+    )
+    if verbose:
+        print(f"\tSorting {len(recordings)} groups with {n_workers} workers ({n_jobs_per_worker} jobs per worker)")
+
+    t_start = time.time()
+    sortings = {}
+    if n_workers == 1:
+        for group, recording_group in recordings.items():
+            try:
+                sortings[group], report["groups"][str(group)] = _run_sorter_group(
+                    sorter,
+                    recording_group,
+                    folder / str(group),
+                    n_jobs_per_worker,
+                    max_memory,
+                    singularity_image,
+                    sorter_params,
+                )
+            except Exception as e:
+                report["groups"][str(group)] = dict(status="failed", error=f"{type(e).__name__}: {e}")
+            if verbose:
+                _print_group_report(group, report["groups"][str(group)])
+    else:
+        # a new process for each group (python >= 3.11), so that the peak RSS is the one of the group
+        pool_kwargs = dict(max_tasks_per_child=1) if sys.version_info >= (3, 11) else {}
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"), **pool_kwargs
+        ) as executor:
+            futures = {}
+            for group, recording_group in recordings.items():
+                futures[group] = executor.submit(
+                    _run_sorter_group,
+                    sorter,
+                    recording_group.to_dict(recursive=True),
+                    folder / str(group),
+                    n_jobs_per_worker,
+                    max_memory,
+                    singularity_image,
+                    sorter_params,
+                )
+            for group, future in futures.items():
+                try:
+                    sortings[group], report["groups"][str(group)] = future.result()
+                except Exception as e:
+                    # e.g. sorter errors, MemoryError or a worker killed by the OS
+                    report["groups"][str(group)] = dict(status="failed", error=f"{type(e).__name__}: {e}")
+                if verbose:
+                    _print_group_report(group, report["groups"][str(group)])
+    report["duration"] = time.time() - t_start
+
+    if report_path is not None:
+        Path(report_path).write_text(json.dumps(report, indent=4))
+    failed = [group for group, group_report in report["groups"].items() if group_report["status"] == "failed"]
+    if len(failed) > 0:
+        errors = "\n".join(f"Group {group}: {report['groups'][group]['error']}" for group in failed)
+        raise Exception(f"Spike sorting failed for {len(failed)} groups:\n{errors}")
+
+    sorting_list = [sortings[group] for group in recordings]
+    unit_groups = np.concatenate(
+        [[group] * sorting.get_num_units() for group, sorting in zip(recordings, sorting_list)]
+    ).astype(recording.get_channel_groups().dtype)
+    sorting = aggregate_units(sorting_list)
+    sorting.set_property(key="group", values=unit_groups)
+    sorting.register_recording(recording)
+    return sorting, report
+
+
+def _run_sorter_group(sorter, recording, folder, n_jobs, max_memory, singularity_image, sorter_params):
+    import spikeinterface as si
+    import spikeinterface.sorters as ss
+
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        resource = None
+
+    # the limits are restored at the end, as the group may run in the current process (with a single worker)
+    rlimit_data = None
+    job_kwargs = si.get_global_job_kwargs()
+    try:
+        if max_memory is not None and resource is not None:
+            # RLIMIT_DATA includes the heap and private memory maps (numpy arrays), but not the shared libraries.
+            # Only the soft limit is set, so that it can be raised back
+            rlimit_data = resource.getrlimit(resource.RLIMIT_DATA)
+            resource.setrlimit(resource.RLIMIT_DATA, (max_memory, rlimit_data[1]))
+        if n_jobs is not None:
+            si.set_global_job_kwargs(n_jobs=n_jobs, progress_bar=False)
+        if isinstance(recording, dict):
+            recording = si.load_extractor(recording)
+
+        # the redirect stdout doesn't work nicely with singularity
+        context = contextlib.nullcontext() if singularity_image else contextlib.redirect_stdout(None)
+        t_start = time.time()
+        with context:
+            sorting = ss.run_sorter(
+                sorter,
+                recording,
+                folder=folder,
+                verbose=False,
+                delete_output_folder=True,
+                remove_existing_folder=True,
+                singularity_image=singularity_image,
+                **sorter_params,
+            )
+    finally:
+        if rlimit_data is not None:
+            resource.setrlimit(resource.RLIMIT_DATA, rlimit_data)
+        si.set_global_job_kwargs(n_jobs=job_kwargs["n_jobs"], progress_bar=job_kwargs["progress_bar"])
+    group_report = dict(
+        status="completed",
+        num_units=int(sorting.get_num_units()),
+        duration=time.time() - t_start,
+        peak_rss_mb=None,
+        pid=os.getpid(),
+    )
+    if resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS (the children are the sorters running in a subprocess
+        # or container)
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        group_report["peak_rss_mb"] = round(peak_rss / (1024**2 if sys.platform == "darwin" else 1024), 1)
+    return sorting, group_report
+
+
+def _print_group_report(group, group_report):
+    if group_report["status"] == "completed":
+        print(
+            f"\t\tGroup {group}: {group_report['num_units']} units in {np.round(group_report['duration'], 1)}s "
+            f"(peak RSS {group_report['peak_rss_mb']} MB)"
+        )
+    else:
+        print(f"\t\tGroup {group}: {group_report['error']}")
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+storage_formats = ("binary", "zarr")
+
+# HDF5 dataset settings of the units tables (see `get_units_dataset_settings`)
+default_units_dataset_settings = dict(
+    compression="gzip",
+    compression_opts=4,
+    shuffle=True,
+    spike_times_chunk_size=65536,
+    unit_chunk_size=64,
+)
+
+# HDF5 dataset settings of the LFP and MUA electrical series (see `get_ecephys_dataset_settings`)
+default_ecephys_dataset_settings = dict(
+    compression="gzip",
+    compression_opts=4,
+    shuffle=True,
+    chunk_duration_s=10.0,
+    dtype=None,
+)
+
+
+def get_storage_format(project, storage_format=None):
+    """
+    Returns the storage format of the analyzer and of the preprocessed traces.
+
+    Parameters
+    ----------
+    project : expipe.Project
+        The expipe project. The project-level format is the "storage_format" entry of the project config
+    storage_format : "binary" | "zarr", optional
+        If given, it overrides the project-level format
+
+    Returns
+    -------
+    storage_format : "binary" | "zarr"
+        With "binary" (default), the analyzer and the preprocessed traces are saved uncompressed to binary folders.
+        With "zarr", they are saved as chunked and compressed zarr folders (see `get_zarr_compressor`)
+    """
+    storage_format = storage_format or project.config.get("storage_format") or "binary"
+    assert storage_format in storage_formats, f"'storage_format' can be one of {storage_formats}"
+    return storage_format
+
+
+def get_units_dataset_settings(project=None, **settings):
+    """
+    Returns the HDF5 chunking and compression settings of the `spike_times` and waveform columns of the units tables
+    (``units``, ``RawUnits-<sorter>`` and ``CuratedUnits``) written to the NWB files.
+
+    The spike times are chunked along the spikes, so that the spike train of a unit only reads the chunks of the
+    unit, and the spike times index and the waveforms along the units. All these columns are compressed.
+
+    Parameters
+    ----------
+    project : expipe.Project, optional
+        The expipe project. The project-level settings are the "units_dataset_settings" entry of the project config,
+        which override the defaults (`default_units_dataset_settings`)
+    **settings : dict
+        Settings overriding the project-level ones:
+
+        * compression: the HDF5 compression filter ("gzip", "lzf" or None to disable the compression)
+        * compression_opts: the compression level of "gzip" (0 to 9)
+        * shuffle: whether to apply the shuffle filter, which improves the compression of the float spike times
+        * spike_times_chunk_size: the number of spikes per chunk of the spike times
+        * unit_chunk_size: the number of units per chunk of the spike times index and of the waveforms
+
+    Returns
+    -------
+    units_dataset_settings : dict
+        The dataset settings
+    """
+    return _get_dataset_settings(project, "units_dataset_settings", default_units_dataset_settings, settings)
+
+
+def get_ecephys_dataset_settings(project=None, **settings):
+    """
+    Returns the HDF5 chunking, compression and dtype settings of the LFP and MUA electrical series
+    (``ElectricalSeriesLFP`` and ``ElectricalSeriesMUA``) written to the NWB files.
+
+    The traces are chunked along time, with all channels in each chunk, so that reading a time window (e.g.
+    `data_loader.load_lfp(..., lim=...)`) only reads and decompresses the chunks of the window.
+
+    Parameters
+    ----------
+    project : expipe.Project, optional
+        The expipe project. The project-level settings are the "ecephys_dataset_settings" entry of the project
+        config, which override the defaults (`default_ecephys_dataset_settings`)
+    **settings : dict
+        Settings overriding the project-level ones:
+
+        * compression: the HDF5 compression filter ("gzip", "lzf" or None to disable the compression)
+        * compression_opts: the compression level of "gzip" (0 to 9)
+        * shuffle: whether to apply the shuffle filter
+        * chunk_duration_s: the duration of the chunks in seconds
+        * dtype: None to write the traces with their dtype, or "int16" to store float traces as int16 with a
+          per-channel conversion factor (see `preprocessing.scale_to_int16`)
+
+    Returns
+    -------
+    ecephys_dataset_settings : dict
+        The dataset settings
+    """
+    return _get_dataset_settings(project, "ecephys_dataset_settings", default_ecephys_dataset_settings, settings)
+
+
+def _get_dataset_settings(project, config_key, default_settings, settings):
+    dataset_settings = dict(default_settings)
+    if project is not None:
+        dataset_settings.update(project.config.get(config_key) or {})
+    dataset_settings.update(settings)
+    unknown_settings = set(dataset_settings) - set(default_settings)
+    assert len(unknown_settings) == 0, f"Unknown {config_key.replace('_', ' ')}: {unknown_settings}"
+    return dataset_settings
+
+
+def get_analyzer_format(storage_format):
+    """Returns the spikeinterface analyzer format for a storage format"""
+    return "zarr" if storage_format == "zarr" else "binary_folder"
+
+
+def get_analyzer_folder(folder, storage_format=None):
+    """
+    Returns the analyzer folder in a processing folder (e.g. ``spikeinterface/<sorter>``).
+
+    Parameters
+    ----------
+    folder : str or Path
+        The processing folder
+    storage_format : "binary" | "zarr", optional
+        The storage format of the analyzer. By default, the existing analyzer folder is returned (or None if there
+        is none)
+
+    Returns
+    -------
+    analyzer_folder : Path or None
+        ``analyzer`` for the binary format and ``analyzer.zarr`` for the zarr format
+    """
+    folder = Path(folder)
+    if storage_format is not None:
+        return folder / ("analyzer.zarr" if storage_format == "zarr" else "analyzer")
+    for analyzer_folder in (folder / "analyzer", folder / "analyzer.zarr"):
+        if analyzer_folder.is_dir():
+            return analyzer_folder
+    return None
+
+
+def get_zarr_compressor(clevel=5):
+    """
+    Returns the zarr compressor of the traces and analyzer data: Blosc with zstd and bit-shuffle, which gives
+    good compression ratios of int16 and float32 electrophysiology data at a low CPU cost.
+
+    Parameters
+    ----------
+    clevel : int, default: 5
+        The compression level (1 to 9)
+
+    Returns
+    -------
+    compressor : numcodecs.Blosc
+        The compressor
+    """
+    from numcodecs import Blosc
+
+    return Blosc(cname="zstd", clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+
+
+def get_channel_chunk_size(recording):
+    """
+    Returns the number of channels of the zarr chunks of a recording: the size of the largest channel group
+    (e.g. 4 for tetrodes), so that reading the traces of a group only decompresses the chunks of the group.
+    Reading a time slice of all channels decompresses one chunk for each group.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording
+
+    Returns
+    -------
+    channel_chunk_size : int or None
+        The number of channels of the chunks (None, i.e. all channels, if the recording has no groups)
+    """
+    if "group" not in recording.get_property_keys():
+        return None
+    _, group_sizes = np.unique(recording.get_channel_groups(), return_counts=True)
+    return int(np.max(group_sizes))
+
+
+def get_folder_size(folder):
+    """Returns the size in bytes of the files in a folder"""
+    return sum(path.stat().st_size for path in Path(folder).rglob("*") if path.is_file())
+
+
+def benchmark_storage(
+    recording,
+    folder,
+    storage_formats=storage_formats,
+    num_reads=20,
+    read_duration_s=1.0,
+    channel_read_duration_s=10.0,
+    seed=None,
+    **job_kwargs,
+):
+    """
+    Compares the size, write throughput and random-access read latency of the storage formats of a recording.
+
+    Each format is written with `preprocessing.save_fused` (as in `process_ecephys`). The read latency is the median
+    over `num_reads` random windows of: time-sliced reads (`read_duration_s` of all channels) and channel-sliced
+    reads (`channel_read_duration_s` of the channels of a random group). The files are read right after they are
+    written, so the latencies are the ones of a warm page cache (i.e. they mostly measure the decompression).
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording to write (e.g. the preprocessed recording)
+    folder : str or Path
+        The scratch folder. The written data are removed at the end
+    storage_formats : tuple, default: ("binary", "zarr")
+        The storage formats to compare
+    num_reads : int, default: 20
+        The number of random reads
+    read_duration_s : float, default: 1.0
+        The duration of the time-sliced reads
+    channel_read_duration_s : float, default: 10.0
+        The duration of the channel-sliced reads
+    seed : int, optional
+        The seed of the random windows
+    **job_kwargs : dict
+        Job kwargs for the writing (n_jobs, chunk_duration, ...)
+
+    Returns
+    -------
+    benchmark : dict
+        Dictionary with the storage format as key and a dictionary with "size_mb", "compression_ratio",
+        "write_time_s", "write_mb_s", "time_read_ms" and "channel_read_ms" as value
+    """
+    from .preprocessing import save_fused
+
+    folder = Path(folder)
+    rng = np.random.default_rng(seed)
+    num_samples = recording.get_num_samples(segment_index=0)
+    sampling_frequency = recording.sampling_frequency
+    num_read_samples = min(int(read_duration_s * sampling_frequency), num_samples)
+    num_channel_read_samples = min(int(channel_read_duration_s * sampling_frequency), num_samples)
+    time_starts = rng.integers(0, num_samples - num_read_samples + 1, size=num_reads)
+    channel_starts = rng.integers(0, num_samples - num_channel_read_samples + 1, size=num_reads)
+    if "group" in recording.get_property_keys():
+        channel_groups = recording.get_channel_groups()
+        groups = rng.choice(np.unique(channel_groups), size=num_reads)
+        channel_ids_per_read = [recording.channel_ids[channel_groups == group] for group in groups]
+    else:
+        channel_ids_per_read = [recording.channel_ids[:1]] * num_reads
+    data_size = recording.get_total_samples() * recording.get_num_channels() * recording.get_dtype().itemsize
+
+    benchmark = {}
+    for storage_format in storage_formats:
+        storage_folder = folder / f"benchmark_{storage_format}"
+        if storage_format == "zarr":
+            storage_folder = storage_folder.with_suffix(".zarr")
+        t_start = time.perf_counter()
+        saved = save_fused(
+            recording,
+            {storage_format: dict(recording=recording, folder=storage_folder, format=storage_format)},
+            **job_kwargs,
+        )[storage_format]
+        write_time = time.perf_counter() - t_start
+        size = get_folder_size(storage_folder)
+
+        time_read_times = []
+        for start_frame in time_starts:
+            t_start = time.perf_counter()
+            # the binary traces are memmap views: they are copied to be read from the files
+            np.array(saved.get_traces(start_frame=start_frame, end_frame=start_frame + num_read_samples))
+            time_read_times.append(time.perf_counter() - t_start)
+        channel_read_times = []
+        for start_frame, channel_ids in zip(channel_starts, channel_ids_per_read):
+            t_start = time.perf_counter()
+            np.array(
+                saved.get_traces(
+                    start_frame=start_frame, end_frame=start_frame + num_channel_read_samples, channel_ids=channel_ids
+                )
+            )
+            channel_read_times.append(time.perf_counter() - t_start)
+
+        benchmark[storage_format] = dict(
+            size_mb=size / 1024**2,
+            compression_ratio=data_size / size,
+            write_time_s=write_time,
+            write_mb_s=data_size / 1024**2 / write_time,
+            time_read_ms=float(np.median(time_read_times)) * 1000,
+            channel_read_ms=float(np.median(channel_read_times)) * 1000,
+        )
+        saved = None
+        shutil.rmtree(storage_folder)
+    return benchmark
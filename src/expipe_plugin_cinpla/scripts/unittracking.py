@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
-import shutil
 import warnings
 
 import numpy as np
 from pynwb import NWBHDF5IO
 from tqdm.auto import tqdm
 
+from expipe_plugin_cinpla.nwbutils.nwbappendwriter import NWBAppendWriter
 from expipe_plugin_cinpla.scripts.utils import _get_data_path
 from expipe_plugin_cinpla.tools.data_loader import load_spiketrains
 
@@ -72,10 +72,8 @@ def track_units(project_loader, actions, dates, dissimilarity):
 def save_to_nwb(project_loader, action_id, unit_matching):
     action = project_loader.actions[action_id]
     nwb_path = _get_data_path(action)
-    nwb_path_tmp = nwb_path.parent / "main_tmp.nwb"
-    shutil.copy(nwb_path, nwb_path_tmp)
 
-    spike_trains = load_spiketrains(nwb_path_tmp)
+    spike_trains = load_spiketrains(nwb_path)
     unit_ids = [u.annotations["name"] for u in spike_trains]
 
     daily_ids = np.zeros(len(unit_ids), dtype="U38")
@@ -88,23 +86,13 @@ def save_to_nwb(project_loader, action_id, unit_matching):
                 daily_ids[unit_index] = unique_unit
 
     try:
-        with NWBHDF5IO(str(nwb_path_tmp), mode="a") as io:
-            nwbfile = io.read()
-            if "daily_unit_id" in nwbfile.units.colnames:
+        with NWBAppendWriter(nwb_path) as writer:
+            if writer.remove_column("units", "daily_unit_id"):
                 print("Overwriting existing daily_unit_id column")
-                daily_units_vector = nwbfile.units["daily_unit_id"]
-                daily_units_vector.data[:] = daily_ids
-                daily_units_vector.set_modified(True)
-            else:
-                nwbfile.add_unit_column(
-                    name="daily_unit_id", description="Unique unid ID over same day", data=daily_ids
-                )
-            io.write(nwbfile)
-        nwb_path.unlink()
-        shutil.copy(nwb_path_tmp, nwb_path)
+            nwbfile = writer.read()
+            nwbfile.add_unit_column(name="daily_unit_id", description="Unique unid ID over same day", data=daily_ids)
     except Exception as e:
         print(f"Failed saving {action_id} to NWB:\n{e}")
-        nwb_path_tmp.unlink()
 
 
 def plot_unit_templates(unit_matching, fig, min_matches=1):
@@ -162,7 +150,7 @@ def plot_unit_templates(unit_matching, fig, min_matches=1):
 def plot_rate_maps(project_loader, unit_matching, fig, min_matches=1):
     from spatial_maps import SpatialMap
 
-    from ..tools.data_processing import load_spiketrains, load_tracking
+    from ..tools.data_processing import load_tracking
 
     identified_units = unit_matching.identified_units
     fig.clear()
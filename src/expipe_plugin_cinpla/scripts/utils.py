@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import shutil
 import sys
 from datetime import datetime, timedelta
@@ -220,49 +221,30 @@ def add_units_from_sorting_analyzer(
     unit_table_description,
     write_in_processing_module=False,
     write_electrodes_column=True,
+    dataset_settings=None,
 ):
     from neuroconv.tools.spikeinterface import add_units_table
 
     sorting = sorting_analyzer.sorting
     sorting.register_recording(sorting_analyzer.recording)
+    template_ext = sorting_analyzer.get_extension("templates")
+    sparse_by_group = "group" in sorting_analyzer.sorting.get_property_keys() and sorting_analyzer.sparsity is not None
+    # dense templates (num_units, num_samples, num_channels): the median for the units sparse by group, the average
+    # otherwise
+    waveform_means = template_ext.get_templates(operator="median" if sparse_by_group else "average")
+    waveform_sds = template_ext.get_templates(operator="std")
+    num_units, num_samples, num_channels = waveform_means.shape
     # Take care of uneven sparsity
-    if "group" in sorting_analyzer.sorting.get_property_keys():
-        waveform_means, waveform_sds, unit_electrode_indices = [], [], []
-        max_channel_in_group = np.max(
-            [rec.get_num_channels() for rec in sorting_analyzer.recording.split_by("group").values()]
+    if sparse_by_group:
+        unit_electrode_indices, valid_mask = _get_padded_channel_indices(sorting_analyzer.sparsity.mask)
+        # gather the sparse channels of all units at once and set the padding channels to 0
+        gather_indices = np.broadcast_to(
+            np.where(valid_mask, unit_electrode_indices, 0)[:, None, :], (num_units, num_samples, valid_mask.shape[1])
         )
-        template_ext = sorting_analyzer.get_extension("templates")
-        for unit_id in sorting_analyzer.unit_ids:
-            wf_mean = template_ext.get_unit_template(unit_id, operator="median")
-            wf_sd = template_ext.get_unit_template(unit_id, operator="std")
-            channel_indices = sorting_analyzer.sparsity.unit_id_to_channel_indices[unit_id]
-
-            # make template sparse
-            wf_mean = wf_mean[:, channel_indices]
-            wf_sd = wf_sd[:, channel_indices]
-            if len(channel_indices) < max_channel_in_group:
-                num_missing_channels = max_channel_in_group - len(channel_indices)
-                wf_mean = np.pad(wf_mean, ((0, 0), (0, num_missing_channels)), mode="constant", constant_values=0)
-                wf_sd = np.pad(wf_sd, ((0, 0), (0, num_missing_channels)), mode="constant", constant_values=0)
-                max_index = np.max(channel_indices)
-                # add fake missing channel indices
-                if max_index < len(sorting_analyzer.channel_ids) - num_missing_channels:
-                    channel_indices = list(channel_indices) + list(
-                        range(max_index + 1, max_index + num_missing_channels + 1)
-                    )
-                else:
-                    min_index = np.min(channel_indices)
-                    channel_indices = list(channel_indices) + list(range(min_index - num_missing_channels, min_index))
-            waveform_means.append(wf_mean)
-            waveform_sds.append(wf_sd)
-            unit_electrode_indices.append(list(channel_indices))
+        waveform_means = np.where(valid_mask[:, None, :], np.take_along_axis(waveform_means, gather_indices, axis=2), 0)
+        waveform_sds = np.where(valid_mask[:, None, :], np.take_along_axis(waveform_sds, gather_indices, axis=2), 0)
     else:
-        waveform_means = template_ext.get_templates()
-        waveform_sds = template_ext.get_all_templates(operator="std")
-        channel_indices = np.array(
-            [list(sorting_analyzer.channel_ids).index(ch) for ch in sorting_analyzer.channel_ids]
-        )
-        unit_electrode_indices = [channel_indices] * len(sorting_analyzer.unit_ids)
+        unit_electrode_indices = np.tile(np.arange(num_channels), (num_units, 1))
 
     if not write_electrodes_column:
         unit_electrode_indices = None
@@ -287,6 +269,220 @@ def add_units_from_sorting_analyzer(
         waveform_sds=waveform_sds,
         unit_electrode_indices=unit_electrode_indices,
     )
+    if dataset_settings is not None:
+        if write_in_processing_module:
+            units_table = nwbfile.processing["ecephys"].data_interfaces[unit_table_name]
+        else:
+            units_table = nwbfile.units
+        set_units_table_data_io(units_table, dataset_settings)
+
+
+def get_timing_recording(recording):
+    """
+    Returns a recording with the channels, sampling frequency and times of a recording, but without traces.
+
+    It can replace a recording reading from the NWB file (e.g. the lazy preprocessed recording) to get the spike
+    times of a sorting once the file has been released, so that it can be opened in append mode.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording
+
+    Returns
+    -------
+    timing_recording : NumpyRecording
+        The recording with the same times, whose traces are zeros (not allocated)
+    """
+    from spikeinterface.core import NumpyRecording
+
+    num_segments = recording.get_num_segments()
+    # zero-strided traces do not allocate any memory
+    traces_list = [
+        np.broadcast_to(
+            np.zeros(1, dtype=recording.get_dtype()),
+            (recording.get_num_samples(segment_index), recording.get_num_channels()),
+        )
+        for segment_index in range(num_segments)
+    ]
+    t_starts = [recording.get_time_info(segment_index)["t_start"] or 0.0 for segment_index in range(num_segments)]
+    timing_recording = NumpyRecording(
+        traces_list, recording.sampling_frequency, t_starts=t_starts, channel_ids=recording.channel_ids
+    )
+    recording.copy_metadata(timing_recording)
+    for segment_index in range(num_segments):
+        if recording.has_time_vector(segment_index):
+            times = np.asarray(recording.get_times(segment_index))
+            timing_recording.set_times(times, segment_index=segment_index, with_warning=False)
+    return timing_recording
+
+
+def replace_analyzer_recording(sorting_analyzer, recording):
+    """
+    Returns a sorting analyzer with the same sorting, sparsity and extensions, but another recording.
+
+    The original analyzer (and its recording) is not referenced anymore by the returned analyzer, so that a recording
+    reading from the NWB file can be released. Analyzers saved to disk are reloaded, in-memory analyzers are copied.
+
+    Parameters
+    ----------
+    sorting_analyzer : SortingAnalyzer
+        The sorting analyzer
+    recording : BaseRecording
+        The new recording (e.g. from `get_timing_recording`)
+
+    Returns
+    -------
+    sorting_analyzer : SortingAnalyzer
+        The sorting analyzer with the new recording
+    """
+    from spikeinterface.core import SortingAnalyzer
+
+    if sorting_analyzer.format != "memory":
+        return SortingAnalyzer.load(sorting_analyzer.folder, recording=recording, format=sorting_analyzer.format)
+    new_sorting_analyzer = SortingAnalyzer.create_memory(
+        sorting_analyzer.sorting,
+        recording,
+        sorting_analyzer.sparsity,
+        sorting_analyzer.return_scaled,
+        sorting_analyzer.rec_attributes,
+    )
+    for extension_name in sorting_analyzer.get_loaded_extension_names():
+        extension = sorting_analyzer.get_extension(extension_name)
+        new_sorting_analyzer.extensions[extension_name] = extension.copy(new_sorting_analyzer)
+    return new_sorting_analyzer
+
+
+def set_units_table_data_io(units_table, dataset_settings):
+    """
+    Sets the HDF5 chunking and compression of the spike times and waveform columns of a units table before it is
+    written.
+
+    Parameters
+    ----------
+    units_table : pynwb.misc.Units
+        The units table (not written yet)
+    dataset_settings : dict
+        The dataset settings (see `storage.get_units_dataset_settings`)
+    """
+    from hdmf.backends.hdf5 import H5DataIO
+    from hdmf.utils import get_data_shape
+
+    compression_kwargs = _get_compression_kwargs(dataset_settings)
+    chunk_sizes = dict(
+        spike_times=dataset_settings["spike_times_chunk_size"],
+        spike_times_index=dataset_settings["unit_chunk_size"],
+        waveform_mean=dataset_settings["unit_chunk_size"],
+        waveform_sd=dataset_settings["unit_chunk_size"],
+    )
+    for column in units_table.columns:
+        if column.name not in chunk_sizes or isinstance(column.data, H5DataIO):
+            continue
+        shape = get_data_shape(column.data)
+        if shape is None or len(shape) == 0 or shape[0] == 0:
+            continue
+        chunks = (min(chunk_sizes[column.name], shape[0]),) + tuple(shape[1:])
+        column.set_data_io(H5DataIO, dict(chunks=chunks, **compression_kwargs))
+
+
+def add_processed_recording(recording, nwbfile, write_as, metadata=None, es_key=None, dataset_settings=None):
+    """
+    Adds a processed recording (e.g. LFP or MUA) to an NWB file as an electrical series in the "ecephys" processing
+    module, with the chunking, compression and dtype of the dataset settings.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording
+    nwbfile : pynwb.NWBFile
+        The NWB file
+    write_as : "lfp" | "processed"
+        Whether to add the electrical series to the "LFP" or "Processed" container
+    metadata : dict, optional
+        The neuroconv metadata, with the electrical series metadata in ``metadata["Ecephys"][es_key]``
+    es_key : str, optional
+        The electrical series key in the metadata. By default, the electrical series is named
+        ``ElectricalSeriesLFP`` (lfp) or ``ElectricalSeriesProcessed`` (processed)
+    dataset_settings : dict, optional
+        The dataset settings (see `storage.get_ecephys_dataset_settings`). By default, the neuroconv defaults
+    """
+    from hdmf.backends.hdf5 import H5DataIO
+    from neuroconv.tools.spikeinterface import add_recording
+
+    from .preprocessing import scale_to_int16
+
+    iterator_opts = None
+    if dataset_settings is not None:
+        if dataset_settings["dtype"] == "int16":
+            recording = scale_to_int16(recording)
+        # time-major chunks with all channels, written one chunk at a time
+        num_chunk_samples = int(dataset_settings["chunk_duration_s"] * recording.sampling_frequency)
+        chunk_shape = (max(1, min(num_chunk_samples, recording.get_num_samples())), recording.get_num_channels())
+        iterator_opts = dict(chunk_shape=chunk_shape)
+    add_recording(
+        recording, nwbfile=nwbfile, write_as=write_as, metadata=metadata, es_key=es_key, iterator_opts=iterator_opts
+    )
+
+    if dataset_settings is not None:
+        if es_key is not None:
+            es_name = metadata["Ecephys"][es_key]["name"]
+        else:
+            es_name = "ElectricalSeriesLFP" if write_as == "lfp" else "ElectricalSeriesProcessed"
+        container_name = "LFP" if write_as == "lfp" else "Processed"
+        electrical_series = nwbfile.processing["ecephys"].data_interfaces[container_name].electrical_series[es_name]
+        electrical_series.set_data_io(
+            "data", H5DataIO, data_io_kwargs=dict(chunks=chunk_shape, **_get_compression_kwargs(dataset_settings))
+        )
+
+
+def _get_compression_kwargs(dataset_settings):
+    compression_kwargs = {}
+    if dataset_settings["compression"] is not None:
+        compression_kwargs = dict(compression=dataset_settings["compression"], shuffle=dataset_settings["shuffle"])
+        # only gzip has a compression level
+        if dataset_settings["compression"] == "gzip":
+            compression_kwargs["compression_opts"] = dataset_settings["compression_opts"]
+    return compression_kwargs
+
+
+def _get_padded_channel_indices(sparsity_mask):
+    """
+    Returns the channel indices of the units of a sparsity mask, padded to the largest number of channels of a unit
+    (e.g. the channels of the largest tetrode) with fake indices of neighbouring channels (after the last channel
+    of the unit, or before the first one when there are not enough channels after it).
+
+    Parameters
+    ----------
+    sparsity_mask : np.ndarray
+        The sparsity mask (num_units, num_channels)
+
+    Returns
+    -------
+    channel_indices : np.ndarray
+        The channel indices (num_units, max_num_channels), in increasing order followed by the fake indices
+    valid_mask : np.ndarray
+        Boolean mask (num_units, max_num_channels) of the channels of the units (False for the fake indices)
+    """
+    num_channels = sparsity_mask.shape[1]
+    num_unit_channels = np.sum(sparsity_mask, axis=1)
+    max_num_channels = int(np.max(num_unit_channels, initial=0))
+    # a stable sort of the mask puts the channels of each unit first, in increasing order
+    channel_indices = np.argsort(~sparsity_mask, axis=1, kind="stable")[:, :max_num_channels]
+    positions = np.arange(max_num_channels)[None, :]
+    valid_mask = positions < num_unit_channels[:, None]
+
+    num_missing = (max_num_channels - num_unit_channels)[:, None]
+    first_index = channel_indices[:, :1]
+    last_index = np.take_along_axis(channel_indices, np.maximum(num_unit_channels - 1, 0)[:, None], axis=1)
+    # position of each padding channel among the padding channels
+    padding_positions = positions - num_unit_channels[:, None]
+    fake_indices = np.where(
+        last_index < num_channels - num_missing,
+        last_index + 1 + padding_positions,
+        first_index - num_missing + padding_positions,
+    )
+    channel_indices = np.where(valid_mask, channel_indices, fake_indices)
+    return channel_indices, valid_mask
 
 
 def generate_phy_restore_files(phy_folder):
@@ -299,6 +495,133 @@ def generate_phy_restore_files(phy_folder):
         shutil.copy(tsv_file, phy_restore_folder)
 
 
+def check_sortings_equal(sorting1, sorting2):
+    """Returns True if the two sortings have the same unit ids and spike trains"""
+    if sorting1.get_num_units() != sorting2.get_num_units():
+        return False
+
+    if not np.array_equal(sorting1.unit_ids.astype(str), sorting2.unit_ids.astype(str)):
+        return False
+
+    if not np.array_equal(sorting1.to_spike_vector(), sorting2.to_spike_vector()):
+        return False
+
+    return True
+
+
+def get_unit_spike_indices(sorting):
+    """
+    Returns the indices of the spikes of each unit in the spike vector of a sorting (`sorting.to_spike_vector()`).
+
+    Parameters
+    ----------
+    sorting : BaseSorting
+        The sorting
+
+    Returns
+    -------
+    unit_spike_indices : dict
+        Dictionary with the unit id as key and the (time-ordered) indices of its spikes as value
+    """
+    spikes = sorting.to_spike_vector()
+    # the spike vector is sorted by segment and sample, so a stable sort keeps the spikes of each unit in order
+    order = np.argsort(spikes["unit_index"], kind="stable")
+    counts = np.bincount(spikes["unit_index"], minlength=sorting.get_num_units())
+    return dict(zip(sorting.unit_ids, np.split(order, np.cumsum(counts)[:-1])))
+
+
+def match_unchanged_units(sorting, reference_sorting):
+    """
+    Matches the units of a sorting to the units of a reference sorting with the same spike train.
+
+    The spike trains are compared by hashing the segment and sample indices of the spikes of each unit, so that
+    units with different ids (e.g. after a curation) are matched as well.
+
+    Parameters
+    ----------
+    sorting : BaseSorting
+        The sorting (e.g. curated)
+    reference_sorting : BaseSorting
+        The reference sorting (e.g. raw)
+
+    Returns
+    -------
+    unit_id_map : dict
+        Dictionary with the unit ids of `sorting` as key and the unit ids of `reference_sorting` with the same
+        spike train as value. Units without a match are not included
+    """
+    reference_hashes = {}
+    for unit_id, spike_hash in get_unit_spike_hashes(reference_sorting).items():
+        reference_hashes.setdefault(spike_hash, unit_id)
+    unit_id_map = {}
+    for unit_id, spike_hash in get_unit_spike_hashes(sorting).items():
+        if spike_hash in reference_hashes:
+            unit_id_map[unit_id] = reference_hashes[spike_hash]
+    return unit_id_map
+
+
+def get_unit_spike_hashes(sorting):
+    """
+    Returns a hash of the spike train (segment and sample indices) of each unit of a sorting.
+
+    Parameters
+    ----------
+    sorting : BaseSorting
+        The sorting
+
+    Returns
+    -------
+    unit_spike_hashes : dict
+        Dictionary with the unit id as key and the hexadecimal hash of its spike train as value
+    """
+    import hashlib
+
+    spikes = sorting.to_spike_vector()
+    unit_spike_hashes = {}
+    for unit_id, spike_indices in get_unit_spike_indices(sorting).items():
+        spike_hash = hashlib.sha1(spikes["segment_index"][spike_indices].astype("int64").tobytes())
+        spike_hash.update(spikes["sample_index"][spike_indices].astype("int64").tobytes())
+        unit_spike_hashes[unit_id] = spike_hash.hexdigest()
+    return unit_spike_hashes
+
+
+def link_phy_recording(phy_folder, binary_file, dtype=None):
+    """
+    Makes an existing binary file the `recording.dat` of a phy folder (e.g. exported with `copy_binary=False`).
+
+    The binary file is hard-linked (copied if the file system does not support hard links) as `recording.dat`,
+    so that the phy folder stays self-contained when the original file is removed, without writing the traces
+    twice. The `dat_path` (and `dtype`) of `params.py` are updated accordingly.
+
+    Parameters
+    ----------
+    phy_folder : str or Path
+        The phy folder
+    binary_file : str or Path
+        The binary file with the traces (same channels as the phy export)
+    dtype : dtype, optional
+        The dtype of the binary file. If None, the dtype in `params.py` is kept
+    """
+    phy_folder = Path(phy_folder)
+    dat_file = phy_folder / "recording.dat"
+    if dat_file.is_file():
+        dat_file.unlink()
+    try:
+        os.link(binary_file, dat_file)
+    except OSError:
+        shutil.copy(binary_file, dat_file)
+
+    params_file = phy_folder / "params.py"
+    params_lines = []
+    for line in params_file.read_text().splitlines():
+        if line.startswith("dat_path"):
+            line = "dat_path = r'recording.dat'"
+        elif line.startswith("dtype") and dtype is not None:
+            line = f"dtype = '{np.dtype(dtype).name}'"
+        params_lines.append(line)
+    params_file.write_text("\n".join(params_lines))
+
+
 def compute_and_set_unit_groups(sorting, recording):
     import spikeinterface as si
 
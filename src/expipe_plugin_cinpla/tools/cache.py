@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of the data loaded from the NWB files of a project"""
+
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+from ..scripts.checkpoints import compute_key
+
+
+class NWBDataCache:
+    """
+    On-disk cache of the outputs of the data loaders (spike trains, tracking, epochs, ...) of the NWB files.
+
+    Each output is stored in a pickle file, keyed by:
+
+    * the NWB file path,
+    * the modification time and size of the NWB file, so that the outputs of a file are recomputed when it is
+      modified (e.g. when new processed data are appended),
+    * the loader name, its parameters and the plugin version.
+
+    The files of an NWB file are stored in ``<folder>/<path hash>/<file state hash>``. When the NWB file is modified,
+    the outputs of its previous state are removed.
+
+    Parameters
+    ----------
+    folder : str or Path
+        The cache folder. It should only be writable by the user, since the cached files are unpickled
+        (see ``get_default_cache_folder``)
+
+    Notes
+    -----
+    The cache is best-effort: if a file cannot be read or written (e.g. read-only or full disk), the output is
+    loaded from the NWB file as if it was not cached.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def __repr__(self):
+        return f"NWBDataCache: {self.folder}"
+
+    def load(self, loader, data_path, *args, **kwargs):
+        """
+        Returns the output of `loader(data_path, *args, **kwargs)`, from the cache if it exists.
+
+        Parameters
+        ----------
+        loader : callable
+            The loader (e.g. `data_loader.load_tracking`). Its output must be picklable
+        data_path : str or Path
+            Path to the NWB file
+        *args, **kwargs :
+            The loader arguments, which are part of the cache key
+
+        Returns
+        -------
+        output :
+            The loader output
+        """
+        from .. import __version__
+
+        data_path = Path(data_path).resolve()
+        path_folder = self._get_path_folder(data_path)
+        stat = data_path.stat()
+        state_folder = path_folder / compute_key(stat.st_mtime_ns, stat.st_size)[:16]
+        name = f"{loader.__module__}.{loader.__qualname__}"
+        cache_file = state_folder / f"{loader.__name__}-{compute_key(name, args, kwargs, __version__)[:16]}.pkl"
+
+        if cache_file.is_file():
+            try:
+                with open(cache_file, "rb") as f:
+                    return pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # an incomplete or unreadable file is recomputed
+                pass
+
+        output = loader(data_path, *args, **kwargs)
+
+        cache_tmp = cache_file.with_suffix(".tmp")
+        try:
+            if path_folder.is_dir():
+                for folder in path_folder.iterdir():
+                    if folder != state_folder:
+                        shutil.rmtree(folder, ignore_errors=True)
+            state_folder.mkdir(parents=True, exist_ok=True)
+            with open(cache_tmp, "wb") as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            cache_tmp.replace(cache_file)
+        except OSError:
+            # the output is not cached (e.g. read-only folder or full disk), a partial ".tmp" file is never read
+            pass
+        return output
+
+    def clear(self, data_path=None):
+        """
+        Removes the cached outputs.
+
+        Parameters
+        ----------
+        data_path : str or Path, optional
+            If given, only the outputs of this NWB file are removed
+        """
+        folder = self.folder if data_path is None else self._get_path_folder(Path(data_path).resolve())
+        if folder.is_dir():
+            shutil.rmtree(folder)
+
+    def _get_path_folder(self, data_path):
+        return self.folder / compute_key(str(data_path))[:16]
+
+
+def get_default_cache_folder():
+    """Returns the per-user cache folder (``$XDG_CACHE_HOME/expipe-plugin-cinpla``, by default in ``~/.cache``)"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "expipe-plugin-cinpla"
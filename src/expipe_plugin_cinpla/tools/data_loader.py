@@ -1,15 +1,227 @@
 # -*- coding: utf-8 -*-
 """Utils for loading data from NWB files"""
 
+from contextlib import contextmanager
+from pathlib import Path
+
 import neo
 import numpy as np
 import quantities as pq
 import spikeinterface as si
 import spikeinterface.extractors as se
 
+from ..scripts.storage import get_analyzer_folder
 from ..scripts.utils import _get_data_path
 
 
+class NWBSession:
+    """
+    Opens the NWB file of an action once and serves the data loaders of this module from the same file handle.
+
+    All the loaders (`get_duration`, `get_channel_groups`, `load_leds`, `load_epochs`, `load_spiketrains`, ...)
+    accept a session instead of a data path. The file is only opened when data are first requested, and the
+    containers are parsed lazily: the timing of the electrical series, the electrodes and the units tables are read
+    directly from the HDF5 file, and the NWB file is only read with pynwb for the containers that need it (e.g. the
+    tracking and the trials).
+
+    Parameters
+    ----------
+    data_path: str / Path
+        The action data path
+    electrical_series_path: str, default: "acquisition/ElectricalSeries"
+        The path of the raw electrical series, which gives the timing of the session
+
+    Examples
+    --------
+    >>> with NWBSession(data_path) as session:
+    ...     duration = get_duration(session)
+    ...     spiketrains = load_spiketrains(session)
+    """
+
+    def __init__(self, data_path, electrical_series_path="acquisition/ElectricalSeries"):
+        self.data_path = Path(data_path)
+        self.electrical_series_path = electrical_series_path
+        self._file = None
+        self._io = None
+        self._nwbfile = None
+        self._timing = None
+        self._unit_properties = {}
+
+    def __repr__(self):
+        return f"NWBSession: {self.data_path} ({'open' if self._file is not None else 'closed'})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def file(self):
+        """The h5py file"""
+        if self._file is None:
+            import h5py
+
+            self._file = h5py.File(self.data_path, "r")
+        return self._file
+
+    @property
+    def nwbfile(self):
+        """The pynwb NWBFile, read from the same file handle"""
+        if self._nwbfile is None:
+            from pynwb import NWBHDF5IO
+
+            self._io = NWBHDF5IO(file=self.file, mode="r")
+            self._nwbfile = self._io.read()
+        return self._nwbfile
+
+    @property
+    def sampling_frequency(self):
+        """The sampling frequency of the electrical series"""
+        return self._get_timing()["sampling_frequency"]
+
+    @property
+    def t_start(self):
+        """The time of the first sample of the electrical series"""
+        return self._get_timing()["t_start"]
+
+    @property
+    def num_samples(self):
+        """The number of samples of the electrical series"""
+        return self._get_timing()["num_samples"]
+
+    @property
+    def t_stop(self):
+        """The time of the last sample of the electrical series"""
+        return self._get_timing()["t_stop"]
+
+    def get_channel_groups(self):
+        """Returns the channel group of each channel of the electrical series"""
+        electrical_series = self.file[self.electrical_series_path]
+        electrodes_table = self.file["general/extracellular_ephys/electrodes"]
+        return _read_column(electrodes_table["group_name"])[electrical_series["electrodes"][:]]
+
+    def get_unit_ids(self, unit_table_path="units"):
+        """Returns the unit ids of a units table (the "unit_name" column, or the "id" column if there is none)"""
+        units = self.file[unit_table_path]
+        return _read_column(units["unit_name"] if "unit_name" in units else units["id"])
+
+    def get_unit_property_names(self, unit_table_path="units"):
+        """Returns the names of the unit properties of a units table, as `spikeinterface.extractors.read_nwb_sorting`"""
+        columns = list(self.file[unit_table_path].keys())
+        skip_properties = ["spike_times", "spike_times_index", "unit_name", "id"]
+        skip_properties += [name for name in columns if name.endswith("_index")]
+        skip_properties += [name for name in columns if f"{name}_index_index" in columns]
+        return [name for name in columns if name not in skip_properties]
+
+    def get_unit_properties(self, properties=None, unit_table_path="units"):
+        """
+        Reads the unit properties of a units table, with the same values as `spikeinterface.extractors.read_nwb_sorting`.
+        Each property column is read once (and kept in memory for the following calls).
+
+        Parameters
+        ----------
+        properties: list, optional
+            The names of the properties to read. By default, all properties
+        unit_table_path: str, default: "units"
+            The path of the units table
+
+        Returns
+        -------
+        properties: dict
+            Dictionary with the property names as keys and arrays of values (one per unit) as values
+        """
+        property_names = self.get_unit_property_names(unit_table_path)
+        if properties is None:
+            properties = property_names
+        missing_properties = set(properties) - set(property_names)
+        assert len(missing_properties) == 0, f"Properties {missing_properties} not found in {unit_table_path}"
+
+        units = self.file[unit_table_path]
+        unit_properties = self._unit_properties.setdefault(unit_table_path, {})
+        for property_name in properties:
+            if property_name in unit_properties:
+                continue
+            values = _read_column(units[property_name])
+            if f"{property_name}_index" in units:
+                # ragged properties are only loaded if all units have the same number of values
+                data_index = units[f"{property_name}_index"][:]
+                num_values = np.unique(np.diff(data_index, prepend=0))
+                values = values.reshape(len(data_index), -1, *values.shape[1:]) if num_values.size == 1 else None
+            unit_properties[property_name] = values
+        return {name: unit_properties[name] for name in properties if unit_properties[name] is not None}
+
+    def get_spike_times(self, unit_table_path="units"):
+        """
+        Reads the spike times of a units table.
+
+        Returns
+        -------
+        spike_times: np.ndarray
+            The concatenated spike times of the units
+        spike_times_index: np.ndarray
+            The end index of each unit in the spike times
+        """
+        units = self.file[unit_table_path]
+        return units["spike_times"][:], units["spike_times_index"][:]
+
+    def close(self):
+        """Closes the file (it is reopened if data are requested again)"""
+        if self._io is not None:
+            self._io.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._io = None
+        self._nwbfile = None
+
+    def _get_timing(self):
+        # the timing is read from the metadata of the electrical series: the raw data are never read
+        if self._timing is None:
+            electrical_series = self.file[self.electrical_series_path]
+            num_samples = electrical_series["data"].shape[0]
+            if "starting_time" in electrical_series:
+                t_start = float(electrical_series["starting_time"][()])
+                sampling_frequency = float(electrical_series["starting_time"].attrs["rate"])
+                t_stop = t_start + (num_samples - 1) / sampling_frequency
+            else:
+                # as spikeinterface, the sampling frequency is estimated from the first timestamps
+                timestamps = electrical_series["timestamps"]
+                first_timestamps = timestamps[:1000]
+                t_start = float(first_timestamps[0])
+                sampling_frequency = float(1 / np.median(np.diff(first_timestamps)))
+                t_stop = float(timestamps[num_samples - 1])
+            self._timing = dict(
+                t_start=t_start,
+                t_stop=t_stop,
+                sampling_frequency=sampling_frequency,
+                num_samples=num_samples,
+            )
+        return self._timing
+
+
+@contextmanager
+def open_session(data_path):
+    """
+    Context manager returning the session of a data path (opened and closed by the context), or the session itself
+    if a session is given (which is left open).
+    """
+    if isinstance(data_path, NWBSession):
+        yield data_path
+    else:
+        with NWBSession(data_path) as session:
+            yield session
+
+
+def _read_column(dataset):
+    import h5py
+
+    # the strings are decoded at once
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return dataset.asstr()[:].astype(str)
+    return dataset[:]
+
+
 def get_data_path(action):
     """Returns the path to the main.nwb file"""
     return str(_get_data_path(action))
@@ -21,7 +233,7 @@ def get_sample_rate(data_path):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
 
     Returns
@@ -29,8 +241,8 @@ def get_sample_rate(data_path):
     sr: pq.Quantity
         The sampling rate of the recording
     """
-    recording = se.read_nwb_recording(str(data_path), electrical_series_path="acquisition/ElectricalSeries")
-    sr = recording.get_sampling_frequency() * pq.Hz
+    with open_session(data_path) as session:
+        sr = session.sampling_frequency * pq.Hz
     return sr
 
 
@@ -40,7 +252,7 @@ def get_duration(data_path):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
 
     Returns
@@ -48,8 +260,8 @@ def get_duration(data_path):
     duration: pq.Quantity
         The duration of the recording
     """
-    recording = se.read_nwb_recording(str(data_path), electrical_series_path="acquisition/ElectricalSeries")
-    duration = recording.get_total_duration() * pq.s
+    with open_session(data_path) as session:
+        duration = session.num_samples / session.sampling_frequency * pq.s
     return duration
 
 
@@ -77,7 +289,7 @@ def view_active_channels(action, sorter):
         waveforms_folder = sorter_path / "waveforms"
         analyzer = si.load_waveforms(waveforms_folder, output="SortingAnalyzer")
     else:
-        analyzer = si.load_sorting_analyzer(sorter_path / "analyzer")
+        analyzer = si.load_sorting_analyzer(get_analyzer_folder(sorter_path))
     return analyzer.channel_ids
 
 
@@ -87,7 +299,7 @@ def load_leds(data_path):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
 
     Returns
@@ -95,26 +307,214 @@ def load_leds(data_path):
     x1, y1, t1, x2, y2, t2, stop_time: tuple
         The x and y positions of the red and green LEDs, the timestamps and the stop time
     """
-    from pynwb import NWBHDF5IO
+    with open_session(data_path) as session:
+        behavior = session.nwbfile.processing["behavior"]
+
+        # tracking data
+        open_field_position = behavior["Open Field Position"]
+        red_spatial_series = open_field_position["LedRed"]
+        green_spatial_series = open_field_position["LedGreen"]
+        red_data = red_spatial_series.data[:]
+        green_data = green_spatial_series.data[:]
+        x1, y1 = red_data[:, 0], red_data[:, 1]
+        x2, y2 = green_data[:, 0], green_data[:, 1]
+        t1 = red_spatial_series.timestamps[:]
+        t2 = green_spatial_series.timestamps[:]
+        stop_time = np.max([t1[-1], t2[-1]])
 
-    io = NWBHDF5IO(str(data_path), "r")
-    nwbfile = io.read()
+    return x1, y1, t1, x2, y2, t2, stop_time
 
-    behavior = nwbfile.processing["behavior"]
 
-    # tracking data
-    open_field_position = behavior["Open Field Position"]
-    red_spatial_series = open_field_position["LedRed"]
-    green_spatial_series = open_field_position["LedGreen"]
-    red_data = red_spatial_series.data
-    green_data = green_spatial_series.data
-    x1, y1 = red_data[:, 0], red_data[:, 1]
-    x2, y2 = green_data[:, 0], green_data[:, 1]
-    t1 = red_spatial_series.timestamps
-    t2 = green_spatial_series.timestamps
-    stop_time = np.max([t1[-1], t2[-1]])
+class LFPView:
+    """
+    Lazy view of the LFP of an action, backed by the HDF5 dataset of the NWB file.
 
-    return x1, y1, t1, x2, y2, t2, stop_time
+    Time slicing (`time_slice`), channel selection (`select_channels`, `select_group`) and decimation (`decimate`)
+    return new views without reading any data. The traces are only read (the HDF5 chunks of the selected time
+    window) when they are requested with `get_traces` or `to_neo`, so that views of many sessions can be kept
+    in memory.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The LFP recording (e.g. read from the NWB file)
+    electrode_idx : np.ndarray, optional
+        The indices of the channels of the view in the LFP electrical series. By default, all channels
+    start_frame : int, default: 0
+        The first frame of the view
+    end_frame : int, optional
+        The end frame (excluded) of the view. By default, the end of the recording
+    """
+
+    def __init__(self, recording, electrode_idx=None, start_frame=0, end_frame=None):
+        self.recording = recording
+        self.electrode_idx = np.arange(recording.get_num_channels()) if electrode_idx is None else electrode_idx
+        self.start_frame = start_frame
+        self.end_frame = recording.get_num_samples() if end_frame is None else end_frame
+
+    def __repr__(self):
+        return (
+            f"LFPView: {self.num_channels} channels - {self.num_samples} samples - "
+            f"{self.sampling_rate:.1f} Hz - {self.t_start:.2f}-{self.t_stop:.2f} s"
+        )
+
+    @property
+    def sampling_rate(self):
+        return self.recording.sampling_frequency
+
+    @property
+    def num_channels(self):
+        return self.recording.get_num_channels()
+
+    @property
+    def num_samples(self):
+        return self.end_frame - self.start_frame
+
+    @property
+    def shape(self):
+        return (self.num_samples, self.num_channels)
+
+    @property
+    def t_start(self):
+        return float(self.recording.sample_index_to_time(self.start_frame))
+
+    @property
+    def t_stop(self):
+        """The time of the last sample of the view"""
+        return float(self.recording.sample_index_to_time(max(self.end_frame - 1, self.start_frame)))
+
+    def time_slice(self, t_start=None, t_stop=None):
+        """
+        Returns the view of the samples between `t_start` (included) and `t_stop` (excluded), in seconds.
+        """
+        start_frame, end_frame = self.start_frame, self.end_frame
+        if t_start is not None:
+            start_frame = max(start_frame, self._time_to_frame(t_start))
+        if t_stop is not None:
+            end_frame = min(end_frame, self._time_to_frame(t_stop))
+        return LFPView(self.recording, self.electrode_idx, start_frame, max(start_frame, end_frame))
+
+    def select_channels(self, channel_indices):
+        """Returns the view of some channels, given by their indices in the view"""
+        channel_ids = self.recording.channel_ids[channel_indices]
+        return LFPView(
+            self.recording.channel_slice(channel_ids),
+            self.electrode_idx[channel_indices],
+            self.start_frame,
+            self.end_frame,
+        )
+
+    def select_group(self, channel_group):
+        """Returns the view of the channels of a channel group"""
+        channel_groups = self.recording.get_channel_groups()
+        assert (
+            channel_group in channel_groups
+        ), f"Channel group {channel_group} not found in available channel groups: {np.unique(channel_groups)}"
+        return self.select_channels(np.flatnonzero(channel_groups == channel_group))
+
+    def decimate(self, decimation_factor, filter_order=5):
+        """
+        Returns the view decimated by an integer factor.
+
+        The traces are low-pass filtered (zero-phase Butterworth at 40% of the new sampling rate) to avoid aliasing
+        before keeping one sample every `decimation_factor`. The filter is applied to the whole recording (with a
+        margin of 10 periods of the cut-off frequency around the requested samples), so that the time slices
+        of the decimated view have no edge effects.
+
+        Parameters
+        ----------
+        decimation_factor : int
+            The decimation factor
+        filter_order : int, default: 5
+            The order of the anti-aliasing filter
+
+        Returns
+        -------
+        view : LFPView
+            The decimated view
+        """
+        import scipy.signal
+        import spikeinterface.preprocessing as spre
+
+        decimation_factor = int(decimation_factor)
+        if decimation_factor == 1:
+            return self
+        cutoff = 0.4 * self.sampling_rate / decimation_factor
+        sos = scipy.signal.butter(filter_order, cutoff, btype="lowpass", fs=self.sampling_rate, output="sos")
+        recording_lowpass = spre.filter(self.recording, coeff=sos, margin_ms=10 * 1000 / cutoff, dtype="float32")
+        recording_decimated = spre.decimate(recording_lowpass, decimation_factor)
+        start_frame = int(np.ceil(self.start_frame / decimation_factor))
+        end_frame = int(np.ceil(self.end_frame / decimation_factor))
+        return LFPView(recording_decimated, self.electrode_idx, start_frame, end_frame)
+
+    def get_traces(self):
+        """Reads the traces of the view in uV, as a (num_samples, num_channels) float32 array"""
+        traces = self.recording.get_traces(start_frame=self.start_frame, end_frame=self.end_frame, return_scaled=True)
+        return traces.astype("float32", copy=False)
+
+    def to_neo(self, units="mV"):
+        """
+        Reads the traces of the view into a neo.AnalogSignal.
+
+        Parameters
+        ----------
+        units : str, default: "mV"
+            The units of the signal
+
+        Returns
+        -------
+        LFP : neo.AnalogSignal
+            The LFP signal, with the "electrode_idx" annotation
+        """
+        traces = self.get_traces()
+        # the traces are scaled in place, and neo wraps the float32 array without copying it
+        traces *= float((1 * pq.uV).rescale(units).magnitude)
+        return neo.AnalogSignal(
+            traces,
+            units=units,
+            t_start=self.t_start * pq.s,
+            t_stop=self.t_stop * pq.s,
+            sampling_rate=self.sampling_rate * pq.Hz,
+            **{"electrode_idx": self.electrode_idx},
+        )
+
+    def _time_to_frame(self, time):
+        # index of the first sample at or after time
+        frame = int(np.ceil((time - self.recording.sample_index_to_time(0)) * self.sampling_rate - 1e-6))
+        return int(np.clip(frame, 0, self.recording.get_num_samples()))
+
+
+def get_lfp_view(data_path, channel_group=None, lim=None):
+    """
+    Returns a lazy view of the LFP signal (see `LFPView`). No data is read until the traces are requested.
+    The view keeps its own file handle, so that it remains valid when a session is closed.
+
+    Parameters
+    ----------
+    data_path: Path / NWBSession
+        The action data path
+    channel_group: str, optional
+        The channel group of the view. If None, all channel groups are included
+    lim: list, optional
+        The time limits of the view. If None, the entire signal is included
+
+    Returns
+    -------
+    LFP: LFPView
+        The LFP view
+    """
+    if isinstance(data_path, NWBSession):
+        data_path = data_path.data_path
+    recording_lfp = se.read_nwb_recording(
+        str(data_path), electrical_series_path="processing/ecephys/LFP/ElectricalSeriesLFP"
+    )
+    lfp_view = LFPView(recording_lfp)
+    if channel_group is not None:
+        lfp_view = lfp_view.select_group(channel_group)
+    if lim is not None:
+        assert len(lim) == 2, "lim must be a list of two elements with t_start and t_stop"
+        lfp_view = lfp_view.time_slice(*lim)
+    return lfp_view
 
 
 def load_lfp(data_path, channel_group=None, lim=None):
@@ -123,7 +523,7 @@ def load_lfp(data_path, channel_group=None, lim=None):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
     channel_group: str, optional
         The channel group to load. If None, all channel groups are loaded
@@ -135,54 +535,7 @@ def load_lfp(data_path, channel_group=None, lim=None):
     LFP: neo.AnalogSignal
         The LFP signal
     """
-    # from pynwb import NWBHDF5IO
-
-    # get the session start time
-    # TODO: are io and nwbfile needed?
-    # io = NWBHDF5IO(str(data_path), "r")
-    # nwbfile = io.read()
-    recording_lfp = se.read_nwb_recording(
-        str(data_path), electrical_series_path="processing/ecephys/LFP/ElectricalSeriesLFP"
-    )
-    # LFP
-    units = pq.uV
-    sampling_rate = recording_lfp.sampling_frequency * pq.Hz
-
-    if channel_group is not None:
-        available_channel_groups = np.unique(recording_lfp.get_channel_groups())
-        assert (
-            channel_group in recording_lfp.get_channel_groups()
-        ), f"Channel group {channel_group} not found in available channel groups: {available_channel_groups}"
-        # this returns a sub-extractor with the requested channel group
-        recording_lfp_group = recording_lfp.split_by("group")[channel_group]
-        (electrode_idx,) = np.nonzero(np.isin(recording_lfp.channel_ids, recording_lfp_group.channel_ids))
-    else:
-        recording_lfp_group = recording_lfp
-        electrode_idx = np.arange(recording_lfp.get_num_channels())
-
-    if lim is None:
-        lfp_traces = recording_lfp_group.get_traces(return_scaled=True)
-        t_start = recording_lfp.get_times()[0] * pq.s
-        t_stop = recording_lfp.get_times()[-1] * pq.s
-    else:
-        assert len(lim) == 2, "lim must be a list of two elements with t_start and t_stop"
-        times_all = recording_lfp_group.get_times()
-        start_frame, end_frame = np.searchsorted(times_all, lim)
-        times = times_all[start_frame:end_frame]
-        t_start = times[0] * pq.s
-        t_stop = times[-1] * pq.s
-        lfp_traces = recording_lfp_group.get_traces(start_frame=start_frame, end_frame=end_frame, return_scaled=True)
-
-    LFP = neo.AnalogSignal(
-        lfp_traces,
-        units=units,
-        t_start=t_start,
-        t_stop=t_stop,
-        sampling_rate=sampling_rate,
-        **{"electrode_idx": electrode_idx},
-    )
-    LFP = LFP.rescale("mV")
-    return LFP
+    return get_lfp_view(data_path, channel_group=channel_group, lim=lim).to_neo()
 
 
 def load_epochs(data_path, label_column=None):
@@ -191,7 +544,7 @@ def load_epochs(data_path, label_column=None):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
     label_column: str, optional
         The column name to use as labels
@@ -201,11 +554,8 @@ def load_epochs(data_path, label_column=None):
     epochs: neo.Epoch
         The trials as NEO epochs
     """
-    from pynwb import NWBHDF5IO
-
-    with NWBHDF5IO(str(data_path), "r") as io:
-        nwbfile = io.read()
-        trials = nwbfile.trials.to_dataframe()
+    with open_session(data_path) as session:
+        trials = session.nwbfile.trials.to_dataframe()
         start_times = trials["start_time"].values * pq.s
         stop_times = trials["stop_time"].values * pq.s
         durations = stop_times - start_times
@@ -229,7 +579,7 @@ def get_channel_groups(data_path):
 
     Parameters
     ----------
-    data_path: Path
+    data_path: Path / NWBSession
         The action data path
 
     Returns
@@ -237,18 +587,23 @@ def get_channel_groups(data_path):
     channel groups: list
         The channel groups
     """
-    recording = se.read_nwb_recording(str(data_path), electrical_series_path="acquisition/ElectricalSeries")
-    channel_groups = list(np.unique(recording.get_channel_groups()))
+    with open_session(data_path) as session:
+        channel_groups = list(np.unique(session.get_channel_groups()))
     return channel_groups
 
 
-def load_spiketrains(data_path, t_start=None, t_stop=None, channel_group=None, subtract_session_start_time=False):
+def load_spiketrains(
+    data_path, t_start=None, t_stop=None, channel_group=None, subtract_session_start_time=False, properties=None
+):
     """
     Load the spike trains as a list of NEO SpikeTrain objects.
 
+    The spike trains are read from the units table, and their timing (start time, stop time and sampling rate) from
+    the metadata of the raw electrical series (see `NWBSession`), without reading the raw data.
+
     Parameters
     ----------
-    data_path: str / Path
+    data_path: str / Path / NWBSession
         The action data path
     t_start: float, optional
         The start time in seconds. Defaults to the start time of the recording.
@@ -258,97 +613,244 @@ def load_spiketrains(data_path, t_start=None, t_stop=None, channel_group=None, s
         The channel group to load. If None, all channel groups are loaded
     subtract_session_start_time: bool, optional
         Whether to subtract the session start time from the spike times.
-        If `True`, the start time of the recording will be 0.
+        If `True`, the spike times and the start and stop times of the spike trains are shifted by the session start
+        time, so that the recording starts at 0, and `t_start` and `t_stop` are relative to the session start
+    properties: list, optional
+        The unit properties to load as annotations (the "name" annotation is always added).
+        If None, all properties are loaded
 
     Returns
     -------
     spiketrains: list of NEO SpikeTrain objects
         The spike trains
     """
-
-    recording, sorting = se.read_nwb(
-        str(data_path), load_recording=True, load_sorting=True, electrical_series_path="acquisition/ElectricalSeries"
+    spike_train_store = load_spike_times(
+        data_path,
+        t_start=t_start,
+        t_stop=t_stop,
+        channel_group=channel_group,
+        subtract_session_start_time=subtract_session_start_time,
+        properties=properties,
     )
+    return spike_train_store.to_neo()
 
-    times = recording.get_times()
 
-    if subtract_session_start_time:
-        times -= times[0]
+class SpikeTrainStore:
+    """
+    Columnar store of the spike trains of the units of an action.
 
-    t_start = t_start if t_start is not None else times[0]
-    t_stop = t_stop if t_stop is not None else times[-1]
+    The spike times of all units are stored in one concatenated array (sorted by unit), with the offsets of the
+    units, and the unit properties in a table. Unit (`select_units`, `select_group`) and time (`time_slice`)
+    selections are vectorized over all units, and the NEO SpikeTrain objects are only built on demand (`to_neo`).
 
-    if channel_group is None:
-        unit_ids = sorting.unit_ids
-    else:
-        assert "group" in sorting.get_property_keys(), "group property not found in sorting"
-        groups = sorting.get_property("group")
-        unit_ids = [
-            unit_id for unit_index, unit_id in enumerate(sorting.unit_ids) if groups[unit_index] == channel_group
-        ]
-
-    sptr = []
-    # build neo objects
-    for unit in unit_ids:
-        spike_times = sorting.get_unit_spike_train(unit, return_times=True)
-
-        if subtract_session_start_time:
-            spike_times -= times[0]
-
-        mask = (spike_times >= t_start) & (spike_times <= t_stop)
-        spike_times = spike_times[mask]
-
-        st = neo.SpikeTrain(
-            times=spike_times * pq.s,
-            t_start=t_start * pq.s,
-            t_stop=t_stop * pq.s,
-            sampling_rate=sorting.sampling_frequency * pq.Hz,
+    Parameters
+    ----------
+    spike_times: np.ndarray
+        The concatenated spike times of the units in seconds (float64)
+    offsets: np.ndarray
+        The offsets of the units in `spike_times` (num_units + 1): the spike times of unit i are
+        ``spike_times[offsets[i]:offsets[i + 1]]``
+    properties: pd.DataFrame
+        The unit properties (one row per unit), with the unit ids in the "name" column
+    t_start: float
+        The start time of the spike trains in seconds
+    t_stop: float
+        The stop time of the spike trains in seconds
+    sampling_rate: float
+        The sampling rate of the spike times
+    """
+
+    def __init__(self, spike_times, offsets, properties, t_start, t_stop, sampling_rate):
+        assert len(offsets) == len(properties) + 1, "'offsets' must have one more element than the number of units"
+        self.spike_times = spike_times
+        self.offsets = offsets
+        self.properties = properties
+        self.t_start = t_start
+        self.t_stop = t_stop
+        self.sampling_rate = sampling_rate
+
+    def __repr__(self):
+        return f"SpikeTrainStore: {self.num_units} units - {len(self.spike_times)} spikes"
+
+    def __len__(self):
+        return self.num_units
+
+    @property
+    def num_units(self):
+        return len(self.properties)
+
+    @property
+    def unit_ids(self):
+        return self.properties["name"].values
+
+    def get_num_spikes(self):
+        """Returns the number of spikes of each unit"""
+        return np.diff(self.offsets)
+
+    def get_unit_spike_times(self, unit_index):
+        """Returns the spike times of a unit, given by its index in the store"""
+        return self.spike_times[self.offsets[unit_index] : self.offsets[unit_index + 1]]
+
+    def select_units(self, unit_indices):
+        """
+        Returns the store of some units.
+
+        Parameters
+        ----------
+        unit_indices: array-like
+            The indices of the units in the store, or a boolean mask of the units
+
+        Returns
+        -------
+        spike_train_store: SpikeTrainStore
+            The store of the selected units
+        """
+        unit_indices = np.arange(self.num_units)[unit_indices]
+        num_spikes = self.get_num_spikes()[unit_indices]
+        offsets = np.concatenate([[0], np.cumsum(num_spikes)])
+        # index of each selected spike in the concatenated spike times
+        spike_indices = np.repeat(self.offsets[unit_indices] - offsets[:-1], num_spikes) + np.arange(offsets[-1])
+        return SpikeTrainStore(
+            self.spike_times[spike_indices],
+            offsets,
+            self.properties.iloc[unit_indices].reset_index(drop=True),
+            self.t_start,
+            self.t_stop,
+            self.sampling_rate,
         )
 
-        st.annotations.update({"name": unit})
-        for p in sorting.get_property_keys():
-            st.annotations.update({p: sorting.get_unit_property(unit, p)})
+    def select_group(self, channel_group):
+        """Returns the store of the units of a channel group"""
+        assert "group" in self.properties, "group property not found in sorting"
+        return self.select_units(self.properties["group"].values == channel_group)
+
+    def time_slice(self, t_start=None, t_stop=None):
+        """Returns the store of the spikes between `t_start` and `t_stop` (both included), in seconds"""
+        t_start = self.t_start if t_start is None else t_start
+        t_stop = self.t_stop if t_stop is None else t_stop
+        mask = (self.spike_times >= t_start) & (self.spike_times <= t_stop)
+        # the offsets are shifted by the number of removed spikes before them
+        removed_indices = np.flatnonzero(~mask)
+        offsets = self.offsets - np.searchsorted(removed_indices, self.offsets)
+        return SpikeTrainStore(
+            self.spike_times[mask], offsets, self.properties, float(t_start), float(t_stop), self.sampling_rate
+        )
 
-        sptr.append(st)
+    def to_neo(self, unit_indices=None):
+        """
+        Builds the NEO SpikeTrain objects of the units, with the unit properties as annotations.
+
+        Parameters
+        ----------
+        unit_indices: array-like, optional
+            The indices of the units in the store. By default, all units
+
+        Returns
+        -------
+        spiketrains: list of NEO SpikeTrain objects
+            The spike trains
+        """
+        unit_indices = np.arange(self.num_units) if unit_indices is None else np.arange(self.num_units)[unit_indices]
+        # the annotations are built from the property columns, rather than looked up unit by unit
+        columns = [self.properties[name].values[unit_indices] for name in self.properties.columns]
+        unit_annotations = [dict(zip(self.properties.columns, unit_values)) for unit_values in zip(*columns)]
+        sptr = []
+        for unit_index, annotations in zip(unit_indices, unit_annotations):
+            st = neo.SpikeTrain(
+                times=self.get_unit_spike_times(unit_index) * pq.s,
+                t_start=self.t_start * pq.s,
+                t_stop=self.t_stop * pq.s,
+                sampling_rate=self.sampling_rate * pq.Hz,
+            )
+            st.annotations.update(annotations)
+            sptr.append(st)
+        return sptr
+
+
+def load_spike_times(
+    data_path, t_start=None, t_stop=None, channel_group=None, subtract_session_start_time=False, properties=None
+):
+    """
+    Load the spike times and the properties of the units in a `SpikeTrainStore`, without building the NEO objects
+    (see `load_spiketrains` for the parameters).
 
-    return sptr
+    Returns
+    -------
+    spike_train_store: SpikeTrainStore
+        The spike trains
+    """
+    import pandas as pd
+
+    with open_session(data_path) as session:
+        sampling_frequency = session.sampling_frequency
+        session_start_time = session.t_start
+        session_stop_time = session.t_stop
+        unit_ids = session.get_unit_ids()
+        unit_properties = session.get_unit_properties(properties)
+        unit_indices = _get_unit_indices(session, unit_ids, channel_group)
+        spike_times, spike_times_index = session.get_spike_times()
+
+    # the spike times are aligned to the samples of the recording, as spikeinterface does
+    spike_frames = np.round((spike_times - session_start_time) * sampling_frequency)
+    spike_times = session_start_time + spike_frames / sampling_frequency
+    if subtract_session_start_time:
+        spike_times -= session_start_time
+        session_stop_time -= session_start_time
+        session_start_time = 0.0
+
+    properties = {"name": unit_ids}
+    for name, values in unit_properties.items():
+        # multi-dimensional properties (e.g. the waveforms) are stored as one array per unit
+        properties[name] = list(values) if values.ndim > 1 else values
+    spike_train_store = SpikeTrainStore(
+        spike_times,
+        np.concatenate([[0], spike_times_index]),
+        pd.DataFrame(properties),
+        session_start_time,
+        session_stop_time,
+        sampling_frequency,
+    )
+
+    if channel_group is not None:
+        spike_train_store = spike_train_store.select_units(unit_indices)
+    return spike_train_store.time_slice(t_start, t_stop)
 
 
-def load_unit_annotations(data_path, channel_group=None):
+def load_unit_annotations(data_path, channel_group=None, properties=None):
     """
     Returns the annotations of the units
 
     Parameters
     ----------
-    data_path: str/Path
+    data_path: str/Path/NWBSession
         The action data path
     channel_group: str, optional
         The channel group to load. If None, all channel groups are loaded
+    properties: list, optional
+        The unit properties to load (the "name" annotation is always added). If None, all properties are loaded
 
     Returns
     -------
     annotations: list of dicts
         The annotations of the units
     """
-    sorting = se.read_nwb_sorting(str(data_path), electrical_series_path="acquisition/ElectricalSeries")
+    with open_session(data_path) as session:
+        unit_ids = session.get_unit_ids()
+        unit_properties = session.get_unit_properties(properties)
+        unit_indices = _get_unit_indices(session, unit_ids, channel_group)
+
+    columns = {"name": unit_ids[unit_indices]}
+    columns.update({name: values[unit_indices] for name, values in unit_properties.items()})
+    units = [dict(zip(columns, unit_values)) for unit_values in zip(*columns.values())]
+    return units
 
-    units = []
 
+def _get_unit_indices(session, unit_ids, channel_group=None):
+    # indices of the units of a channel group (or of all units)
     if channel_group is None:
-        unit_ids = sorting.unit_ids
-    else:
-        assert "group" in sorting.get_property_keys(), "group property not found in sorting"
-        groups = sorting.get_property("group")
-        unit_ids = [
-            unit_id for unit_index, unit_id in enumerate(sorting.unit_ids) if groups[unit_index] == channel_group
-        ]
-
-    for unit in unit_ids:
-        annotations = {"name": unit}
-        for p in sorting.get_property_keys():
-            annotations.update({p: sorting.get_unit_property(unit, p)})
-        units.append(annotations)
-    return units
+        return np.arange(len(unit_ids))
+    assert "group" in session.get_unit_property_names(), "group property not found in sorting"
+    return np.flatnonzero(session.get_unit_properties(["group"])["group"] == channel_group)
 
 
 # These functions are not relevant anymore
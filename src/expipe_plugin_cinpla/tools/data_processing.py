@@ -2,18 +2,20 @@
 # This is work in progress,
 import pathlib
 import warnings
+from collections import OrderedDict
 
 import expipe
 import numpy as np
 import spatial_maps as sp
 
+from expipe_plugin_cinpla.tools.cache import NWBDataCache, get_default_cache_folder
 from expipe_plugin_cinpla.tools.data_loader import (
     get_channel_groups,
     get_duration,
+    get_lfp_view,
     load_epochs,
     load_leds,
-    load_lfp,
-    load_spiketrains,
+    load_spike_times,
 )
 
 
@@ -238,8 +240,25 @@ class Template:
 
 
 class DataProcessor:
-    def __init__(self, project, stim_mask=False, baseline_duration=None, stim_channels=None, **kwargs):
+    def __init__(
+        self,
+        project,
+        stim_mask=False,
+        baseline_duration=None,
+        stim_channels=None,
+        cache=False,
+        max_actions=None,
+        **kwargs,
+    ):
         self._project_path = project.path
+        # with cache, the data loaded from the NWB files are cached on disk, so that they are not reloaded in new
+        # sessions: True uses the per-user cache folder, a path uses the given folder
+        if cache is True:
+            self._cache = NWBDataCache(get_default_cache_folder())
+        elif cache:
+            self._cache = NWBDataCache(cache)
+        else:
+            self._cache = None
         self.params = kwargs  # TODO: remove this
         self._project = expipe.get_project(self.project_path)
         self._actions = self.project.actions
@@ -251,6 +270,7 @@ class DataProcessor:
         self._tracking = {}
         self._head_direction = {}
         self._lfp = {}
+        self._lfp_views = {}
         self._occupancy = {}
         self._rate_maps = {}
         self._tracking_split = {}
@@ -261,6 +281,10 @@ class DataProcessor:
         self.baseline_duration = baseline_duration
         self._channel_groups = {}
         self.stim_channels = stim_channels
+        # the data of at most `max_actions` actions are kept in memory (the least recently used are removed)
+        assert max_actions is None or max_actions >= 1, "'max_actions' must be None or at least 1"
+        self.max_actions = max_actions
+        self._resident_actions = OrderedDict()
 
     @property
     def project(self):
@@ -279,30 +303,79 @@ class DataProcessor:
         return self._entities
 
     def channel_groups(self, action_id):
+        self._touch(action_id)
         if action_id not in self._channel_groups:
-            self._channel_groups[action_id] = get_channel_groups(self.data_path(action_id))
+            self._channel_groups[action_id] = self._load(get_channel_groups, action_id)
         return self._channel_groups[action_id]
 
     def data_path(self, action_id):
         return pathlib.Path(self.project_path) / "actions" / action_id / "data" / "main.nwb"
 
+    def clear_cache(self, action_id=None):
+        """Removes the on-disk cache of the data of an action (or of all actions)"""
+        if self._cache is not None:
+            self._cache.clear(None if action_id is None else self.data_path(action_id))
+
+    def invalidate(self, action_id=None):
+        """Removes the data of an action (or of all actions) loaded in memory, so that they are reloaded"""
+        action_caches = [
+            self._spike_trains,
+            self._templates,
+            self._stim_times,
+            self._unit_names,
+            self._tracking,
+            self._head_direction,
+            self._lfp,
+            self._lfp_views,
+            self._occupancy,
+            self._rate_maps,
+            self._tracking_split,
+            self._rate_maps_split,
+            self._prob_dist,
+            self._channel_groups,
+        ]
+        for action_cache in action_caches:
+            if action_id is None:
+                action_cache.clear()
+            else:
+                action_cache.pop(action_id, None)
+        if action_id is None:
+            self._resident_actions.clear()
+        else:
+            self._resident_actions.pop(action_id, None)
+
+    def _touch(self, action_id):
+        # marks the action as the most recently used one and removes the data of the least recently used ones
+        self._resident_actions[action_id] = None
+        self._resident_actions.move_to_end(action_id)
+        if self.max_actions is not None:
+            while len(self._resident_actions) > self.max_actions:
+                self.invalidate(next(iter(self._resident_actions)))
+
+    def _load(self, loader, action_id, *args, **kwargs):
+        if self._cache is None:
+            return loader(self.data_path(action_id), *args, **kwargs)
+        return self._cache.load(loader, self.data_path(action_id), *args, **kwargs)
+
     def get_lim(self, action_id):
         stim_times = self.stim_times(action_id)
         if stim_times is None:
             if self.baseline_duration is None:
-                return [0, float(get_duration(self.data_path(action_id)).magnitude)]
+                return [0, float(self.duration(action_id).magnitude)]
             else:
                 return [0, float(self.baseline_duration)]
         stim_times = np.array(stim_times)
         return [stim_times.min(), stim_times.max()]
 
     def duration(self, action_id):
-        return get_duration(self.data_path(action_id))
+        return self._load(get_duration, action_id)
 
     def tracking(self, action_id):
+        self._touch(action_id)
         if action_id not in self._tracking:
-            x, y, t, speed = load_tracking(
-                self.data_path(action_id),
+            x, y, t, speed = self._load(
+                load_tracking,
+                action_id,
                 low_pass_frequency=self.params["position_low_pass_frequency"],
                 box_size=self.params["box_size"],
             )
@@ -454,6 +527,7 @@ class DataProcessor:
         return self._rate_maps[action_id][channel_group][unit_name][smoothing]
 
     def head_direction(self, action_id):
+        self._touch(action_id)
         if action_id not in self._head_direction:
             a, t = load_head_direction(
                 self.data_path(action_id),
@@ -469,14 +543,28 @@ class DataProcessor:
             self._head_direction[action_id] = {"a": a, "t": t}
         return self._head_direction[action_id]
 
+    def lfp_view(self, action_id, channel_group=None):
+        """
+        Returns a lazy view of the LFP (see `data_loader.LFPView`), which only reads the traces when they are
+        requested (e.g. `lfp_view(...).time_slice(t1, t2).decimate(4).to_neo()`).
+        """
+        self._touch(action_id)
+        if action_id not in self._lfp_views:
+            lim = self.get_lim(action_id) if self.stim_mask else None
+            self._lfp_views[action_id] = get_lfp_view(self.data_path(action_id), lim=lim)
+        lfp_view = self._lfp_views[action_id]
+        if channel_group is not None:
+            lfp_view = lfp_view.select_group(channel_group)
+        return lfp_view
+
     def lfp(self, action_id, channel_group, clean_memory=False):
-        lim = self.get_lim(action_id) if self.stim_mask else None
+        self._touch(action_id)
         if clean_memory:
-            return load_lfp(self.data_path(action_id), channel_group, lim)
+            return self.lfp_view(action_id, channel_group).to_neo()
         if action_id not in self._lfp:
             self._lfp[action_id] = {}
         if channel_group not in self._lfp[action_id]:
-            self._lfp[action_id][channel_group] = load_lfp(self.data_path(action_id), channel_group, lim)
+            self._lfp[action_id][channel_group] = self.lfp_view(action_id, channel_group).to_neo()
         return self._lfp[action_id][channel_group]
 
     def template(self, action_id, channel_group, unit_id):
@@ -488,16 +576,19 @@ class DataProcessor:
         return self._spike_trains[action_id][channel_group][unit_id]
 
     def spike_trains(self, action_id, channel_group=None):
+        self._touch(action_id)
         if action_id not in self._spike_trains:
-            self._spike_trains[action_id] = {}
-        lim = self.get_lim(action_id) if self.stim_mask else None
-
-        sts = load_spiketrains(self.data_path(action_id), lim=lim)
-        for st in sts:
-            group = st.annotations["group"]
-            if group not in self._spike_trains[action_id]:
-                self._spike_trains[action_id][group] = {}
-            self._spike_trains[action_id][group][int(get_unit_id(st))] = st
+            t_start, t_stop = self.get_lim(action_id) if self.stim_mask else (None, None)
+
+            # the spike train store is cached rather than the neo objects, which do not support pickling with annotations
+            sts = self._load(load_spike_times, action_id, t_start=t_start, t_stop=t_stop).to_neo()
+            spike_trains = {}
+            for st in sts:
+                group = st.annotations["group"]
+                if group not in spike_trains:
+                    spike_trains[group] = {}
+                spike_trains[group][int(get_unit_id(st))] = st
+            self._spike_trains[action_id] = spike_trains
         if channel_group is None:
             return self._spike_trains[action_id]
         else:
@@ -510,9 +601,10 @@ class DataProcessor:
         return [u["name"] for u in units]
 
     def stim_times(self, action_id):
+        self._touch(action_id)
         if action_id not in self._stim_times:
             try:
-                trials = load_epochs(self.data_path(action_id), label_column="channel")
+                trials = self._load(load_epochs, action_id, label_column="channel")
                 if len(set(trials.labels)) > 1:
                     stim_times = trials.times[trials.labels == self.stim_channels[action_id]]
                 else:
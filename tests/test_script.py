@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from pathlib import Path
 
 import pytest
 
@@ -70,6 +71,68 @@ def test_register_openephys():
     assert "008-081222-2" in project.actions
 
 
+@pytest.mark.dependency(depends=["test_register_openephys"])
+def test_save_fused(tmp_path):
+    import numpy as np
+    import spikeinterface.extractors as se
+    import spikeinterface.preprocessing as spre
+
+    from expipe_plugin_cinpla.scripts.preprocessing import save_fused, scale_to_int16
+    from expipe_plugin_cinpla.scripts.storage import benchmark_storage
+
+    project = pytest.PROJECT
+    nwbfile_path = project.actions["008-081222-2"].path / "data" / "main.nwb"
+    recording = se.read_nwb_recording(nwbfile_path, electrical_series_path="acquisition/ElectricalSeries")
+    recordings = dict(
+        cmr=spre.common_reference(spre.bandpass_filter(recording, freq_min=300, freq_max=3000), operator="median"),
+        lfp=spre.resample(spre.bandpass_filter(recording, freq_min=1, freq_max=300), 1000),
+        mua=spre.resample(spre.rectify(recording), 1000),
+    )
+    outputs = {name: dict(recording=rec, folder=tmp_path / name) for name, rec in recordings.items()}
+    saved = save_fused(recording, outputs, n_jobs=1, chunk_duration="0.5s")
+    for name, rec in recordings.items():
+        # same result as saving each output separately (with the same chunks)
+        rec_saved = rec.save(folder=tmp_path / f"{name}_separate", n_jobs=1, chunk_duration="0.5s")
+        np.testing.assert_array_equal(saved[name].get_traces(), rec_saved.get_traces())
+        assert np.array_equal(saved[name].get_channel_groups(), rec.get_channel_groups())
+        # same metadata files as recording.save
+        _assert_same_saved_metadata(tmp_path / name, tmp_path / f"{name}_separate")
+
+    # compressed zarr output, chunked by tetrode
+    outputs = dict(cmr=dict(recording=recordings["cmr"], folder=tmp_path / "cmr.zarr", format="zarr"))
+    saved_zarr = save_fused(recording, outputs, n_jobs=1, chunk_duration="0.5s")["cmr"]
+    np.testing.assert_array_equal(saved_zarr.get_traces(), saved["cmr"].get_traces())
+    assert np.array_equal(saved_zarr.get_channel_groups(), recordings["cmr"].get_channel_groups())
+    assert saved_zarr._root["traces_seg0"].chunks == (int(0.5 * recording.sampling_frequency), 4)
+    recordings["cmr"].save(format="zarr", folder=tmp_path / "cmr_separate.zarr", n_jobs=1, chunk_duration="0.5s")
+    _assert_same_saved_metadata(tmp_path / "cmr.zarr", tmp_path / "cmr_separate.zarr")
+
+    # float traces stored as int16 with a per-channel gain
+    lfp_float = spre.astype(saved["lfp"], "float32")
+    lfp_int16 = scale_to_int16(lfp_float)
+    assert lfp_int16.get_dtype() == np.int16
+    error = np.abs(lfp_int16.get_traces(return_scaled=True) - lfp_float.get_traces(return_scaled=True))
+    assert np.all(error <= lfp_int16.get_channel_gains() / 2 + 1e-3)
+
+    benchmark = benchmark_storage(recordings["cmr"], tmp_path / "benchmark", num_reads=2, n_jobs=1)
+    assert benchmark["zarr"]["size_mb"] < benchmark["binary"]["size_mb"]
+
+
+def _assert_same_saved_metadata(folder, folder_separate):
+    import numpy as np
+    import spikeinterface as si
+
+    assert {path.name for path in folder.iterdir()} == {path.name for path in folder_separate.iterdir()}
+    saved, saved_separate = si.load_extractor(folder), si.load_extractor(folder_separate)
+    assert type(saved) is type(saved_separate)
+    assert saved.get_annotation_keys() == saved_separate.get_annotation_keys()
+    assert sorted(saved.get_property_keys()) == sorted(saved_separate.get_property_keys())
+    for key in saved.get_property_keys():
+        np.testing.assert_array_equal(saved.get_property(key), saved_separate.get_property(key))
+    for segment_index in range(saved.get_num_segments()):
+        assert saved.get_time_info(segment_index) == saved_separate.get_time_info(segment_index)
+
+
 @pytest.mark.dependency(depends=["test_register_openephys"])
 def test_process():
     import pynwb
@@ -117,10 +180,251 @@ def test_process():
     with pynwb.NWBHDF5IO(str(nwbfile_path), "r") as io:
         nwbfile = io.read()
         assert f"RawUnits-{sorter}" in nwbfile.processing["ecephys"].data_interfaces
+        raw_units = nwbfile.processing["ecephys"].data_interfaces[f"RawUnits-{sorter}"]
+        assert raw_units["spike_times"].target.data.compression == "gzip"
+        assert raw_units["waveform_mean"].data.chunks[0] == min(64, len(raw_units))
+        lfp_data = nwbfile.processing["ecephys"]["LFP"]["ElectricalSeriesLFP"].data
+        assert lfp_data.compression == "gzip"
+        assert lfp_data.chunks == (min(10000, lfp_data.shape[0]), lfp_data.shape[1])
+
+
+@pytest.mark.dependency(depends=["test_process"])
+def test_process_resume():
+    import json
+
+    from expipe_plugin_cinpla.scripts.profiling import collect_profiles
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    sorter = "mountainsort5"
+    checkpoint_file = project.actions[action_id].path / "data" / "spikeinterface" / sorter / "checkpoints.json"
+    assert checkpoint_file.is_file()
+    checkpoints = json.loads(checkpoint_file.read_text())
+    assert list(checkpoints) == [
+        "preprocess",
+        "lfp",
+        "mua",
+        "cache",
+        "sort",
+        "analyzer",
+        "postprocess",
+        "qc",
+        "phy",
+        "nwb",
+    ]
+    # the intermediate outputs of the preprocessing are removed after writing to NWB
+    assert not (checkpoint_file.parent / "recording_cmr").exists()
+    assert not (checkpoint_file.parent / "processed_tmp").exists()
+    sorting_report = json.loads((checkpoint_file.parent / "sorting_report.json").read_text())
+    assert all(group_report["status"] == "completed" for group_report in sorting_report["groups"].values())
+    profiles = collect_profiles(project, sorter=sorter, action_ids=[action_id])
+    assert {"preprocess", "sort", "postprocess/waveforms", "qc", "phy", "nwb"} <= set(profiles["name"])
+
+    # same parameters as test_process: all stages are skipped
+    process_ecephys(
+        project,
+        action_id,
+        sorter,
+        reference="cmr",
+        split="half",
+        compute_mua=True,
+        metric_names=["firing_rate", "presence_ratio", "isi_violation"],
+        n_components=2,
+    )
+    assert json.loads(checkpoint_file.read_text()) == checkpoints
+
+
+def test_spikeinterface_private_api():
+    # scripts.extensions relies on private functions of spikeinterface, which can change without deprecation
+    import spikeinterface as si
+    from spikeinterface.core import sortinganalyzer
+
+    sorted_extensions = sortinganalyzer._sort_extensions_by_dependency({"templates": {}, "random_spikes": {}})
+    assert list(sorted_extensions) == ["random_spikes", "templates"]
+    assert "templates" in sortinganalyzer._get_children_dependencies("random_spikes")
+    recording, sorting = si.generate_ground_truth_recording(durations=[1.0], num_channels=4, num_units=2, seed=0)
+    sorting_analyzer = si.create_sorting_analyzer(sorting, recording, sparse=False)
+    extension = sorting_analyzer.compute("random_spikes")
+    assert callable(extension._get_binary_extension_folder)
+
+
+@pytest.mark.dependency(depends=["test_process"])
+def test_compute_extensions():
+    import numpy as np
+    import spikeinterface as si
+
+    from expipe_plugin_cinpla.scripts.extensions import (
+        compute_extensions,
+        get_extension_list,
+    )
+
+    project = pytest.PROJECT
+    analyzer_folder = project.actions["008-081222-2"].path / "data" / "spikeinterface" / "mountainsort5" / "analyzer"
+    sorting_analyzer = si.load_sorting_analyzer(analyzer_folder).save_as(format="memory")
+    sorting_analyzer.set_temporary_recording(si.load_extractor(analyzer_folder.parent / "preprocessed.json"))
+
+    plan = compute_extensions(sorting_analyzer, get_extension_list(n_components=2))
+    assert set(plan.values()) == {"reused"}
+    # only the principal components depend on n_components
+    plan = compute_extensions(sorting_analyzer, get_extension_list(n_components=3))
+    assert [name for name, status in plan.items() if status == "computed"] == ["principal_components"]
+
+    # split the first unit: the extensions of the other units are carried over
+    sorting = sorting_analyzer.sorting
+    spike_train = sorting.get_unit_spike_train(sorting.unit_ids[0])
+    units_dict = {f"{unit_id}_curated": sorting.get_unit_spike_train(unit_id) for unit_id in sorting.unit_ids[1:]}
+    units_dict.update(split0=spike_train[::2], split1=spike_train[1::2])
+    curated_sorting = si.NumpySorting.from_unit_dict(units_dict, sorting.sampling_frequency)
+    curated_sorting.set_property(
+        "group", list(sorting.get_property("group")[1:]) + [sorting.get_property("group")[0]] * 2
+    )
+    curated_analyzer = si.create_sorting_analyzer(
+        curated_sorting, sorting_analyzer.recording, sparse=True, method="by_property", by_property="group"
+    )
+    plan = compute_extensions(curated_analyzer, get_extension_list(n_components=3), source_analyzer=sorting_analyzer)
+    assert plan["waveforms"] == "carried over"
+    assert plan["spike_amplitudes"] == "carried over"
+    for unit_id in sorting.unit_ids[1:]:
+        np.testing.assert_array_equal(
+            curated_analyzer.get_extension("templates").get_unit_template(f"{unit_id}_curated"),
+            sorting_analyzer.get_extension("templates").get_unit_template(unit_id),
+        )
+
+
+@pytest.mark.dependency(depends=["test_process"])
+def test_load_lfp():
+    import numpy as np
+    import quantities as pq
+
+    from expipe_plugin_cinpla.tools.data_loader import get_lfp_view, load_lfp
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    data_path = project.actions[action_id].path / "data" / "main.nwb"
+
+    lfp = load_lfp(data_path)
+    lfp_view = get_lfp_view(data_path)
+    assert lfp_view.shape == lfp.shape
+    assert lfp.units == pq.mV
+
+    channel_group = lfp_view.recording.get_channel_groups()[0]
+    t_start = lfp_view.t_start + 0.2
+    lfp_window = load_lfp(data_path, channel_group=channel_group, lim=[t_start, t_start + 0.5])
+    lfp_group = lfp[:, lfp_window.annotations["electrode_idx"]]
+    first_frame = int(np.searchsorted(lfp.times.magnitude, t_start))
+    np.testing.assert_allclose(lfp_window.magnitude, lfp_group.magnitude[first_frame : first_frame + 500])
+
+    lfp_decimated = lfp_view.decimate(4)
+    assert lfp_decimated.sampling_rate == lfp_view.sampling_rate / 4
+    # the decimated view keeps the samples whose index is a multiple of the decimation factor
+    assert lfp_decimated.num_samples == int(np.ceil(lfp_view.num_samples / 4))
+    # the decimated windows are filtered with a margin, like the entire signal
+    traces_window = lfp_decimated.time_slice(t_start, t_start + 0.5).get_traces()
+    np.testing.assert_allclose(traces_window, lfp_decimated.get_traces()[50:175], atol=1e-3)
+
+
+@pytest.mark.dependency(depends=["test_process_resume"])
+def test_process_many(tmp_path):
+    from expipe_plugin_cinpla.scripts.process import process_many
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    report_path = tmp_path / "report.json"
+    start = datetime.now().replace(microsecond=0)
+    # the action is already processed: resume=False reprocesses it
+    report = process_many(
+        project,
+        [action_id],
+        "mountainsort5",
+        n_jobs=2,
+        report_path=report_path,
+        reference="cmr",
+        split="half",
+        compute_mua=True,
+        metric_names=["firing_rate", "presence_ratio", "isi_violation"],
+        n_components=2,
+        resume=False,
+        overwrite=True,
+    )
+    assert report_path.is_file()
+    assert report["n_jobs_per_action"] == 2
+    assert report["actions"][action_id]["status"] == "completed"
+    assert (tmp_path / "report" / f"{action_id}.log").is_file()
+    _assert_stages_ran(project, action_id, "mountainsort5", start)
+
+
+def _assert_stages_ran(project, action_id, sorter, start):
+    import json
+
+    profile_file = project.actions[action_id].path / "data" / "spikeinterface" / sorter / "profile.json"
+    profile = json.loads(profile_file.read_text())
+    assert datetime.fromisoformat(profile["start"]) >= start
+    stage_names = [stage_profile["name"] for stage_profile in profile["stages"]]
+    assert {"preprocess", "sort", "postprocess/waveforms", "qc", "phy", "nwb"} <= set(stage_names)
+    assert all(stage_profile["status"] == "completed" for stage_profile in profile["stages"])
+
+
+fake_sbatch = """#!/bin/bash
+# runs all tasks of the array job locally and prints a job id, like "sbatch --parsable"
+job_script="${@: -1}"
+last_task=$(grep -oP "#SBATCH --array=0-\\K[0-9]+" "$job_script")
+log_folder=$(grep -oP "#SBATCH --output=\\K.*(?=/task-%a.log)" "$job_script")
+for task in $(seq 0 "$last_task"); do
+    SLURM_ARRAY_TASK_ID=$task SLURM_JOB_ID=1234 bash "$job_script" > "$log_folder/task-$task.log" 2>&1
+done
+echo 1234
+"""
+
+
+@pytest.mark.dependency(depends=["test_process_resume"])
+def test_process_slurm(tmp_path):
+    from expipe_plugin_cinpla.scripts.slurm import (
+        collect_slurm_report,
+        prepare_slurm_run,
+        submit_slurm_job,
+    )
+
+    project = pytest.PROJECT
+    sbatch = tmp_path / "sbatch"
+    sbatch.write_text(fake_sbatch)
+    sbatch.chmod(0o755)
+
+    process_kwargs = dict(
+        reference="cmr",
+        split="half",
+        compute_mua=True,
+        metric_names=["firing_rate", "presence_ratio", "isi_violation"],
+        n_components=2,
+        resume=False,
+        overwrite=True,
+    )
+    start = datetime.now().replace(microsecond=0)
+    run_folder = prepare_slurm_run(
+        project,
+        ["008-081222-2", "non-existing-action"],
+        "mountainsort5",
+        process_kwargs=process_kwargs,
+        run_folder=tmp_path / "run",
+        cpus_per_task=2,
+    )
+    assert "#SBATCH --array=0-1" in (run_folder / "job.sh").read_text()
+    job_id = submit_slurm_job(run_folder, sbatch=str(sbatch))
+    assert job_id == "1234"
+
+    report = collect_slurm_report(run_folder)
+    assert report["job_id"] == "1234"
+    assert report["actions"]["008-081222-2"]["status"] == "completed"
+    assert report["actions"]["008-081222-2"]["exit_code"] == 0
+    assert report["actions"]["non-existing-action"]["status"] == "failed"
+    assert report["actions"]["non-existing-action"]["exit_code"] == 1
+    assert (run_folder / "report.json").is_file()
+    _assert_stages_ran(project, "008-081222-2", "mountainsort5", start)
 
 
 @pytest.mark.dependency(depends=["test_process"])
 def test_curate():
+    import json
+
     import spikeinterface.extractors as se
 
     project = pytest.PROJECT
@@ -137,14 +441,358 @@ def test_curate():
         electrical_series_path="acquisition/ElectricalSeries",
     )
     assert len(sorting_curated.unit_ids) <= len(sorting_raw.unit_ids)
+    curation_log = json.loads((curator.si_path / sorter / "curation_log.json").read_text())
+    assert curation_log["summary"]["unchanged"] == len(sorting_curated.unit_ids)
+    assert curation_log["summary"]["removed"] == len(sorting_raw.unit_ids) - len(sorting_curated.unit_ids)
+
+
+@pytest.mark.dependency(depends=["test_curate"])
+def test_data_processor_cache():
+    import os
+
+    import numpy as np
+
+    from expipe_plugin_cinpla.tools.data_processing import DataProcessor
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    cache_folder = pytest.PROJECT_PATH / ".cache"
+    assert DataProcessor(project)._cache is None
+    data_processor = DataProcessor(project, cache=cache_folder)
+    spike_trains = data_processor.spike_trains(action_id)
+    assert len(list(cache_folder.rglob("load_spike_times-*.pkl"))) == 1
+    # the spike trains are loaded once and kept in memory until they are invalidated
+    assert data_processor.spike_trains(action_id) is spike_trains
+    data_processor.invalidate(action_id)
+    assert data_processor.spike_trains(action_id) is not spike_trains
+
+    spike_trains_cached = DataProcessor(project, cache=cache_folder).spike_trains(action_id)
+    assert spike_trains_cached.keys() == spike_trains.keys()
+    for channel_group, group_spike_trains in spike_trains.items():
+        for unit_id, spike_train in group_spike_trains.items():
+            np.testing.assert_array_equal(spike_trains_cached[channel_group][unit_id].times, spike_train.times)
+
+    # modifying the NWB file invalidates its cache
+    data_path = data_processor.data_path(action_id)
+    stat = data_path.stat()
+    os.utime(data_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    DataProcessor(project, cache=cache_folder).duration(action_id)
+    assert len(list(cache_folder.rglob("load_spike_times-*.pkl"))) == 0
+    assert len(list(cache_folder.rglob("get_duration-*.pkl"))) == 1
+
+    data_processor.clear_cache(action_id)
+    assert len(list(cache_folder.rglob("*.pkl"))) == 0
+
+    # a cache folder which cannot be written is a cache miss
+    not_a_folder = cache_folder / "not_a_folder"
+    not_a_folder.write_text("")
+    assert DataProcessor(project, cache=not_a_folder).duration(action_id) == data_processor.duration(action_id)
+
+
+@pytest.mark.dependency(depends=["test_curate"])
+def test_nwb_session():
+    import numpy as np
+
+    from expipe_plugin_cinpla.tools.data_loader import (
+        NWBSession,
+        get_channel_groups,
+        get_duration,
+        load_spike_times,
+        load_spiketrains,
+        load_unit_annotations,
+    )
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    data_path = project.actions[action_id].path / "data" / "main.nwb"
+
+    with NWBSession(data_path) as session:
+        duration = get_duration(session)
+        channel_groups = get_channel_groups(session)
+        spiketrains = load_spiketrains(session)
+        unit_annotations = load_unit_annotations(session)
+        spike_train_store = load_spike_times(session)
+    assert session._file is None
+
+    assert duration == get_duration(data_path)
+    assert channel_groups == get_channel_groups(data_path)
+    assert len(spiketrains) == len(unit_annotations) > 0
+    for spiketrain, spiketrain_path, annotations in zip(spiketrains, load_spiketrains(data_path), unit_annotations):
+        np.testing.assert_array_equal(spiketrain.times, spiketrain_path.times)
+        assert spiketrain.annotations["name"] == annotations["name"]
+        assert spiketrain.t_stop <= duration + spiketrain.t_start
+
+    assert spike_train_store.num_units == len(spiketrains)
+    unit_groups = load_unit_annotations(data_path, properties=["group"])
+    assert [annotations.keys() for annotations in unit_groups] == [{"name", "group"}] * len(spiketrains)
+    assert [annotations["group"] for annotations in unit_groups] == [st.annotations["group"] for st in spiketrains]
+    channel_group = spike_train_store.properties["group"].values[0]
+    t_start = float(spike_train_store.t_start) + 0.5
+    group_store = spike_train_store.select_group(channel_group).time_slice(t_start=t_start)
+    group_spiketrains = load_spiketrains(data_path, channel_group=channel_group, t_start=t_start)
+    assert group_store.num_units == len(group_spiketrains) > 0
+    for spiketrain, spiketrain_store in zip(group_spiketrains, group_store.to_neo()):
+        np.testing.assert_array_equal(spiketrain.times, spiketrain_store.times)
+        assert spiketrain.annotations["name"] == spiketrain_store.annotations["name"]
+
+
+def test_load_spiketrains_subtract_session_start_time(tmp_path):
+    from datetime import timezone
+
+    import numpy as np
+    import pynwb
+    from pynwb.ecephys import ElectricalSeries
+
+    from expipe_plugin_cinpla.tools.data_loader import load_spiketrains
+
+    # a session starting at 10 s, with 2 s of data at 1 kHz
+    session_start_time = 10.0
+    nwbfile = pynwb.NWBFile("test", "test", datetime.now(timezone.utc))
+    device = nwbfile.create_device("probe")
+    electrode_group = nwbfile.create_electrode_group("tetrode0", "tetrode", "brain", device)
+    for _ in range(4):
+        nwbfile.add_electrode(group=electrode_group, location="brain")
+    nwbfile.add_acquisition(
+        ElectricalSeries(
+            name="ElectricalSeries",
+            data=np.zeros((2000, 4), dtype="int16"),
+            electrodes=nwbfile.create_electrode_table_region(list(range(4)), "electrodes"),
+            starting_time=session_start_time,
+            rate=1000.0,
+        )
+    )
+    spike_times = [session_start_time + np.array([0.1, 0.5, 1.2]), session_start_time + np.array([0.3, 1.9])]
+    for unit_spike_times in spike_times:
+        nwbfile.add_unit(spike_times=unit_spike_times)
+    data_path = tmp_path / "main.nwb"
+    with pynwb.NWBHDF5IO(str(data_path), "w") as io:
+        io.write(nwbfile)
+
+    spiketrains = load_spiketrains(data_path)
+    assert float(spiketrains[0].t_start) == session_start_time
+    for spiketrain, unit_spike_times in zip(spiketrains, spike_times):
+        np.testing.assert_allclose(spiketrain.times.magnitude, unit_spike_times)
+
+    # the spike times, the start and the stop times are shifted, and t_start and t_stop are relative to the start
+    spiketrains = load_spiketrains(data_path, subtract_session_start_time=True)
+    for spiketrain, unit_spike_times in zip(spiketrains, spike_times):
+        assert float(spiketrain.t_start) == 0.0
+        assert float(spiketrain.t_stop) == pytest.approx(1.999)
+        np.testing.assert_allclose(spiketrain.times.magnitude, unit_spike_times - session_start_time)
+    spiketrains = load_spiketrains(data_path, t_start=0.4, t_stop=1.5, subtract_session_start_time=True)
+    np.testing.assert_allclose(spiketrains[0].times.magnitude, [0.5, 1.2])
+    assert len(spiketrains[1]) == 0
+
+
+@pytest.mark.dependency(depends=["test_process"])
+def test_curate_phy():
+    import numpy as np
+
+    project = pytest.PROJECT
+    sorter = "mountainsort5"
+    action_id = "008-081222-2"
+    curator = SortingCurator(project)
+    curator.set_action(action_id)
+    # split the first cluster in phy
+    phy_folder = curator.si_path / sorter / "phy"
+    spike_clusters = np.load(phy_folder / "spike_templates.npy")
+    cluster_spike_indices = np.flatnonzero(spike_clusters == spike_clusters[0])
+    spike_clusters[cluster_spike_indices[::2]] = spike_clusters.max() + 1
+    np.save(phy_folder / "spike_clusters.npy", spike_clusters)
+
+    curator.load_from_phy(sorter)
+    assert "split" in [unit["status"] for unit in curator.curation_diff["units"].values()]
+    assert curator.curated_analyzer.format == "binary_folder"
+    assert curator.get_curated_analyzer_folder(sorter).is_dir()
+
+    # a new curator (e.g. after a restart) reuses the saved analyzer
+    curator_restart = SortingCurator(project)
+    curator_restart.set_action(action_id)
+    assert curator_restart.load_curated_analyzer(sorter, curator.curated_analyzer.sorting) is not None
+    curator.restore_phy(sorter)
+
+
+def test_curation_diff():
+    import numpy as np
+    import spikeinterface as si
+
+    from expipe_plugin_cinpla.scripts.curation import compute_curation_diff
+
+    rng = np.random.default_rng(seed=0)
+    raw_units = {unit_id: np.sort(rng.choice(1_000_000, 200, replace=False)) for unit_id in "abcde"}
+    curated_units = dict(
+        a=raw_units["a"],
+        bc=np.sort(np.concatenate([raw_units["b"], raw_units["c"]])),
+        d0=raw_units["d"][::2],
+        d1=raw_units["d"][1::2],
+    )
+    curation_diff = compute_curation_diff(
+        si.NumpySorting.from_unit_dict(raw_units, 30000.0), si.NumpySorting.from_unit_dict(curated_units, 30000.0)
+    )
+    assert curation_diff["units"]["a"] == dict(status="unchanged", from_unit_ids=["a"])
+    assert curation_diff["units"]["bc"] == dict(status="merged", from_unit_ids=["b", "c"])
+    assert curation_diff["units"]["d0"] == dict(status="split", from_unit_ids=["d"])
+    assert curation_diff["removed"] == ["e"]
+
+
+def test_add_units_waveforms():
+    from datetime import timezone
+
+    import numpy as np
+    import pynwb
+    import spikeinterface as si
+
+    from expipe_plugin_cinpla.scripts.utils import add_units_from_sorting_analyzer
+
+    recording, sorting = si.generate_ground_truth_recording(durations=[5.0], num_channels=8, num_units=4, seed=0)
+    templates_params = dict(operators=["average", "median", "std"])
+    # without groups, the waveform means are the average templates
+    sorting_analyzer = si.create_sorting_analyzer(sorting, recording, sparse=False)
+    sorting_analyzer.compute(
+        ["random_spikes", "waveforms", "templates"], extension_params=dict(templates=templates_params)
+    )
+    nwbfile = pynwb.NWBFile("test", "test", datetime.now(timezone.utc))
+    add_units_from_sorting_analyzer(sorting_analyzer, nwbfile, "units", "units", write_electrodes_column=False)
+    template_ext = sorting_analyzer.get_extension("templates")
+    np.testing.assert_allclose(nwbfile.units["waveform_mean"][:], template_ext.get_templates(operator="average"))
+
+    # with sparsity by group, the waveform means are the median templates, on the channels of the group
+    recording.set_channel_groups([0] * 4 + [1] * 4)
+    sorting.set_property("group", [0, 0, 1, 1])
+    sorting_analyzer = si.create_sorting_analyzer(
+        sorting, recording, sparse=True, method="by_property", by_property="group"
+    )
+    sorting_analyzer.compute(
+        ["random_spikes", "waveforms", "templates"], extension_params=dict(templates=templates_params)
+    )
+    nwbfile = pynwb.NWBFile("test", "test", datetime.now(timezone.utc))
+    add_units_from_sorting_analyzer(sorting_analyzer, nwbfile, "units", "units", write_electrodes_column=False)
+    templates_median = sorting_analyzer.get_extension("templates").get_templates(operator="median")
+    for unit_index, group in enumerate([0, 0, 1, 1]):
+        np.testing.assert_allclose(
+            nwbfile.units["waveform_mean"][unit_index], templates_median[unit_index][:, group * 4 : (group + 1) * 4]
+        )
+
+
+@pytest.mark.parametrize("n_workers", [None, 1])
+def test_run_sorter_by_group_serial(tmp_path, monkeypatch, n_workers):
+    import concurrent.futures
+
+    import spikeinterface as si
+
+    resource = pytest.importorskip("resource")
+
+    from expipe_plugin_cinpla.scripts.sorting import run_sorter_by_group
+
+    recording, _ = si.generate_ground_truth_recording(durations=[10.0], num_channels=8, num_units=4, seed=0)
+    recording.set_channel_groups([0] * 4 + [1] * 4)
+    job_kwargs = si.get_global_job_kwargs()
+    rlimit_data = resource.getrlimit(resource.RLIMIT_DATA)
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("the groups are sorted on a pool of processes")
+
+    # by default, the groups are sorted sequentially in the current process
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", no_pool)
+    sorting, report = run_sorter_by_group(
+        "mountainsort5", recording, tmp_path / "sorting", n_workers=n_workers, n_jobs=2, max_memory="64G"
+    )
+    assert report["n_workers"] == 1
+    assert all(group_report["status"] == "completed" for group_report in report["groups"].values())
+    assert set(sorting.get_property("group")) <= {0, 1}
+    # the job kwargs and the memory limit of the current process are restored
+    assert si.get_global_job_kwargs() == job_kwargs
+    assert resource.getrlimit(resource.RLIMIT_DATA) == rlimit_data
+
+
+@pytest.mark.skipif(not Path("/proc/self/io").is_file(), reason="I/O counters are only available on Linux")
+def test_stage_profiler_children_io(tmp_path):
+    import subprocess
+    import sys
+
+    from expipe_plugin_cinpla.scripts.profiling import StageProfiler
+
+    n_bytes = 5_000_000
+    write_code = f"open({str(tmp_path / 'data.bin')!r}, 'wb').write(bytes({n_bytes}))"
+    profiler = StageProfiler(tmp_path / "profile")
+    # terminated child process
+    with profiler.stage("terminated"):
+        subprocess.run([sys.executable, "-c", write_code], check=True)
+    # running child process
+    child = subprocess.Popen(
+        [sys.executable, "-c", f"{write_code}; print('written', flush=True); input()"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    with profiler.stage("running"):
+        assert child.stdout.readline().strip() == "written"
+    child.communicate("\n")
+    for stage_profile in profiler.profile["stages"]:
+        assert stage_profile["write_chars"] >= n_bytes
+
+
+@pytest.mark.dependency(depends=["test_curate"])
+def test_nwb_append_writer_rollback():
+    import pynwb
+
+    from expipe_plugin_cinpla.nwbutils.nwbappendwriter import (
+        NWBAppendWriter,
+        get_journal_path,
+    )
+
+    project = pytest.PROJECT
+    action_id = "008-081222-2"
+    nwbfile_path = project.actions[action_id].path / "data" / "main.nwb"
+
+    with pytest.raises(ValueError):
+        with NWBAppendWriter(nwbfile_path) as writer:
+            assert writer.remove("units")
+            nwbfile = writer.read()
+            nwbfile.add_unit_column(name="failed_column", description="never written", data=[])
+            raise ValueError("simulated failure")
+
+    assert not get_journal_path(nwbfile_path).is_file()
+    with pynwb.NWBHDF5IO(str(nwbfile_path), "r") as io:
+        nwbfile = io.read()
+        assert nwbfile.units is not None
+        assert "failed_column" not in nwbfile.units.colnames
+        # readers of the file are not closed by the writer
+        with pytest.raises(RuntimeError):
+            with NWBAppendWriter(nwbfile_path):
+                pass
+        assert len(nwbfile.units.id[:]) > 0
 
 
 if __name__ == "__main__":
+    import tempfile
+
     from conftest import pytest_configure
 
     pytest_configure()
 
     test_register_entity()
     test_register_openephys()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_save_fused(Path(tmp_dir))
     test_process()
+    test_process_resume()
+    test_compute_extensions()
+    test_load_lfp()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_process_many(Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_process_slurm(Path(tmp_dir))
     test_curate()
+    test_data_processor_cache()
+    test_nwb_session()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_load_spiketrains_subtract_session_start_time(Path(tmp_dir))
+    test_curate_phy()
+    test_curation_diff()
+    test_add_units_waveforms()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_run_sorter_by_group_serial(Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_stage_profiler_children_io(Path(tmp_dir))
+    test_nwb_append_writer_rollback()